@@ -0,0 +1,173 @@
+'''
+Bandwidth shared by the transfers of all the engines
+
+The clients ask the BandwidthScheduler before sending or after receiving each buffer. Every flow,
+an engine synchronization or DirectEdit, gets a share of the global and of the direction limits
+proportional to its weight among the flows currently transferring, through its own token bucket.
+'''
+from threading import Lock
+import time
+
+UPLOAD = 'upload'
+DOWNLOAD = 'download'
+DIRECTIONS = (UPLOAD, DOWNLOAD)
+# Flow of the DirectEdit transfers, an interactive save should not wait for the synchronization
+DIRECT_EDIT_FLOW = 'direct_edit'
+DEFAULT_DIRECT_EDIT_WEIGHT = 4
+DEFAULT_WEIGHT = 1
+# Time in s without transfer after which a flow leaves its share to the others
+FLOW_IDLE_TIME = 2
+# Bytes a flow can send at once after an idle period, in seconds of its rate
+BURST_TIME = 0.5
+# Time in s over which the rates are measured
+RATE_WINDOW = 5
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, now=None):
+        self._rate = rate
+        self._tokens = rate * BURST_TIME
+        self._updated = time.time() if now is None else now
+
+    def _refill(self, now):
+        elapsed = max(now - self._updated, 0)
+        self._tokens = min(self._tokens + elapsed * self._rate, self._rate * BURST_TIME)
+        self._updated = now
+
+    def set_rate(self, rate, now):
+        self._refill(now)
+        self._rate = rate
+
+    def consume(self, size, now):
+        '''
+        Take the tokens, going in debt if needed, return the time in s to wait for the debt to be repaid
+        '''
+        self._refill(now)
+        self._tokens -= size
+        if self._tokens >= 0:
+            return 0
+        return -self._tokens / self._rate
+
+
+class TransferRate(object):
+
+    def __init__(self, now):
+        self.total = 0
+        self.rate = 0.0
+        self._window_start = now
+        self._window_bytes = 0
+
+    def add(self, size, now):
+        self.total += size
+        self._window_bytes += size
+        elapsed = now - self._window_start
+        if elapsed >= RATE_WINDOW:
+            self.rate = self._window_bytes / elapsed
+            self._window_start = now
+            self._window_bytes = 0
+
+    def get_rate(self, now):
+        elapsed = now - self._window_start
+        if elapsed >= RATE_WINDOW:
+            # Nothing transferred since the last window
+            return self._window_bytes / elapsed
+        return self.rate
+
+
+class BandwidthScheduler(object):
+    '''
+    Limits are in bytes per second, None or 0 for no limit
+    '''
+    def __init__(self, limit=None, upload_limit=None, download_limit=None):
+        self._limits = {None: limit, UPLOAD: upload_limit, DOWNLOAD: download_limit}
+        self._weights = {DIRECT_EDIT_FLOW: DEFAULT_DIRECT_EDIT_WEIGHT}
+        # By (flow, direction)
+        self._buckets = dict()
+        self._active = dict()
+        self._rates = dict()
+        self._throttled = 0.0
+        self._lock = Lock()
+
+    def get_limit(self, direction=None):
+        return self._limits[direction]
+
+    def set_limit(self, limit, direction=None):
+        self._limits[direction] = limit or None
+
+    def get_weight(self, flow):
+        return self._weights.get(flow, DEFAULT_WEIGHT)
+
+    def set_weight(self, flow, weight):
+        self._weights[flow] = weight
+
+    def _get_rate(self, flow, direction, now):
+        # Share of the flow in the global and the direction limits, among the active flows
+        weight = self.get_weight(flow)
+        rate = None
+        for scope in (None, direction):
+            limit = self._limits[scope]
+            if not limit:
+                continue
+            total = sum(self.get_weight(active_flow) for active_flow, active_direction in self._active
+                        if scope is None or active_direction == scope)
+            share = float(limit) * weight / total
+            rate = share if rate is None else min(rate, share)
+        return rate
+
+    def acquire(self, direction, flow, size, now=None):
+        '''
+        Account size bytes transferred by the flow, return the time in s it must wait before going on
+        '''
+        if now is None:
+            now = time.time()
+        key = (flow, direction)
+        self._lock.acquire()
+        try:
+            for active, last in self._active.items():
+                if now - last > FLOW_IDLE_TIME:
+                    del self._active[active]
+            self._active[key] = now
+            transfer_rate = self._rates.get(key)
+            if transfer_rate is None:
+                transfer_rate = self._rates[key] = TransferRate(now)
+            transfer_rate.add(size, now)
+            rate = self._get_rate(flow, direction, now)
+            if rate is None:
+                self._buckets.pop(key, None)
+                return 0
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(rate, now)
+            else:
+                bucket.set_rate(rate, now)
+            wait = bucket.consume(size, now)
+            self._throttled += wait
+            return wait
+        finally:
+            self._lock.release()
+
+    def consume(self, direction, flow, size):
+        wait = self.acquire(direction, flow, size)
+        if wait > 0:
+            time.sleep(wait)
+
+    def get_metrics(self):
+        now = time.time()
+        metrics = dict()
+        metrics["limit"] = self._limits[None]
+        metrics["throttled_time"] = self._throttled
+        self._lock.acquire()
+        try:
+            for direction in DIRECTIONS:
+                metrics[direction + "_limit"] = self._limits[direction]
+                metrics[direction + "_rate"] = 0.0
+                metrics[direction + "_total"] = 0
+            for (flow, direction), transfer_rate in self._rates.iteritems():
+                rate = transfer_rate.get_rate(now)
+                metrics["%s_%s_rate" % (flow, direction)] = rate
+                metrics[direction + "_rate"] += rate
+                metrics[direction + "_total"] += transfer_rate.total
+        finally:
+            self._lock.release()
+        return metrics
@@ -15,6 +15,7 @@ from nxdrive.logging_config import get_logger
 from nxdrive.client.common import BaseClient
 from nxdrive.client.common import DEFAULT_REPOSITORY_NAME
 from nxdrive.client.common import FILE_BUFFER_SIZE
+from nxdrive.client.bandwidth import UPLOAD, DOWNLOAD
 from nxdrive.client.common import DEFAULT_IGNORED_PREFIXES
 from nxdrive.client.common import DEFAULT_IGNORED_SUFFIXES
 from nxdrive.client.common import safe_filename
@@ -175,6 +176,9 @@ class BaseAutomationClient(BaseClient):
         # Function to check during long-running processing like upload /
         # download if the synchronization thread needs to be suspended
         self.check_suspended = check_suspended
+        # BandwidthScheduler sharing the transfers, and the flow of this client in it
+        self.bandwidth = None
+        self.bandwidth_flow = None
 
         if timeout is None or timeout < 0:
             timeout = 20
@@ -377,6 +381,7 @@ class BaseAutomationClient(BaseClient):
                         buffer_ = resp.read(self.get_download_buffer())
                         if buffer_ == '':
                             break
+                        self._throttle(DOWNLOAD, len(buffer_))
                         if current_action:
                             current_action.progress += (
                                                 self.get_download_buffer())
@@ -763,6 +768,7 @@ class BaseAutomationClient(BaseClient):
             r = file_object.read(buffer_size)
             if not r:
                 break
+            self._throttle(UPLOAD, len(r))
             if current_action is not None:
                 current_action.progress += buffer_size
             yield r
@@ -805,6 +811,7 @@ class BaseAutomationClient(BaseClient):
                             buffer_ = response.read(self.get_download_buffer())
                             if buffer_ == '':
                                 break
+                            self._throttle(DOWNLOAD, len(buffer_))
                             if current_action:
                                 current_action.progress += (
                                                     self.get_download_buffer())
@@ -842,5 +849,10 @@ class BaseAutomationClient(BaseClient):
                 e.msg = base_error_message + ": " + e.msg
             raise
 
+    def _throttle(self, direction, size):
+        # Wait for the share of the bandwidth of the flow
+        if self.bandwidth is not None:
+            self.bandwidth.consume(direction, self.bandwidth_flow, size)
+
     def get_download_buffer(self):
         return FILE_BUFFER_SIZE
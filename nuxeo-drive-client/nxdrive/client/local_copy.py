@@ -0,0 +1,197 @@
+'''
+Copy of the synchronized files matching the digest of a download
+
+The processors copy a local duplicate instead of downloading the content. Where the filesystem
+shares the extents, btrfs, XFS or APFS, the copy is a clone: no data is written until one of the
+files changes. Elsewhere copy_file_range lets the kernel copy without going through user space.
+The method is detected for each sync root, a failing copy falls back on the next methods.
+
+Hard links are not used, the synchronized files must stay independent when one of them changes.
+'''
+from threading import Lock
+import ctypes
+import ctypes.util
+import errno
+import os
+import shutil
+import sys
+from nxdrive.logging_config import get_logger
+log = get_logger(__name__)
+
+CLONE = 'clone'
+KERNEL_COPY = 'kernel_copy'
+COPY = 'copy'
+# From the fastest, COPY always works
+METHODS = (CLONE, KERNEL_COPY, COPY)
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+# Bytes asked on each copy_file_range call
+KERNEL_COPY_CHUNK_SIZE = 1 << 30
+PROBE_PREFIX = '.nxcopy-probe-'
+PROBE_SUFFIX = '.nxpart'
+PROBE_SIZE = 64 * 1024
+
+_libc_lock = Lock()
+_libc_functions = dict()
+
+
+def _get_libc_function(name, argtypes, restype):
+    if sys.platform == 'win32':
+        return None
+    _libc_lock.acquire()
+    try:
+        if name not in _libc_functions:
+            function = None
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+                function = getattr(libc, name)
+                function.argtypes = argtypes
+                function.restype = restype
+            except (OSError, AttributeError):
+                log.debug("No %s in the C library", name)
+            _libc_functions[name] = function
+        return _libc_functions[name]
+    finally:
+        _libc_lock.release()
+
+
+def _raise_errno():
+    err = ctypes.get_errno()
+    raise OSError(err, os.strerror(err))
+
+
+def _encode(path):
+    if isinstance(path, unicode):
+        return path.encode(sys.getfilesystemencoding() or 'utf-8')
+    return path
+
+
+def _clone(src, dst):
+    if sys.platform.startswith('linux'):
+        import fcntl
+        with open(src, 'rb') as file_in:
+            with open(dst, 'wb') as file_out:
+                fcntl.ioctl(file_out.fileno(), FICLONE, file_in.fileno())
+        return
+    clonefile = None
+    if sys.platform == 'darwin':
+        clonefile = _get_libc_function('clonefile', [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_uint],
+                                       ctypes.c_int)
+    if clonefile is None:
+        raise OSError(errno.EOPNOTSUPP, "Cannot clone files on %s" % sys.platform)
+    # clonefile does not replace the destination
+    if os.path.exists(dst):
+        os.remove(dst)
+    if clonefile(_encode(src), _encode(dst), 0) != 0:
+        _raise_errno()
+
+
+def _kernel_copy(src, dst):
+    copy_file_range = _get_libc_function('copy_file_range', [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                                         ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint], ctypes.c_ssize_t)
+    if copy_file_range is None:
+        raise OSError(errno.ENOSYS, "No copy_file_range on %s" % sys.platform)
+    with open(src, 'rb') as file_in:
+        with open(dst, 'wb') as file_out:
+            size = os.fstat(file_in.fileno()).st_size
+            remaining = size
+            while remaining > 0:
+                copied = copy_file_range(file_in.fileno(), None, file_out.fileno(), None,
+                                         min(remaining, KERNEL_COPY_CHUNK_SIZE), 0)
+                if copied < 0:
+                    _raise_errno()
+                if copied == 0:
+                    break
+                remaining -= copied
+    if remaining > 0:
+        # The source was truncated meanwhile, or the filesystem stopped early: the next method copies it again
+        raise IOError(errno.EIO, "Copied %d bytes of %d from %r" % (size - remaining, size, src))
+
+
+def _copy(src, dst):
+    shutil.copyfile(src, dst)
+
+
+_COPIERS = {CLONE: _clone, KERNEL_COPY: _kernel_copy, COPY: _copy}
+
+
+def copy_file(src, dst, method=CLONE):
+    '''
+    Copy the content and the mode of src to dst, starting with the method then falling back on the
+    next ones, return the method used
+    '''
+    for candidate in METHODS[METHODS.index(method):]:
+        try:
+            _COPIERS[candidate](src, dst)
+        except (IOError, OSError) as e:
+            if candidate == COPY:
+                raise
+            log.trace("Cannot %s %r to %r, falling back: %r", candidate, src, dst, e)
+            continue
+        shutil.copymode(src, dst)
+        return candidate
+
+
+def detect_copy_method(folder):
+    '''
+    Return the fastest method copying between two files of the folder, None if it cannot be tested
+    '''
+    src = os.path.join(folder, PROBE_PREFIX + 'src' + PROBE_SUFFIX)
+    dst = os.path.join(folder, PROBE_PREFIX + 'dst' + PROBE_SUFFIX)
+    data = os.urandom(PROBE_SIZE)
+    try:
+        with open(src, 'wb') as probe:
+            probe.write(data)
+        for method in METHODS[:-1]:
+            try:
+                _COPIERS[method](src, dst)
+                with open(dst, 'rb') as probe:
+                    if probe.read() == data:
+                        return method
+            except (IOError, OSError) as e:
+                log.debug("Cannot %s in %r: %r", method, folder, e)
+        return COPY
+    except (IOError, OSError) as e:
+        log.debug("Cannot detect the copy method of %r: %r", folder, e)
+        return None
+    finally:
+        for path in (src, dst):
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+class LocalCopier(object):
+    '''
+    Copies of a sync root with their metrics, thread safe
+    '''
+    def __init__(self, method=None):
+        self.method = method if method in METHODS else CLONE
+        self._files = dict.fromkeys(METHODS, 0)
+        self._bytes = dict.fromkeys(METHODS, 0)
+        self._fallbacks = 0
+        self._lock = Lock()
+
+    def copy(self, src, dst):
+        used = copy_file(src, dst, self.method)
+        size = os.path.getsize(dst)
+        self._lock.acquire()
+        try:
+            self._files[used] += 1
+            self._bytes[used] += size
+            if used != self.method:
+                self._fallbacks += 1
+        finally:
+            self._lock.release()
+        return used
+
+    def get_metrics(self):
+        metrics = dict(method=self.method, fallbacks=self._fallbacks)
+        for method in METHODS:
+            metrics[method + "_files"] = self._files[method]
+            metrics[method + "_bytes"] = self._bytes[method]
+        # The clones share the extents of their source
+        metrics["not_copied_bytes"] = self._bytes[CLONE]
+        return metrics
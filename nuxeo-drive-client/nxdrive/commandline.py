@@ -621,18 +621,23 @@ class CliHandler(object):
             # List the test modules explicitly as recursive discovery is broken
             # when the app is frozen.
             argv += [
+                "nxdrive.tests.test_bandwidth",
                 "nxdrive.tests.test_bind_server",
                 "nxdrive.tests.test_blacklist_queue",
                 "nxdrive.tests.test_bulk_remote_changes",
                 "nxdrive.tests.test_commandline",
+                "nxdrive.tests.test_concurrency",
                 "nxdrive.tests.test_conflicts",
                 "nxdrive.tests.test_copy",
+                "nxdrive.tests.test_delay_queue",
                 "nxdrive.tests.test_direct_edit",
                 "nxdrive.tests.test_encoding",
                 "nxdrive.tests.test_engine_dao",
                 "nxdrive.tests.test_concurrent_synchronization",
+                "nxdrive.tests.test_histogram",
                 "nxdrive.tests.test_integration_local_root_deletion",
                 "nxdrive.tests.test_local_client",
+                "nxdrive.tests.test_local_copy",
                 "nxdrive.tests.test_local_copy_paste",
                 "nxdrive.tests.test_local_create_folders",
                 "nxdrive.tests.test_local_deletion",
@@ -644,7 +649,11 @@ class CliHandler(object):
                 "nxdrive.tests.test_manager_dao",
                 "nxdrive.tests.test_model_filters",
                 "nxdrive.tests.test_multiple_files",
+                "nxdrive.tests.test_path_index",
                 "nxdrive.tests.test_permission_hierarchy",
+                "nxdrive.tests.test_prefetch",
+                "nxdrive.tests.test_processor",
+                "nxdrive.tests.test_queue_manager",
                 "nxdrive.tests.test_readonly",
                 "nxdrive.tests.test_reinit_database",
                 "nxdrive.tests.test_remote_changes",
@@ -653,6 +662,7 @@ class CliHandler(object):
                 "nxdrive.tests.test_remote_file_system_client",
                 "nxdrive.tests.test_remote_move_and_rename",
                 "nxdrive.tests.test_report",
+                "nxdrive.tests.test_scheduler",
                 "nxdrive.tests.test_security_updates",
                 "nxdrive.tests.test_shared_folders",
                 "nxdrive.tests.test_sync_roots",
@@ -23,6 +23,8 @@ class DebugDriveApi(WebDriveApi):
     def _export_engine(self, engine):
         result = super(DebugDriveApi, self)._export_engine(engine)
         result["queue"]["metrics"] = engine.get_queue_manager().get_metrics()
+        result["dao_metrics"] = engine.get_dao().get_metrics()
+        result["diagnostics"] = engine.get_diagnostics()
         result["queue"]["local_folder_enable"] = engine.get_queue_manager()._local_folder_enable
         result["queue"]["local_file_enable"] = engine.get_queue_manager()._local_file_enable
         result["queue"]["remote_folder_enable"] = engine.get_queue_manager()._remote_folder_enable
@@ -168,6 +170,15 @@ class DebugDriveApi(WebDriveApi):
         except Exception as e:
             log.exception(e)
 
+    @QtCore.pyqtSlot(str, result=str)
+    def check_state_counters(self, uid):
+        try:
+            engine = self._get_engine(uid)
+            return self._json(engine.get_dao().check_state_counters())
+        except Exception as e:
+            log.exception(e)
+            return None
+
     @QtCore.pyqtSlot(str)
     def direct_edit(self, url):
         try:
@@ -10,11 +10,12 @@ from nxdrive.client.local_client import LocalClient
 from nxdrive.client.base_automation_client import DOWNLOAD_TMP_FILE_PREFIX
 from nxdrive.client.base_automation_client import DOWNLOAD_TMP_FILE_SUFFIX
 from nxdrive.client.common import NotFound
+from nxdrive.client.bandwidth import DIRECT_EDIT_FLOW
 from nxdrive.utils import guess_digest_algorithm, current_milli_time
 from nxdrive.osi import parse_protocol_url
 import os
 import sys
-from time import sleep
+from time import sleep, time
 import shutil
 from PyQt4.QtCore import pyqtSignal, pyqtSlot
 from Queue import Queue, Empty
@@ -197,7 +198,7 @@ class DirectEdit(Worker):
             local_client = engine.get_local_client()
             existing_file_path = local_client.abspath(pair.local_path)
             log.debug('Local file matches remote digest %r, copying it from %r', info.digest, existing_file_path)
-            shutil.copy(existing_file_path, file_out)
+            engine.get_local_copier().copy(existing_file_path, file_out)
             if pair.is_readonly():
                 log.debug('Unsetting readonly flag on copied file %r', file_out)
                 from nxdrive.client.common import BaseClient
@@ -236,6 +237,7 @@ class DirectEdit(Worker):
         remote_client = engine.get_remote_doc_client()
         # Avoid any link with the engine, remote_doc are not cached so we can do that
         remote_client.check_suspended = self.stop_client
+        remote_client.bandwidth_flow = DIRECT_EDIT_FLOW
         rest_client = engine.get_rest_api_client()
         doc = rest_client.fetch(doc_id, fetchDocument=['lock'], enrichers=['permissions'])
         info = remote_client.doc_to_info(doc)
@@ -327,6 +329,7 @@ class DirectEdit(Worker):
             raise NotFound()
         remote_client = engine.get_remote_doc_client()
         remote_client.check_suspended = self.stop_client
+        remote_client.bandwidth_flow = DIRECT_EDIT_FLOW
         digest_algorithm = self._local_client.get_remote_id(dir_path, "nxdirecteditdigestalgorithm")
         digest = self._local_client.get_remote_id(dir_path, "nxdirecteditdigest")
         return uid, engine, remote_client, digest_algorithm, digest
@@ -372,11 +375,13 @@ class DirectEdit(Worker):
                 # Try again in 30s
                 log.debug("Can't %s document '%s': %r", item[1], ref, e, exc_info=True)
                 self.directEditLockError.emit(item[1], os.path.basename(ref), uid)
-        # Unqueue any errors
-        item = self._error_queue.get()
-        while (item is not None):
-            self._upload_queue.put(item.get())
+        # Unqueue the errors once the earliest one is due
+        next_try = self._error_queue.get_next_try()
+        if next_try is not None and next_try < int(time()):
             item = self._error_queue.get()
+            while (item is not None):
+                self._upload_queue.put(item.get())
+                item = self._error_queue.get()
         # Handle the upload queue
         while (not self._upload_queue.empty()):
             try:
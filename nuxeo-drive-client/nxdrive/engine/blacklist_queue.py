@@ -3,7 +3,7 @@ Created on 1 juil. 2015
 
 @author: Remi Cattiau
 '''
-from threading import Lock
+from nxdrive.engine.delay_queue import DelayQueue
 import time
 
 
@@ -40,17 +40,12 @@ class BlacklistItem(object):
 class BlacklistQueue(object):
 
     def __init__(self, delay=30):
-        self._queue = dict()
-        self._lock = Lock()
+        self._queue = DelayQueue()
         self._delay = delay
 
     def push(self, id_obj, obj):
         item = BlacklistItem(item_id=id_obj, item=obj, next_try=self._delay)
-        self._lock.acquire()
-        try:
-            self._queue[item.get_id()] = item
-        finally:
-            self._lock.release()
+        self._queue.push(item.get_id(), item, item._next_try)
 
     def repush(self, item, increase_wait=True):
         if not isinstance(item, BlacklistItem):
@@ -59,19 +54,10 @@ class BlacklistQueue(object):
             item.increase()
         else:
             item.increase(next_try=self._delay)
-        self._lock.acquire()
-        try:
-            self._queue[item.get_id()] = item
-        finally:
-            self._lock.release()
+        self._queue.push(item.get_id(), item, item._next_try)
 
     def get(self):
-        cur_time = int(time.time())
-        self._lock.acquire()
-        try:
-            for item in self._queue.values():
-                if item.check(cur_time=cur_time):
-                    del self._queue[item.get_id()]
-                    return item
-        finally:
-            self._lock.release()
+        return self._queue.get(cur_time=int(time.time()))
+
+    def get_next_try(self):
+        return self._queue.get_next_due()
@@ -0,0 +1,154 @@
+'''
+Adaptive number of generic file processors
+
+The controller follows the synchronization results of a window: it halves the processors
+when the server is overloaded (5xx answers and timeouts), it holds while the local disk is slow
+and it adds one processor while the throughput keeps increasing with pending files.
+The disk latency is the time the handlers spend in the calls of their LocalClient, measured
+by a LocalIOTimer: the remote calls and the database work are not counted.
+'''
+from threading import Lock
+from urllib2 import HTTPError, URLError
+import socket
+import time
+
+# Time in s between two adjustments
+DEFAULT_CONCURRENCY_WINDOW = 30
+# Limits of the generic processors of an engine
+DEFAULT_MIN_PROCESSORS = 1
+DEFAULT_MAX_PROCESSORS = 20
+# Share of the pairs of a window failing on overload from which the processors are halved
+OVERLOAD_ERROR_RATE = 0.05
+# Relative throughput change considered as an increase or a decrease
+THROUGHPUT_MARGIN = 0.05
+# Average time in s spent in the LocalClient calls by a pair from which the disk is considered saturated
+DISK_LATENCY_THRESHOLD = 1.0
+
+
+def is_overload_error(exception):
+    if isinstance(exception, HTTPError):
+        return exception.code >= 500 or exception.code in (408, 429)
+    if isinstance(exception, socket.timeout):
+        return True
+    if isinstance(exception, URLError):
+        return isinstance(exception.reason, socket.timeout) or 'timed out' in str(exception.reason)
+    return False
+
+
+class LocalIOTimer(object):
+    '''
+    Proxy of a LocalClient adding up the time spent in its calls
+    '''
+
+    def __init__(self, client):
+        self._client = client
+        self.elapsed = 0.0
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                self.elapsed += time.time() - start
+        return timed
+
+
+class ConcurrencyController(object):
+
+    def __init__(self, processors, min_processors=DEFAULT_MIN_PROCESSORS, max_processors=DEFAULT_MAX_PROCESSORS):
+        self._min = min_processors
+        self._max = max(max_processors, min_processors)
+        self._limit = min(max(processors, self._min), self._max)
+        self._lock = Lock()
+        self._last_throughput = None
+        self._last_change = 0
+        self._adjustments = 0
+        self._reset_window(time.time())
+
+    def _reset_window(self, now):
+        self._window_start = now
+        self._synced = 0
+        self._bytes = 0
+        self._errors = 0
+        self._overloads = 0
+        self._local_io_time = 0.0
+
+    def get_limit(self):
+        return self._limit
+
+    def record_sync(self, metrics):
+        '''
+        Count a synchronized pair from the pairSync metrics, times are in ms
+        '''
+        self._lock.acquire()
+        try:
+            self._synced += 1
+            self._bytes += metrics.get("size", 0)
+            self._local_io_time += metrics.get("local_io_time", 0) / 1000.0
+        finally:
+            self._lock.release()
+
+    def record_error(self, exception=None):
+        self._lock.acquire()
+        try:
+            self._errors += 1
+            if is_overload_error(exception):
+                self._overloads += 1
+        finally:
+            self._lock.release()
+
+    def adjust(self, backlog, now=None):
+        '''
+        Return the number of generic processors for the next window
+        '''
+        if now is None:
+            now = time.time()
+        self._lock.acquire()
+        try:
+            elapsed = now - self._window_start
+            done = self._synced + self._errors
+            if elapsed <= 0 or done == 0:
+                self._reset_window(now)
+                return self._limit
+            # Pairs and bytes per second, small files are limited by the first and big ones by the second
+            throughput = (self._synced / elapsed, self._bytes / elapsed)
+            last = self._last_throughput
+            limit = self._limit
+            if float(self._overloads) / done > OVERLOAD_ERROR_RATE:
+                # Multiplicative decrease, the server or the link is saturated
+                limit = max(self._min, limit // 2)
+            elif self._synced and self._local_io_time / self._synced > DISK_LATENCY_THRESHOLD:
+                # More processors would only wait on the disk
+                pass
+            elif last is None or any(rate > previous * (1 + THROUGHPUT_MARGIN)
+                                     for rate, previous in zip(throughput, last)):
+                if backlog > 0:
+                    limit = min(self._max, limit + 1)
+            elif self._last_change > 0 and all(rate < previous * (1 - THROUGHPUT_MARGIN)
+                                               for rate, previous in zip(throughput, last)):
+                # The last processor added made it worse
+                limit = max(self._min, limit - 1)
+            self._last_change = limit - self._limit
+            if self._last_change:
+                self._adjustments += 1
+            self._limit = limit
+            self._last_throughput = throughput
+            self._reset_window(now)
+            return limit
+        finally:
+            self._lock.release()
+
+    def get_metrics(self):
+        metrics = dict()
+        metrics["limit"] = self._limit
+        metrics["min"] = self._min
+        metrics["max"] = self._max
+        metrics["adjustments"] = self._adjustments
+        if self._last_throughput is not None:
+            metrics["pairs_per_second"], metrics["bytes_per_second"] = self._last_throughput
+        return metrics
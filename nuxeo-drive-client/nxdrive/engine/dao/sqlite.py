@@ -1,13 +1,45 @@
 import sqlite3
 import os
+import shutil
+import re
 import inspect
-from threading import RLock, local, current_thread
+from threading import Lock, RLock, Condition, Event, Thread, local, current_thread
+from Queue import Queue, Empty
+from collections import OrderedDict
 from datetime import datetime
+from time import sleep, time
 from nxdrive.logging_config import get_logger
 from PyQt4.QtCore import pyqtSignal, QObject
 log = get_logger(__name__)
 
 SCHEMA_VERSION = "schema_version"
+# Reader connections kept by the pool
+DEFAULT_READERS_POOL_SIZE = 5
+# Time in ms sqlite waits on a locked database before failing
+DEFAULT_BUSY_TIMEOUT = 5000
+# Maximum number of mutations committed together by the writer thread
+DEFAULT_GROUP_COMMIT_SIZE = 100
+# Time in s the writer thread waits for more mutations before committing,
+# 0 commits as soon as the pending mutations are applied
+DEFAULT_GROUP_COMMIT_INTERVAL = 0
+# Time in s a caller waits for the writer thread to commit its mutation
+DEFAULT_WRITE_TIMEOUT = 60
+# Number of lookups kept by the StateRow cache, 0 disables it
+DEFAULT_STATE_CACHE_SIZE = 5000
+# Rows fetched by each query of the iter_* methods
+DEFAULT_ITER_BATCH_SIZE = 1000
+# VACUUM INTO copies the database in a single read transaction
+SNAPSHOT_MIN_SQLITE_VERSION = (3, 27, 0)
+# Free pages released by each incremental vacuum, and the minimum time in s between two of them
+DEFAULT_VACUUM_PAGES = 1000
+DEFAULT_VACUUM_INTERVAL = 3600
+# Time in s from which a statement is logged with its query plan when the profiling is enabled
+DEFAULT_SLOW_QUERY_THRESHOLD = 0.1
+# Upper bounds in s of the profiling histograms buckets, the last bucket has no bound
+PROFILE_HISTOGRAM_BOUNDS = ((0.001, 'le_1ms'), (0.01, 'le_10ms'), (0.1, 'le_100ms'), (1, 'le_1s'))
+PROFILE_HISTOGRAM_OVERFLOW = 'gt_1s'
+# Attributes set on the StateRow that are not columns of States
+STATE_ROW_EXTRA_FIELDS = ('error_next_try',)
 
 # Summary status from last known pair of states
 
@@ -45,29 +77,380 @@ PAIR_STATES = {
     ('deleted', 'unknown'): 'deleted_unknown',
 }
 
+# Integer codes of the local_state, remote_state, pair_state and last_transfer columns since the
+# schema version 8, the code is the position of the name: they are persisted so only append new ones
+STATE_NAMES = (
+    'unknown', 'synchronized', 'created', 'modified', 'moved', 'deleted',
+    'locally_created', 'locally_modified', 'locally_moved', 'locally_moved_created',
+    'locally_moved_remotely_modified', 'locally_deleted', 'parent_locally_deleted',
+    'remotely_created', 'remotely_modified', 'remotely_deleted', 'parent_remotely_deleted',
+    'conflicted', 'unsynchronized', 'unknown_deleted', 'deleted_unknown',
+    'upload', 'download',
+)
+STATE_CODES = dict((name, code) for code, name in enumerate(STATE_NAMES))
+STATE_COLUMNS = ('local_state', 'remote_state', 'pair_state', 'last_transfer')
+
+
+def state_code(name):
+    # A name without code is stored as is
+    return STATE_CODES.get(name, name)
+
+
+def _state_codes_sql(*names):
+    return ", ".join(str(STATE_CODES[name]) for name in names)
+
+# Secondary indexes of the States table, created with the schema version 4
+STATE_INDEXES = (
+    ('States_local_path', 'local_path'),
+    ('States_local_parent_path', 'local_parent_path'),
+    ('States_remote_parent_ref', 'remote_parent_ref, remote_name'),
+    ('States_remote_digest', 'remote_digest'),
+    ('States_pair_state', 'pair_state, folderish'),
+    ('States_error_count', 'error_count'),
+    ('States_processor', 'processor'),
+    ('States_last_sync_date', 'last_sync_date'),
+    # Since the schema version 9
+    ('States_remote_parent_path', 'remote_parent_path'),
+)
+
+# Error threshold of the errors and syncing counters
+STATE_COUNTERS_THRESHOLD = 3
+# Columns of the StateCounters table, created with the schema version 5, with the condition
+# and the value a row of States adds to it ({0} stands for the row)
+STATE_COUNTERS = (
+    ('synchronized', "{0}.pair_state=" + _state_codes_sql('synchronized'), '1'),
+    ('sync_files', "{0}.pair_state=" + _state_codes_sql('synchronized') + " AND {0}.folderish=0", '1'),
+    ('sync_folders', "{0}.pair_state=" + _state_codes_sql('synchronized') + " AND {0}.folderish=1", '1'),
+    ('sync_size', "{0}.pair_state=" + _state_codes_sql('synchronized'), 'IFNULL({0}.size, 0)'),
+    ('syncing', "{0}.pair_state NOT IN (" + _state_codes_sql('synchronized', 'conflicted', 'unsynchronized') +
+                ") AND {0}.error_count < " + str(STATE_COUNTERS_THRESHOLD), '1'),
+    ('errors', "{0}.error_count > " + str(STATE_COUNTERS_THRESHOLD), '1'),
+    ('conflicts', "{0}.pair_state=" + _state_codes_sql('conflicted'), '1'),
+    ('unsynchronized', "{0}.pair_state=" + _state_codes_sql('unsynchronized'), '1'),
+)
+
+# Queue of the WorkQueue table, created with the schema version 7, a row of States belongs to
+# ({0} stands for the row), NULL if it is not processable
+WORK_QUEUE_KIND = ("(CASE WHEN {0}.pair_state IN (" +
+                   _state_codes_sql(*[name for name in STATE_NAMES if name.startswith('locally')]) +
+                   ") THEN 'local' WHEN {0}.pair_state IN (" +
+                   _state_codes_sql(*[name for name in STATE_NAMES if name.startswith('remotely')]) +
+                   ") THEN 'remote' END || CASE WHEN {0}.folderish=1 THEN '_folder' ELSE '_file' END)")
+# Depth of the pair, parents are dequeued before their children
+WORK_QUEUE_PRIORITY = "(length({0}.local_path) - length(replace({0}.local_path, '/', '')))"
+WORK_QUEUE_KINDS = ('local_folder', 'local_file', 'remote_folder', 'remote_file')
+
+
 class AutoRetryCursor(sqlite3.Cursor):
+    # The profiler only times execute(), a SELECT steps to its first row there: _select times the fetch itself
+    profiled = True
+
     def execute(self, *args, **kwargs):
         count = 0
         obj = None
         while (1):
             try:
                 count += 1
-                obj = super(AutoRetryCursor, self).execute(*args, **kwargs)
+                if self.connection.profiler is None or not self.profiled:
+                    obj = super(AutoRetryCursor, self).execute(*args, **kwargs)
+                else:
+                    start = time()
+                    obj = super(AutoRetryCursor, self).execute(*args, **kwargs)
+                    self.connection.profiler.record_query(time() - start, *args)
                 if count > 1:
                     log.trace('Result returned from try #%d', count)
                 break
             except sqlite3.OperationalError as e:
+                # Only a lock held by another connection can go away, the other errors would fail again
+                message = str(e)
+                if 'locked' not in message and 'busy' not in message:
+                    raise
                 log.trace('Retry locked database #%d', count)
+                self.connection.retries += 1
                 if count > 5:
                     raise e
+                # Back off a little to let the other connection finish
+                sleep(0.01 * count)
         return obj
 
 
 class AutoRetryConnection(sqlite3.Connection):
+    # Number of statements retried on this connection
+    retries = 0
+    # QueryProfiler timing the statements, if enabled
+    profiler = None
+
     def cursor(self):
         return super(AutoRetryConnection, self).cursor(AutoRetryCursor)
 
 
+class ConnectionPool(object):
+    '''
+    Fixed-size pool of reader connections, a connection is checked out
+    for one statement and given back right after
+    '''
+
+    def __init__(self, create_connection, size=DEFAULT_READERS_POOL_SIZE):
+        self._create_connection = create_connection
+        self._size = size
+        self._connections = []
+        self._free = []
+        self._condition = Condition()
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time = 0
+
+    def checkout(self):
+        self._condition.acquire()
+        try:
+            if not self._free and len(self._connections) >= self._size:
+                self._waits += 1
+                start = time()
+                while not self._free:
+                    self._condition.wait()
+                self._wait_time += time() - start
+            if self._free:
+                con = self._free.pop()
+            else:
+                con = self._create_connection()
+                self._connections.append(con)
+            self._checkouts += 1
+            return con
+        finally:
+            self._condition.release()
+
+    def checkin(self, con):
+        self._condition.acquire()
+        try:
+            if con in self._connections:
+                self._free.append(con)
+                self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def get_connections(self):
+        self._condition.acquire()
+        try:
+            return list(self._connections)
+        finally:
+            self._condition.release()
+
+    def close(self):
+        self._condition.acquire()
+        try:
+            for con in self._connections:
+                con.close()
+            self._connections = []
+            self._free = []
+        finally:
+            self._condition.release()
+
+    def get_metrics(self):
+        metrics = dict()
+        metrics["size"] = self._size
+        metrics["connections"] = len(self._connections)
+        metrics["in_use"] = len(self._connections) - len(self._free)
+        metrics["checkouts"] = self._checkouts
+        metrics["waits"] = self._waits
+        metrics["wait_time"] = int(self._wait_time * 1000)
+        metrics["retries"] = sum([con.retries for con in self._connections])
+        return metrics
+
+
+class WriteTimeout(Exception):
+    pass
+
+
+class WriterStopped(Exception):
+    pass
+
+
+class WriteFuture(object):
+    '''
+    Result of a mutation submitted to the DAOWriter
+    '''
+
+    def __init__(self):
+        self._event = Event()
+        self._result = None
+        self._exception = None
+
+    def set_result(self, result, exception=None):
+        self._result = result
+        self._exception = exception
+        self._event.set()
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise WriteTimeout("Mutation not committed after %ss" % timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+class DAOWriter(Thread):
+    '''
+    Single thread applying the DAO mutations, the mutations queued while
+    a batch is applied are committed together
+    '''
+
+    def __init__(self, dao, max_batch=DEFAULT_GROUP_COMMIT_SIZE, interval=DEFAULT_GROUP_COMMIT_INTERVAL):
+        super(DAOWriter, self).__init__(name="DAOWriter")
+        self.daemon = True
+        self._dao = dao
+        self._max_batch = max_batch
+        self._interval = interval
+        self._queue = Queue()
+        self._callbacks = []
+        self._start_time = time()
+        self._commits = 0
+        self._operations = 0
+        self._last_batch = 0
+        self._max_batch_size = 0
+
+    def is_current(self):
+        return current_thread() is self
+
+    def submit(self, command, *args):
+        future = WriteFuture()
+        self._queue.put((command, args, future))
+        return future
+
+    def after_commit(self, callback, *args):
+        self._callbacks.append((callback, args))
+
+    def stop(self):
+        self._queue.put(None)
+        if not self.is_current():
+            self.join()
+
+    def _get_batch(self):
+        item = self._queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = time() + self._interval
+        while len(batch) < self._max_batch:
+            try:
+                item = self._queue.get_nowait()
+            except Empty:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(True, remaining)
+                except Empty:
+                    break
+            if item is None:
+                # Stop after this batch
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def run(self):
+        try:
+            while True:
+                batch = self._get_batch()
+                if batch is None:
+                    break
+                try:
+                    self._apply(batch)
+                except Exception as e:
+                    # Keep applying the next batches, the callers of this one get the error
+                    log.exception(e)
+                    self._callbacks = []
+                    for _, _, future in batch:
+                        if not future.done():
+                            future.set_result(None, e)
+        finally:
+            # The mutations queued after the stop are not applied
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except Empty:
+                    break
+                if item is not None:
+                    item[2].set_result(None, WriterStopped("DAO writer stopped"))
+
+    def _apply(self, batch):
+        # Wait for the end of a transaction opened on the write connection, it is committed by its thread
+        self._dao._tx_lock.acquire()
+        try:
+            self._dao.acquire_lock()
+            try:
+                results = self._apply_batch(batch)
+            finally:
+                self._dao.release_lock()
+        finally:
+            self._dao._tx_lock.release()
+        self._commits += 1
+        self._operations += len(batch)
+        self._last_batch = len(batch)
+        self._max_batch_size = max(self._max_batch_size, len(batch))
+        # Notify only once the changes are visible to the other connections
+        callbacks = self._callbacks
+        self._callbacks = []
+        for callback, args in callbacks:
+            try:
+                callback(*args)
+            except Exception as e:
+                log.exception(e)
+        for future, result, exception in results:
+            future.set_result(result, exception)
+
+    def _apply_batch(self, batch):
+        results = []
+        con = self._dao._get_write_connection()
+        # Explicit transaction: a failing mutation is rolled back to its savepoint, the others are committed
+        isolation_level = con.isolation_level
+        con.isolation_level = None
+        try:
+            c = con.cursor()
+            c.execute("BEGIN")
+            try:
+                for command, args, future in batch:
+                    callbacks = len(self._callbacks)
+                    c.execute("SAVEPOINT mutation")
+                    try:
+                        results.append((future, command(con.cursor(), *args), None))
+                    except Exception as e:
+                        log.trace("Mutation %r failed: %r", command, e)
+                        c.execute("ROLLBACK TO mutation")
+                        # Its notifications are for changes that are not committed
+                        del self._callbacks[callbacks:]
+                        results.append((future, None, e))
+                    c.execute("RELEASE mutation")
+                c.execute("COMMIT")
+            except Exception as e:
+                log.exception(e)
+                # Otherwise the next batch would commit it
+                try:
+                    c.execute("ROLLBACK")
+                except Exception as rollback_error:
+                    log.exception(rollback_error)
+                self._callbacks = []
+                results = [(future, None, e) for _, _, future in batch]
+        finally:
+            con.isolation_level = isolation_level
+        return results
+
+    def get_metrics(self):
+        metrics = dict()
+        elapsed = max(time() - self._start_time, 1)
+        metrics["queue"] = self._queue.qsize()
+        metrics["commits"] = self._commits
+        metrics["operations"] = self._operations
+        metrics["commits_per_sec"] = int(self._commits / elapsed)
+        metrics["last_batch"] = self._last_batch
+        metrics["max_batch"] = self._max_batch_size
+        metrics["avg_batch"] = self._operations / self._commits if self._commits else 0
+        return metrics
+
+
 class CustomRow(sqlite3.Row):
 
     def __init__(self, arg1, arg2):
@@ -92,8 +475,44 @@ class CustomRow(sqlite3.Row):
             del self._custom[name]
 
 
-class StateRow(CustomRow):
-    _custom = None
+class StateRow(object):
+    '''
+    Base of the rows returned by EngineDAO, a subclass with one slot per column
+    is generated for each set of columns by state_row_factory
+    '''
+    __slots__ = ()
+    # Columns of the generated class and the slot storing each of them
+    _fields = ()
+    _slots = ()
+    _index = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            try:
+                return getattr(self, self._index[key.lower()])
+            except KeyError:
+                raise IndexError("No item with that key")
+        return getattr(self, self._slots[key])
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __iter__(self):
+        for slot in self._slots:
+            yield getattr(self, slot)
+
+    def __eq__(self, other):
+        return (isinstance(other, StateRow) and self._fields == other._fields
+                and tuple(self) == tuple(other))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._fields) ^ hash(tuple(self))
+
+    def keys(self):
+        return list(self._fields)
 
     def is_readonly(self):
         if self.folderish:
@@ -117,6 +536,49 @@ class StateRow(CustomRow):
             self.pair_state)
 
 
+_IDENTIFIER = re.compile(r'^[A-Za-z][A-Za-z0-9_]*$')
+_row_classes = dict()
+_last_row_class = (None, None)
+
+
+def _create_row_class(fields, base=StateRow, extras=STATE_ROW_EXTRA_FIELDS):
+    slots = []
+    for i, name in enumerate(fields):
+        # Expressions and duplicated columns are only reachable by index or by name
+        if not _IDENTIFIER.match(name) or name in slots or name in extras:
+            name = '_column%d' % i
+        slots.append(name)
+    namespace = {'__slots__': tuple(slots) + extras, '_fields': fields, '_slots': tuple(slots),
+                 '_index': dict((field.lower(), slot) for field, slot in reversed(zip(fields, slots))),
+                 '_state_names': dict(enumerate(STATE_NAMES))}
+    # Assign all the columns at once by unpacking the sqlite tuple
+    source = "def __init__(self, cursor, row):\n    pass\n"
+    if slots:
+        source += "    (%s,) = row\n" % ", ".join("self." + slot for slot in slots)
+    # The state columns are given back by name, the values without code are kept
+    for slot in slots:
+        if slot in STATE_COLUMNS:
+            source += "    self.%s = _state_names.get(self.%s, self.%s)\n" % (slot, slot, slot)
+    for extra in extras:
+        source += "    self.%s = None\n" % extra
+    exec source in namespace
+    return type(base.__name__, (base,), namespace)
+
+
+def state_row_factory(cursor, row):
+    global _last_row_class
+    description, row_class = _last_row_class
+    if description is not cursor.description:
+        # Most of the rows come from the same query, avoid the lookup for them
+        description = cursor.description
+        fields = tuple(column[0] for column in description)
+        row_class = _row_classes.get(fields)
+        if row_class is None:
+            row_class = _row_classes.setdefault(fields, _create_row_class(fields))
+        _last_row_class = (description, row_class)
+    return row_class(cursor, row)
+
+
 class LogLock(object):
     def __init__(self):
         self._lock = RLock()
@@ -139,18 +601,297 @@ class FakeLock(object):
         pass
 
 
+class CacheLock(object):
+    '''
+    Reentrant lock telling the StateCache when a write is in progress
+    '''
+    def __init__(self, cache):
+        self._lock = RLock()
+        self._cache = cache
+        self._depth = 0
+
+    def acquire(self):
+        self._lock.acquire()
+        self._depth += 1
+        if self._depth == 1:
+            self._cache.begin_write()
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            self._cache.end_write()
+        self._lock.release()
+
+
+class StateCache(object):
+    '''
+    LRU cache of the States lookups by id, local_path and remote_ref
+
+    Only the row values are kept, each hit returns a new StateRow as the callers
+    update their rows. A row is invalidated by the temporary triggers of the
+    write connection, and a lookup done while a write was in progress is not
+    stored as it could have read the previous version.
+    '''
+
+    def __init__(self, size=DEFAULT_STATE_CACHE_SIZE):
+        self._size = size
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self._writing = 0
+        self._generation = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    def begin_write(self):
+        with self._lock:
+            self._writing += 1
+
+    def end_write(self):
+        with self._lock:
+            self._writing -= 1
+            self._generation += 1
+
+    def get_token(self):
+        with self._lock:
+            if self._writing:
+                return None
+            return self._generation
+
+    def _get_entry(self, key):
+        # Caller must hold the lock
+        value = self._entries.pop(key)
+        self._entries[key] = value
+        return value
+
+    def _get_row(self, row_id):
+        # Caller must hold the lock
+        if ('id', row_id) not in self._entries:
+            return None
+        row_class, values = self._get_entry(('id', row_id))
+        return row_class(None, values)
+
+    def get(self, key):
+        '''
+        Return (True, result) on a hit, (False, None) otherwise
+        '''
+        with self._lock:
+            if key not in self._entries:
+                self._misses += 1
+                return False, None
+            value = self._get_entry(key)
+            if key[0] == 'id':
+                result = value[0](None, value[1])
+            elif key[0] == 'local':
+                result = None if value is None else self._get_row(value)
+                if value is not None and result is None:
+                    self._misses += 1
+                    return False, None
+            else:
+                result = [self._get_row(row_id) for row_id in value]
+                if None in result:
+                    self._misses += 1
+                    return False, None
+            self._hits += 1
+            return True, result
+
+    def _put_row(self, row):
+        # Caller must hold the lock
+        self._entries[('id', row.id)] = (type(row), tuple(row))
+
+    def put(self, token, key, result):
+        if token is None:
+            return
+        with self._lock:
+            if self._writing or token != self._generation:
+                return
+            if key[0] == 'id':
+                if result is None:
+                    return
+                self._put_row(result)
+            elif key[0] == 'local':
+                if result is not None:
+                    self._put_row(result)
+                self._entries[key] = None if result is None else result.id
+            else:
+                for row in result:
+                    self._put_row(row)
+                self._entries[key] = tuple(row.id for row in result)
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def invalidate(self, row_id, local_path, remote_ref):
+        with self._lock:
+            self._invalidations += 1
+            self._entries.pop(('id', row_id), None)
+            self._entries.pop(('local', local_path), None)
+            self._entries.pop(('remote', remote_ref), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+    def get_metrics(self):
+        with self._lock:
+            return {"size": len(self._entries), "hits": self._hits, "misses": self._misses,
+                    "evictions": self._evictions, "invalidations": self._invalidations}
+
+
+class ProfiledLock(object):
+    '''
+    Lock wrapper reporting the time spent waiting for the DAO lock to the QueryProfiler
+    '''
+    def __init__(self, lock, profiler):
+        self._lock = lock
+        self._profiler = profiler
+
+    def acquire(self):
+        start = time()
+        self._lock.acquire()
+        self._profiler.record_lock_wait(time() - start)
+
+    def release(self):
+        self._lock.release()
+
+
+class QueryProfiler(object):
+    '''
+    Timing of the DAO public methods and statements
+
+    Each method keeps its calls, total time, rows returned, time spent waiting
+    for the DAO lock and a histogram of its durations. The statements slower
+    than the threshold are logged with their query plan.
+    '''
+
+    def __init__(self, db, threshold=DEFAULT_SLOW_QUERY_THRESHOLD):
+        self._db = db
+        self._threshold = threshold
+        self._lock = Lock()
+        self._methods = dict()
+        self._queries = 0
+        self._slow_queries = 0
+        self._lock_wait = 0
+        # Stack of the methods running in the thread, the lock waits are added to the innermost
+        self._current = local()
+
+    def _get_stack(self):
+        if not hasattr(self._current, 'stack'):
+            self._current.stack = []
+        return self._current.stack
+
+    def _get_method(self, name):
+        method = self._methods.get(name)
+        if method is None:
+            method = dict(calls=0, time=0, rows=0, lock_wait=0, histogram=OrderedDict(
+                [(bucket, 0) for _, bucket in PROFILE_HISTOGRAM_BOUNDS] + [(PROFILE_HISTOGRAM_OVERFLOW, 0)]))
+            self._methods[name] = method
+        return method
+
+    def wrap(self, name, function):
+        def profiled(*args, **kwargs):
+            stack = self._get_stack()
+            stack.append(name)
+            start = time()
+            try:
+                result = function(*args, **kwargs)
+            finally:
+                stack.pop()
+                self.record_call(name, time() - start)
+            if isinstance(result, list):
+                self.record_rows(name, len(result))
+            elif isinstance(result, (sqlite3.Row, StateRow)):
+                self.record_rows(name, 1)
+            return result
+        profiled.__name__ = function.__name__
+        profiled.__doc__ = function.__doc__
+        return profiled
+
+    def record_call(self, name, duration):
+        with self._lock:
+            method = self._get_method(name)
+            method["calls"] += 1
+            method["time"] += duration
+            bucket = PROFILE_HISTOGRAM_OVERFLOW
+            for bound, label in PROFILE_HISTOGRAM_BOUNDS:
+                if duration <= bound:
+                    bucket = label
+                    break
+            method["histogram"][bucket] += 1
+
+    def record_rows(self, name, rows):
+        with self._lock:
+            self._get_method(name)["rows"] += rows
+
+    def record_lock_wait(self, duration):
+        stack = self._get_stack()
+        with self._lock:
+            self._lock_wait += duration
+            if stack:
+                self._get_method(stack[-1])["lock_wait"] += duration
+
+    def _explain(self, query, params):
+        # A separate connection as pysqlite commits the pending transaction before an EXPLAIN
+        con = sqlite3.connect(self._db, timeout=0)
+        try:
+            return [row[-1] for row in con.execute("EXPLAIN QUERY PLAN " + query, params).fetchall()]
+        except sqlite3.Error:
+            return []
+        finally:
+            con.close()
+
+    def record_query(self, duration, query, params=()):
+        with self._lock:
+            self._queries += 1
+            if duration < self._threshold:
+                return
+            self._slow_queries += 1
+        stack = self._get_stack()
+        plan = self._explain(query, params)
+        log.warn("Slow query in %s (%dms): %s %r, plan: %r", stack[-1] if stack else None, duration * 1000,
+                 query, params, plan)
+
+    def get_profile(self):
+        with self._lock:
+            profile = dict()
+            for name, method in self._methods.iteritems():
+                profile[name] = dict(calls=method["calls"], time=int(method["time"] * 1000), rows=method["rows"],
+                                     lock_wait=int(method["lock_wait"] * 1000), histogram=dict(method["histogram"]))
+            return profile
+
+    def get_metrics(self):
+        with self._lock:
+            metrics = {"queries": self._queries, "slow_queries": self._slow_queries,
+                       "lock_wait": int(self._lock_wait * 1000)}
+        for name, method in self.get_profile().iteritems():
+            for key in ("calls", "time", "rows", "lock_wait"):
+                metrics[name + "_" + key] = method[key]
+            for bucket, count in method["histogram"].iteritems():
+                metrics[name + "_" + bucket] = count
+        return metrics
+
+
 class ConfigurationDAO(QObject):
     '''
     classdocs
     '''
 
-    def __init__(self, db):
+    # Default row factory of the read queries
+    _row_factory = CustomRow
+
+    def __init__(self, db, wal=False, readers=DEFAULT_READERS_POOL_SIZE):
         '''
         Constructor
         '''
         super(ConfigurationDAO, self).__init__()
-        log.debug("Create DAO on %s", db)
+        log.debug("Create DAO on %s (WAL: %r)", db, wal)
         self._db = db
+        self._wal = wal
+        self._readers = None
+        self._writer = None
+        self._profiler = None
         migrate = os.path.exists(self._db)
         # For testing purpose only should always be True
         self.share_connection = True
@@ -158,9 +899,11 @@ class ConfigurationDAO(QObject):
         self.schema_version = self.get_schema_version()
         self.in_tx = None
         self._tx_lock = RLock()
+        # Depth of the acquire_lock calls of the thread
+        self._lock_owner = local()
         # If we dont share connection no need to lock
         if self.share_connection:
-            self._lock = RLock()
+            self._lock = self._create_lock()
         else:
             self._lock = FakeLock()
         # Use to clean
@@ -180,7 +923,11 @@ class ConfigurationDAO(QObject):
         else:
             c.execute("INSERT INTO Configuration(name,value) VALUES(?,?)", (SCHEMA_VERSION, self.schema_version))
         self._conn.commit()
+        if migrate and c.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            self._enable_incremental_vacuum(c)
         self._conns = local()
+        # The reads share a pool instead of a connection per thread, kept until the thread ends
+        self._readers = ConnectionPool(self._create_read_conn, readers)
         # FOR PYTHON 3.3...
         #if log.getEffectiveLevel() < 6:
         #    self._conn.set_trace_callback(self._log_trace)
@@ -188,12 +935,44 @@ class ConfigurationDAO(QObject):
     def get_schema_version(self):
         return 1
 
+    def enable_profiling(self, threshold=DEFAULT_SLOW_QUERY_THRESHOLD):
+        '''
+        Time the public methods, the DAO lock waits and the statements of all the connections
+        '''
+        if self._profiler is not None:
+            return
+        log.debug("Enable the profiling of %s (slow query threshold: %ss)", self._db, threshold)
+        self._profiler = QueryProfiler(self._db, threshold)
+        for name, member in inspect.getmembers(type(self), inspect.ismethod):
+            if name.startswith('_') or name in ('enable_profiling', 'get_metrics', 'get_profile'):
+                continue
+            setattr(self, name, self._profiler.wrap(name, getattr(self, name)))
+        self._lock = ProfiledLock(self._lock, self._profiler)
+        connections = list(self._connections)
+        if self._readers is not None:
+            connections.extend(self._readers.get_connections())
+        for con in connections:
+            con.profiler = self._profiler
+
+    def get_profile(self):
+        '''
+        Return the profile of each public method called, None if the profiling is disabled
+        '''
+        if self._profiler is None:
+            return None
+        return self._profiler.get_profile()
+
     def acquire_lock(self):
         self._lock.acquire()
+        self._lock_owner.depth = getattr(self._lock_owner, 'depth', 0) + 1
 
     def release_lock(self):
+        self._lock_owner.depth -= 1
         self._lock.release()
 
+    def _holds_lock(self):
+        return getattr(self._lock_owner, 'depth', 0) > 0
+
     def get_db(self):
         return self._db
 
@@ -225,34 +1004,160 @@ class ConfigurationDAO(QObject):
             self.update_config(SCHEMA_VERSION, 1)
 
     def _init_db(self, cursor):
-        # http://www.stevemcarthur.co.uk/blog/post/some-kind-of-disk-io-error-occurred-sqlite
-        cursor.execute("PRAGMA journal_mode = MEMORY")
+        # Only effective on a new database, the older ones are converted when opened
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        if self._wal:
+            cursor.execute("PRAGMA journal_mode = WAL")
+        else:
+            # http://www.stevemcarthur.co.uk/blog/post/some-kind-of-disk-io-error-occurred-sqlite
+            cursor.execute("PRAGMA journal_mode = MEMORY")
         self._create_configuration_table(cursor)
 
+    def _init_connection(self, cursor):
+        # journal_mode is persistent, synchronous and busy_timeout are per connection
+        if self._wal:
+            cursor.execute("PRAGMA synchronous = NORMAL")
+        cursor.execute("PRAGMA busy_timeout = %d" % DEFAULT_BUSY_TIMEOUT)
+
+    def _enable_incremental_vacuum(self, cursor):
+        # The databases created without the incremental auto vacuum need a full VACUUM once,
+        # done when opened as it blocks all the writes
+        log.debug("Convert %s to incremental auto vacuum", self._db)
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        try:
+            cursor.execute("VACUUM")
+        except sqlite3.OperationalError as e:
+            log.warn("Cannot convert %s to incremental auto vacuum: %r", self._db, e)
+
     def _create_configuration_table(self, cursor):
         cursor.execute("CREATE TABLE if not exists Configuration(name VARCHAR NOT NULL, value VARCHAR, PRIMARY KEY (name))")
 
+    def _create_lock(self):
+        return RLock()
+
     def _create_main_conn(self):
         log.debug("Create main connexion on %s (dir exists: %d / file exists: %d)",
                     self._db, os.path.exists(os.path.dirname(self._db)), os.path.exists(self._db))
         self._conn = AutoRetryConnection(self._db, check_same_thread=False)
+        self._conn.profiler = self._profiler
+        self._init_connection(self._conn.cursor())
         self._connections.append(self._conn)
 
+    def _create_read_conn(self):
+        # Dont check same thread for closing purpose and to move it between threads
+        con = AutoRetryConnection(self._db, check_same_thread=False)
+        con.profiler = self._profiler
+        self._init_connection(con.cursor())
+        return con
+
     def _log_trace(self, query):
         log.trace(query)
 
+    def is_wal(self):
+        return self._wal
+
+    def get_metrics(self):
+        metrics = dict()
+        metrics["wal"] = self._wal
+        metrics["connections"] = len(self._connections)
+        metrics["retries"] = sum([con.retries for con in self._connections])
+        if self._readers is not None:
+            pool_metrics = self._readers.get_metrics()
+            metrics["connections"] += pool_metrics["connections"]
+            metrics["retries"] += pool_metrics["retries"]
+            metrics["pool_size"] = pool_metrics["size"]
+            metrics["pool_in_use"] = pool_metrics["in_use"]
+            metrics["pool_checkouts"] = pool_metrics["checkouts"]
+            metrics["pool_waits"] = pool_metrics["waits"]
+            metrics["pool_wait_time"] = pool_metrics["wait_time"]
+        if self._writer is not None:
+            for key, value in self._writer.get_metrics().iteritems():
+                metrics["writer_" + key] = value
+        if self._profiler is not None:
+            for key, value in self._profiler.get_metrics().iteritems():
+                metrics["profile_" + key] = value
+        return metrics
+
+    def snapshot(self, path):
+        '''
+        Copy a consistent state of the database to path, from a read transaction of a pooled reader
+        The writers go on in WAL mode, otherwise their commits wait until the copy is done
+        '''
+        if os.path.exists(path):
+            os.remove(path)
+        con = self._readers.checkout()
+        try:
+            if sqlite3.sqlite_version_info >= SNAPSHOT_MIN_SQLITE_VERSION:
+                con.execute("VACUUM INTO ?", (path,))
+            else:
+                self._copy_database(con, path)
+        finally:
+            self._readers.checkin(con)
+        log.debug("Snapshot of %s written to %s", self._db, path)
+
+    def _copy_database(self, con, path):
+        isolation_level = con.isolation_level
+        con.isolation_level = None
+        try:
+            c = con.cursor()
+            c.execute("BEGIN")
+            try:
+                # The first read takes the shared lock, or the WAL snapshot, kept for the whole copy
+                c.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+                if self._wal:
+                    # The committed transactions still in the -wal file are only seen through the connection
+                    target = sqlite3.connect(path, isolation_level=None)
+                    try:
+                        for statement in con.iterdump():
+                            target.execute(statement)
+                    finally:
+                        target.close()
+                else:
+                    shutil.copyfile(self._db, path)
+            finally:
+                c.execute("ROLLBACK")
+        finally:
+            con.isolation_level = isolation_level
+
+    def incremental_vacuum(self, pages=DEFAULT_VACUUM_PAGES):
+        '''
+        Release up to pages free pages of the database file, return the number of pages released
+        '''
+        self._lock.acquire()
+        try:
+            con = self._get_write_connection()
+            c = con.cursor()
+            if c.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                # The conversion failed when opened
+                return 0
+            free = c.execute("PRAGMA freelist_count").fetchone()[0]
+            if free == 0:
+                return 0
+            log.trace("Incremental vacuum of %s: %d free pages", self._db, free)
+            c.execute("PRAGMA incremental_vacuum(%d)" % pages).fetchall()
+            return free - c.execute("PRAGMA freelist_count").fetchone()[0]
+        finally:
+            self._lock.release()
+
     def dispose(self):
         log.debug("Disposing sqlite database %r", self.get_db())
+        if self._writer is not None:
+            # Apply the pending mutations before closing the connections
+            self._writer.stop()
+            self._writer = None
+        if self._readers is not None:
+            self._readers.close()
         for con in self._connections:
             con.close()
         self._connections = []
         self._conn = None
 
     def dispose_thread(self):
-        if not hasattr(self._conns, '_conn'):
+        if not hasattr(self._conns, '_conn') or self._conns._conn is None:
             return
         if self._conns._conn in self._connections:
             self._connections.remove(self._conns._conn)
+            self._conns._conn.close()
         self._conns._conn = None
 
     def _get_write_connection(self, factory=CustomRow):
@@ -275,8 +1180,7 @@ class ConfigurationDAO(QObject):
                 # Return the write connection
                 return self._conn
         if not hasattr(self._conns, '_conn') or self._conns._conn is None:
-            # Dont check same thread for closing purpose
-            self._conns._conn = AutoRetryConnection(self._db, check_same_thread=False)
+            self._conns._conn = self._create_read_conn()
             self._connections.append(self._conns._conn)
         self._conns._conn.row_factory = factory
             # Python3.3 feature
@@ -284,6 +1188,87 @@ class ConfigurationDAO(QObject):
             #    self._conns._conn.set_trace_callback(self._log_trace)
         return self._conns._conn
 
+    def _select(self, query, params=(), factory=None, fetch_one=False):
+        if factory is None:
+            factory = self._row_factory
+        # Transactions need the thread connection to see the uncommitted changes
+        if self._readers is None or self.in_tx is not None:
+            c = self._get_read_connection(factory).cursor()
+            return self._fetch(c, query, params, fetch_one)
+        con = self._readers.checkout()
+        try:
+            con.row_factory = factory
+            c = con.cursor()
+            result = self._fetch(c, query, params, fetch_one)
+            c.close()
+            return result
+        finally:
+            self._readers.checkin(con)
+
+    def _fetch(self, cursor, query, params, fetch_one):
+        profiler = cursor.connection.profiler
+        if profiler is None:
+            cursor.execute(query, params)
+            return cursor.fetchone() if fetch_one else cursor.fetchall()
+        # Most of the cost of the large results is in the fetch, timed with the execution
+        cursor.profiled = False
+        start = time()
+        cursor.execute(query, params)
+        result = cursor.fetchone() if fetch_one else cursor.fetchall()
+        profiler.record_query(time() - start, query, params)
+        return result
+
+    def _select_one(self, query, params=(), factory=None):
+        return self._select(query, params, factory, fetch_one=True)
+
+    def start_writer(self, max_batch=DEFAULT_GROUP_COMMIT_SIZE, interval=DEFAULT_GROUP_COMMIT_INTERVAL):
+        if self._writer is not None:
+            return
+        self._writer = DAOWriter(self, max_batch=max_batch, interval=interval)
+        self._writer.start()
+
+    def _use_writer(self):
+        # The writer thread waits for the lock: a thread holding it writes inline, as when the writer is gone
+        return (self._writer is not None and self.auto_commit and not self._writer.is_current()
+                and not self._holds_lock() and self._writer.is_alive())
+
+    def _write_async(self, command, *args):
+        '''
+        Apply command(cursor, *args) and return a WriteFuture resolved once it is committed
+        '''
+        if not self._use_writer():
+            future = WriteFuture()
+            try:
+                future.set_result(self._write(command, *args))
+            except Exception as e:
+                future.set_result(None, e)
+            return future
+        return self._writer.submit(command, *args)
+
+    def _write(self, command, *args):
+        '''
+        Apply command(cursor, *args) and return its result once it is committed
+        '''
+        if self._use_writer():
+            return self._writer.submit(command, *args).result(DEFAULT_WRITE_TIMEOUT)
+        self._lock.acquire()
+        try:
+            con = self._get_write_connection()
+            result = command(con.cursor(), *args)
+            # The writer thread commits its whole batch at once
+            if self.auto_commit and (self._writer is None or not self._writer.is_current()):
+                con.commit()
+        finally:
+            self._lock.release()
+        return result
+
+    def _on_commit(self, callback, *args):
+        # Delay notifications until the writer thread has committed the change
+        if self._writer is not None and self._writer.is_current():
+            self._writer.after_commit(callback, *args)
+        else:
+            callback(*args)
+
     def begin_transaction(self):
         self.auto_commit = False
         self._tx_lock.acquire()
@@ -310,34 +1295,20 @@ class ConfigurationDAO(QObject):
         cursor.execute("DELETE FROM Configuration WHERE name=?", (name,))
 
     def delete_config(self, name):
-        self._lock.acquire()
-        try:
-            con = self._get_write_connection()
-            c = con.cursor()
-            self._delete_config(c, name)
-            if self.auto_commit:
-                con.commit()
-        finally:
-            self._lock.release()
+        self._write(self._delete_config, name)
+
+    def _update_config(self, cursor, name, value):
+        if value is not None:
+            cursor.execute("UPDATE OR IGNORE Configuration SET value=? WHERE name=?", (value,name))
+            cursor.execute("INSERT OR IGNORE INTO Configuration(value,name) VALUES(?,?)", (value,name))
+        else:
+            cursor.execute("DELETE FROM Configuration WHERE name=?", (name,))
 
     def update_config(self, name, value):
-        self._lock.acquire()
-        try:
-            con = self._get_write_connection()
-            c = con.cursor()
-            if value is not None:
-                c.execute("UPDATE OR IGNORE Configuration SET value=? WHERE name=?", (value,name))
-                c.execute("INSERT OR IGNORE INTO Configuration(value,name) VALUES(?,?)", (value,name))
-            else:
-                c.execute("DELETE FROM Configuration WHERE name=?", (name,))
-            if self.auto_commit:
-                con.commit()
-        finally:
-            self._lock.release()
+        self._write(self._update_config, name, value)
 
     def get_config(self, name, default=None):
-        c = self._get_read_connection().cursor()
-        obj = c.execute("SELECT value FROM Configuration WHERE name=?",(name,)).fetchone()
+        obj = self._select_one("SELECT value FROM Configuration WHERE name=?", (name,))
         if obj is None:
             return default
         return obj.value
@@ -378,9 +1349,7 @@ class ManagerDAO(ConfigurationDAO):
             self._lock.release()
 
     def get_locked_paths(self):
-        con = self._get_read_connection()
-        c = con.cursor()
-        return c.execute("SELECT * FROM AutoLock").fetchall()
+        return self._select("SELECT * FROM AutoLock")
 
     def lock_path(self, path, process, doc_id):
         self._lock.acquire()
@@ -412,11 +1381,10 @@ class ManagerDAO(ConfigurationDAO):
 
     def get_notifications(self, discarded=True):
         from nxdrive.notification import Notification
-        c = self._get_read_connection().cursor()
         if discarded:
-            return c.execute("SELECT * FROM Notifications").fetchall()
+            return self._select("SELECT * FROM Notifications")
         else:
-            return c.execute("SELECT * FROM Notifications WHERE (flags & " + str(Notification.FLAG_DISCARD) + ") = 0").fetchall()
+            return self._select("SELECT * FROM Notifications WHERE (flags & " + str(Notification.FLAG_DISCARD) + ") = 0")
 
     def discard_notification(self, uid):
         from nxdrive.notification import Notification
@@ -450,8 +1418,7 @@ class ManagerDAO(ConfigurationDAO):
             self.update_config(SCHEMA_VERSION, 3)
 
     def get_engines(self):
-        c = self._get_read_connection(factory=StateRow).cursor()
-        return c.execute("SELECT * FROM Engines").fetchall()
+        return self._select("SELECT * FROM Engines")
 
     def update_engine_path(self, engine, path):
         self._lock.acquire()
@@ -495,20 +1462,84 @@ class EngineDAO(ConfigurationDAO):
     classdocs
     '''
     newConflict = pyqtSignal(object)
-    def __init__(self, db):
+    _row_factory = staticmethod(state_row_factory)
+
+    def __init__(self, db, wal=False, readers=DEFAULT_READERS_POOL_SIZE, cache_size=DEFAULT_STATE_CACHE_SIZE):
         '''
         Constructor
         '''
         self._filters = None
         self._queue_manager = None
-        super(EngineDAO, self).__init__(db)
+        self._cache = StateCache(cache_size) if cache_size > 0 else None
+        super(EngineDAO, self).__init__(db, wal=wal, readers=readers)
         self._filters = self.get_filters()
-        self._items_count = None
-        self._items_count = self.get_syncing_count()
         self.reinit_processors()
 
     def get_schema_version(self):
-        return 3
+        return 10
+
+    def get_metrics(self):
+        metrics = super(EngineDAO, self).get_metrics()
+        if self._cache is not None:
+            for key, value in self._cache.get_metrics().iteritems():
+                metrics["cache_" + key] = value
+        return metrics
+
+    def _create_lock(self):
+        if self._cache is None:
+            return super(EngineDAO, self)._create_lock()
+        return CacheLock(self._cache)
+
+    def _create_main_conn(self):
+        super(EngineDAO, self)._create_main_conn()
+        if self._cache is not None:
+            # The writes done before this connection were not seen
+            self._init_cache_connection(self._conn)
+            self._cache.clear()
+
+    def _create_read_conn(self):
+        con = super(EngineDAO, self)._create_read_conn()
+        self._init_cache_connection(con)
+        return con
+
+    def _init_cache_connection(self, con):
+        # invalidate_state and the temporary triggers only live as long as their connection
+        if self._cache is None:
+            return
+        con.create_function("invalidate_state", 3, self._cache.invalidate)
+        c = con.cursor()
+        # A new database creates them with its tables
+        if c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='States'").fetchone() is not None:
+            self._create_state_cache(c)
+
+    def _create_state_cache(self, cursor):
+        if self._cache is None:
+            return
+        # Temporary triggers, created on each connection where invalidate_state is defined
+        cursor.execute("CREATE TEMP TRIGGER if not exists States_cache_insert AFTER INSERT ON main.States BEGIN " +
+                       "SELECT invalidate_state(NEW.id, NEW.local_path, NEW.remote_ref); END")
+        cursor.execute("CREATE TEMP TRIGGER if not exists States_cache_update AFTER UPDATE ON main.States BEGIN " +
+                       "SELECT invalidate_state(OLD.id, OLD.local_path, OLD.remote_ref); " +
+                       "SELECT invalidate_state(NEW.id, NEW.local_path, NEW.remote_ref); END")
+        cursor.execute("CREATE TEMP TRIGGER if not exists States_cache_delete AFTER DELETE ON main.States BEGIN " +
+                       "SELECT invalidate_state(OLD.id, OLD.local_path, OLD.remote_ref); END")
+
+    def _select_state(self, key, query, params):
+        # Uncommitted rows of a transaction must not be shared
+        if self._cache is None or self.in_tx is not None:
+            if key[0] == 'remote':
+                return self._select(query, params)
+            return self._select_one(query, params)
+        found, result = self._cache.get(key)
+        if found:
+            return result
+        token = self._cache.get_token()
+        if key[0] == 'remote':
+            result = self._select(query, params)
+        else:
+            result = self._select_one(query, params)
+        self._cache.put(token, key, result)
+        return result
 
     def _migrate_state(self, cursor):
         try:
@@ -517,12 +1548,20 @@ class EngineDAO(ConfigurationDAO):
             # If we cannot smoothly migrate harder migration
             cursor.execute("DROP TABLE if exists StatesMigration")
             self._reinit_states(cursor)
+        self._encode_states(cursor)
+        # Indexes and triggers followed the renamed table and were dropped with it
+        self._create_state_indexes(cursor)
+        self._create_state_counters(cursor, rebuild=True)
+        self._create_work_queue(cursor, rebuild=True)
+        self._create_state_cache(cursor)
 
     def _migrate_db(self, cursor, version):
         if (version < 1):
             self._migrate_state(cursor)
-            cursor.execute(u"UPDATE States SET last_transfer = 'upload' WHERE last_local_updated < last_remote_updated AND folderish=0;")
-            cursor.execute(u"UPDATE States SET last_transfer = 'download' WHERE last_local_updated > last_remote_updated AND folderish=0;")
+            cursor.execute(u"UPDATE States SET last_transfer = ? WHERE last_local_updated < last_remote_updated AND folderish=0;",
+                           (STATE_CODES['upload'],))
+            cursor.execute(u"UPDATE States SET last_transfer = ? WHERE last_local_updated > last_remote_updated AND folderish=0;",
+                           (STATE_CODES['download'],))
             self.update_config(SCHEMA_VERSION, 1)
         if (version < 2):
             cursor.execute("CREATE TABLE if not exists ToRemoteScan(path STRING NOT NULL, PRIMARY KEY(path))")
@@ -530,6 +1569,28 @@ class EngineDAO(ConfigurationDAO):
         if (version < 3):
             self._migrate_state(cursor)
             self.update_config(SCHEMA_VERSION, 3)
+        if (version < 4):
+            self._create_state_indexes(cursor)
+            self.update_config(SCHEMA_VERSION, 4)
+        if (version < 5):
+            self._create_state_counters(cursor, rebuild=True)
+            self.update_config(SCHEMA_VERSION, 5)
+        if (version < 6):
+            # The parent_id tree of this version is dropped by the version 10
+            self.update_config(SCHEMA_VERSION, 6)
+        if (version < 7):
+            self._create_work_queue(cursor, rebuild=True)
+            self.update_config(SCHEMA_VERSION, 7)
+        if (version < 8):
+            # The state columns become INTEGER
+            self._migrate_state(cursor)
+            self.update_config(SCHEMA_VERSION, 8)
+        if (version < 9):
+            self._create_state_indexes(cursor)
+            self.update_config(SCHEMA_VERSION, 9)
+        if (version < 10):
+            self._drop_state_tree(cursor)
+            self.update_config(SCHEMA_VERSION, 10)
 
     def _reinit_database(self):
         self.reinit_states()
@@ -549,22 +1610,136 @@ class EngineDAO(ConfigurationDAO):
         cursor.execute("CREATE TABLE "+statement+"States(id INTEGER NOT NULL, last_local_updated TIMESTAMP,"
           + "last_remote_updated TIMESTAMP, local_digest VARCHAR, remote_digest VARCHAR, local_path VARCHAR,"
           + "remote_ref VARCHAR, local_parent_path VARCHAR, remote_parent_ref VARCHAR, remote_parent_path VARCHAR,"
-          + "local_name VARCHAR, remote_name VARCHAR, size INTEGER DEFAULT (0), folderish INTEGER, local_state VARCHAR DEFAULT('unknown'), remote_state VARCHAR DEFAULT('unknown'),"
-          + "pair_state VARCHAR DEFAULT('unknown'), remote_can_rename INTEGER, remote_can_delete INTEGER, remote_can_update INTEGER,"
+          + "local_name VARCHAR, remote_name VARCHAR, size INTEGER DEFAULT (0), folderish INTEGER, local_state INTEGER DEFAULT(0), remote_state INTEGER DEFAULT(0),"
+          + "pair_state INTEGER DEFAULT(0), remote_can_rename INTEGER, remote_can_delete INTEGER, remote_can_update INTEGER,"
           + "remote_can_create_child INTEGER, last_remote_modifier VARCHAR,"
-          + "last_sync_date TIMESTAMP, error_count INTEGER DEFAULT (0), last_sync_error_date TIMESTAMP, last_error VARCHAR, last_error_details TEXT, version INTEGER DEFAULT (0), processor INTEGER DEFAULT (0), last_transfer VARCHAR, PRIMARY KEY (id),"
+          + "last_sync_date TIMESTAMP, error_count INTEGER DEFAULT (0), last_sync_error_date TIMESTAMP, last_error VARCHAR, last_error_details TEXT, version INTEGER DEFAULT (0), processor INTEGER DEFAULT (0), last_transfer INTEGER, PRIMARY KEY (id),"
           +  "UNIQUE(remote_ref, remote_parent_ref), UNIQUE(remote_ref, local_path));")
+        self._create_state_indexes(cursor)
+        self._create_state_counters(cursor, rebuild=force)
+        self._create_work_queue(cursor, rebuild=force)
+        self._create_state_cache(cursor)
+
+    def _create_state_codes(self, cursor):
+        # Lookup table of the state codes, for the migrations and the humans
+        cursor.execute("CREATE TABLE if not exists StateCodes(code INTEGER NOT NULL, name VARCHAR, PRIMARY KEY(code))")
+        cursor.executemany("INSERT OR REPLACE INTO StateCodes(code, name) VALUES(?, ?)", enumerate(STATE_NAMES))
+
+    def _encode_states(self, cursor):
+        # Replace the state names stored before the schema version 8 by their code
+        for column in STATE_COLUMNS:
+            cursor.execute("UPDATE States SET {0}=(SELECT code FROM StateCodes WHERE name=States.{0})"
+                           " WHERE {0} IN (SELECT name FROM StateCodes)".format(column))
+
+    def _create_state_indexes(self, cursor):
+        # remote_ref lookups are already covered by the UNIQUE(remote_ref, ...) constraints
+        for name, columns in STATE_INDEXES:
+            cursor.execute("CREATE INDEX if not exists " + name + " ON States(" + columns + ")")
+
+    def _drop_state_tree(self, cursor):
+        # The parent_id column is left to the next table migration, nothing reads nor maintains it
+        cursor.execute("DROP TRIGGER if exists States_tree_insert")
+        cursor.execute("DROP TRIGGER if exists States_tree_delete")
+        cursor.execute("DROP INDEX if exists States_parent_id")
+
+    def _get_work_queue_insert(self, row):
+        # Keep the enqueue time of a pair already waiting
+        return ("INSERT OR REPLACE INTO WorkQueue(row_id, kind, priority, enqueue_time) SELECT " + row + ".id, kind, " +
+                WORK_QUEUE_PRIORITY.format(row) + ", IFNULL((SELECT enqueue_time FROM WorkQueue WHERE row_id=" + row +
+                ".id), strftime('%s', 'now')) FROM (SELECT " + WORK_QUEUE_KIND.format(row) + " AS kind) WHERE kind IS NOT NULL")
+
+    def _create_work_queue(self, cursor, rebuild=False):
+        # Processable pairs, maintained by the triggers on States and paged by the QueueManager
+        cursor.execute("CREATE TABLE if not exists WorkQueue(row_id INTEGER NOT NULL, kind VARCHAR NOT NULL," +
+                       " priority INTEGER DEFAULT (0), enqueue_time INTEGER, PRIMARY KEY(row_id))")
+        cursor.execute("CREATE INDEX if not exists WorkQueue_kind ON WorkQueue(kind, priority, row_id)")
+        cursor.execute("CREATE TRIGGER if not exists States_queue_insert AFTER INSERT ON States BEGIN " +
+                       self._get_work_queue_insert("NEW") + "; END")
+        cursor.execute("CREATE TRIGGER if not exists States_queue_delete AFTER DELETE ON States BEGIN " +
+                       "DELETE FROM WorkQueue WHERE row_id=OLD.id; END")
+        cursor.execute("CREATE TRIGGER if not exists States_queue_update AFTER UPDATE OF " +
+                       "pair_state, folderish, local_path ON States BEGIN " +
+                       "DELETE FROM WorkQueue WHERE row_id=NEW.id AND " + WORK_QUEUE_KIND.format("NEW") + " IS NULL; " +
+                       self._get_work_queue_insert("NEW") + "; END")
+        if rebuild:
+            cursor.execute("DELETE FROM WorkQueue")
+            cursor.execute("INSERT INTO WorkQueue(row_id, kind, priority, enqueue_time) SELECT id, kind, priority," +
+                           " strftime('%s', 'now') FROM (SELECT id, " + WORK_QUEUE_KIND.format("States") + " AS kind, " +
+                           WORK_QUEUE_PRIORITY.format("States") + " AS priority FROM States) WHERE kind IS NOT NULL")
+
+    def _get_state_counters_delta(self, *changes):
+        # changes are the (row, sign) applied to each counter
+        return ", ".join(name + "=" + name + "".join(" %s (CASE WHEN %s THEN %s ELSE 0 END)" % (
+                                                        sign, condition.format(row), value.format(row))
+                                                    for row, sign in changes)
+                         for name, condition, value in STATE_COUNTERS)
+
+    def _create_state_counters(self, cursor, rebuild=False):
+        # Single row table kept up to date by the triggers on States
+        cursor.execute("CREATE TABLE if not exists StateCounters(" +
+                       ", ".join(name + " INTEGER DEFAULT (0)" for name, _, _ in STATE_COUNTERS) + ")")
+        cursor.execute("CREATE TRIGGER if not exists States_counters_insert AFTER INSERT ON States BEGIN " +
+                       "UPDATE StateCounters SET " + self._get_state_counters_delta(("NEW", "+")) + "; END")
+        cursor.execute("CREATE TRIGGER if not exists States_counters_delete AFTER DELETE ON States BEGIN " +
+                       "UPDATE StateCounters SET " + self._get_state_counters_delta(("OLD", "-")) + "; END")
+        # Only the columns used by the counters fire this one
+        cursor.execute("CREATE TRIGGER if not exists States_counters_update AFTER UPDATE OF " +
+                       "pair_state, folderish, size, error_count ON States BEGIN " +
+                       "UPDATE StateCounters SET " + self._get_state_counters_delta(("NEW", "+"), ("OLD", "-")) +
+                       "; END")
+        if rebuild or cursor.execute("SELECT COUNT(*) FROM StateCounters").fetchone()[0] != 1:
+            self._rebuild_state_counters(cursor)
+
+    def _compute_state_counters(self, cursor):
+        query = ("SELECT " + ", ".join("IFNULL(SUM(CASE WHEN %s THEN %s ELSE 0 END), 0)" % (condition.format("States"),
+                                                                                        value.format("States"))
+                                        for _, condition, value in STATE_COUNTERS) + " FROM States")
+        row = cursor.execute(query).fetchone()
+        return dict((counter[0], row[i]) for i, counter in enumerate(STATE_COUNTERS))
+
+    def _rebuild_state_counters(self, cursor):
+        counters = self._compute_state_counters(cursor)
+        cursor.execute("DELETE FROM StateCounters")
+        cursor.execute("INSERT INTO StateCounters(" + ", ".join(name for name, _, _ in STATE_COUNTERS) + ") VALUES(" +
+                       ", ".join("?" * len(STATE_COUNTERS)) + ")",
+                       [counters[name] for name, _, _ in STATE_COUNTERS])
+        return counters
+
+    def _check_state_counters(self, cursor, rebuild):
+        counters = cursor.execute("SELECT * FROM StateCounters").fetchone()
+        expected = self._compute_state_counters(cursor)
+        invalids = [name for name, _, _ in STATE_COUNTERS if counters is None or counters[name] != expected[name]]
+        if not invalids:
+            return True
+        log.warn("State counters %r are incorrect, expected %r", invalids, expected)
+        if rebuild:
+            self._rebuild_state_counters(cursor)
+        return False
+
+    def check_state_counters(self, rebuild=True):
+        '''
+        Compare the StateCounters with a full scan of States, rebuild them if needed
+        Return True if they were consistent, only run on demand as the triggers keep them exact
+        '''
+        return self._write(self._check_state_counters, rebuild)
 
     def _init_db(self, cursor):
         super(EngineDAO, self)._init_db(cursor)
         cursor.execute("CREATE TABLE if not exists Filters(path STRING NOT NULL, PRIMARY KEY(path))")
         cursor.execute("CREATE TABLE if not exists RemoteScan(path STRING NOT NULL, PRIMARY KEY(path))")
         cursor.execute("CREATE TABLE if not exists ToRemoteScan(path STRING NOT NULL, PRIMARY KEY(path))")
+        # Remote refs returned by the scroll scan in progress
+        cursor.execute("CREATE TABLE if not exists RemoteScrolled(remote_ref VARCHAR NOT NULL, PRIMARY KEY(remote_ref))")
+        self._create_state_codes(cursor)
         self._create_state_table(cursor)
 
-    def _get_read_connection(self, factory=StateRow):
+    def _get_read_connection(self, factory=state_row_factory):
         return super(EngineDAO, self)._get_read_connection(factory)
 
+    def _get_write_connection(self, factory=state_row_factory):
+        # The commands compare the states of the rows they read by name
+        return super(EngineDAO, self)._get_write_connection(factory)
+
     def acquire_state(self, thread_id, row_id):
         if self.acquire_processor(thread_id, row_id):
             # Avoid any lock for this call by using the write connection
@@ -578,35 +1753,25 @@ class EngineDAO(ConfigurationDAO):
     def release_state(self, thread_id):
         self.release_processor(thread_id)
 
+    def _release_processor(self, cursor, processor_id):
+        # TO_REVIEW Might go back to primary key id
+        cursor.execute("UPDATE States SET processor=0 WHERE processor=?", (processor_id,))
+        return cursor.rowcount
+
     def release_processor(self, processor_id):
-        self._lock.acquire()
-        try:
-            con = self._get_write_connection()
-            c = con.cursor()
-            # TO_REVIEW Might go back to primary key id
-            c.execute("UPDATE States SET processor=0 WHERE processor=?", (processor_id,))
-            if self.auto_commit:
-                con.commit()
-        finally:
-            self._lock.release()
-        res = c.rowcount > 0
+        res = self._write(self._release_processor, processor_id) > 0
         if res:
             log.trace('Released processor %d', processor_id)
         else:
             log.trace('No processor to release with id %d', processor_id)
         return res
 
+    def _acquire_processor(self, cursor, thread_id, row_id):
+        cursor.execute("UPDATE States SET processor=? WHERE id=? AND (processor=0 OR processor=?)", (thread_id, row_id, thread_id))
+        return cursor.rowcount
+
     def acquire_processor(self, thread_id, row_id):
-        self._lock.acquire()
-        try:
-            con = self._get_write_connection()
-            c = con.cursor()
-            c.execute("UPDATE States SET processor=? WHERE id=? AND (processor=0 OR processor=?)", (thread_id, row_id, thread_id))
-            if self.auto_commit:
-                con.commit()
-        finally:
-            self._lock.release()
-        res = c.rowcount == 1
+        res = self._write(self._acquire_processor, thread_id, row_id) == 1
         if res:
             log.trace('Acquired processor %d for row %d', thread_id, row_id)
         else:
@@ -630,9 +1795,6 @@ class EngineDAO(ConfigurationDAO):
             c = con.cursor()
             self._reinit_states(c)
             con.commit()
-            log.trace("Vacuum sqlite")
-            con.execute("VACUUM")
-            log.trace("Vacuum sqlite finished")
         finally:
             self._lock.release()
 
@@ -642,123 +1804,123 @@ class EngineDAO(ConfigurationDAO):
             con = self._get_write_connection()
             c = con.cursor()
             c.execute("UPDATE States SET processor=0")
-            c.execute("UPDATE States SET error_count=0, last_sync_error_date=NULL, last_error = NULL WHERE pair_state='synchronized'")
+            c.execute("UPDATE States SET error_count=0, last_sync_error_date=NULL, last_error = NULL WHERE pair_state=?",
+                      (STATE_CODES['synchronized'],))
             if self.auto_commit:
                 con.commit()
-            log.trace("Vacuum sqlite")
-            con.execute("VACUUM")
-            log.trace("Vacuum sqlite finished")
         finally:
             self._lock.release()
 
+    def _delete_remote_state(self, cursor, doc_pair):
+        update = "UPDATE States SET remote_state=" + _state_codes_sql('deleted') + ", pair_state=?"
+        cursor.execute(update + " WHERE id=?", (STATE_CODES['remotely_deleted'], doc_pair.id))
+        if doc_pair.folderish:
+            cursor.execute(update + self._get_recursive_condition(doc_pair), (STATE_CODES['parent_remotely_deleted'],))
+        # Only queue parent
+        self._queue_pair_state(doc_pair.id, doc_pair.folderish, 'remotely_deleted', pair=doc_pair)
+
     def delete_remote_state(self, doc_pair):
-        self._lock.acquire()
-        try:
-            con = self._get_write_connection()
-            c = con.cursor()
-            update = "UPDATE States SET remote_state='deleted', pair_state=?"
-            c.execute(update + " WHERE id=?", ('remotely_deleted',doc_pair.id))
-            if doc_pair.folderish:
-                c.execute(update + self._get_recursive_condition(doc_pair), ('parent_remotely_deleted',))
-            # Only queue parent
-            self._queue_pair_state(doc_pair.id, doc_pair.folderish, 'remotely_deleted')
-            if self.auto_commit:
-                con.commit()
-        finally:
-            self._lock.release()
+        self._write(self._delete_remote_state, doc_pair)
+
+    def _delete_local_state(self, cursor, doc_pair):
+        # Check parent to see current pair state
+        parent = cursor.execute("SELECT * FROM States WHERE local_path=?", (doc_pair.local_parent_path,)).fetchone()
+        if parent is not None and (parent.pair_state == 'locally_deleted' or parent.pair_state == 'parent_locally_deleted'):
+            current_state = 'parent_locally_deleted'
+        else:
+            current_state = 'locally_deleted'
+        update = "UPDATE States SET local_state=" + _state_codes_sql('deleted') + ", pair_state=?"
+        cursor.execute(update + " WHERE id=?", (STATE_CODES[current_state], doc_pair.id))
+        if doc_pair.folderish:
+            cursor.execute(update + self._get_recursive_condition(doc_pair), (STATE_CODES['parent_locally_deleted'],))
+        return current_state
 
     def delete_local_state(self, doc_pair):
         current_state = None
-        self._lock.acquire()
         try:
-            con = self._get_write_connection()
-            c = con.cursor()
-            # Check parent to see current pair state
-            parent = c.execute("SELECT * FROM States WHERE local_path=?", (doc_pair.local_parent_path,)).fetchone()
-            if parent is not None and (parent.pair_state == 'locally_deleted' or parent.pair_state == 'parent_locally_deleted'):
-                current_state = 'parent_locally_deleted'
-            else:
-                current_state = 'locally_deleted'
-            update = "UPDATE States SET local_state='deleted', pair_state=?"
-            c.execute(update + " WHERE id=?", (current_state, doc_pair.id))
-            if doc_pair.folderish:
-                c.execute(update + self._get_recursive_condition(doc_pair), ('parent_locally_deleted',))
-            if self.auto_commit:
-                con.commit()
+            current_state = self._write(self._delete_local_state, doc_pair)
         finally:
-            self._lock.release()
             self._queue_manager.interrupt_processors_on(doc_pair.local_path, exact_match=False)
             # Only queue parent
             if current_state is not None and current_state == "locally_deleted":
-                self._queue_pair_state(doc_pair.id, doc_pair.folderish, current_state)
+                self._queue_pair_state(doc_pair.id, doc_pair.folderish, current_state, pair=doc_pair)
 
-    def insert_local_state(self, info, parent_path):
+    def _insert_local_state(self, cursor, info, parent_path, digest):
         pair_state = PAIR_STATES.get(('created', 'unknown'))
+        name = os.path.basename(info.path)
+        cursor.execute("INSERT INTO States(last_local_updated, local_digest, "
+                  + "local_path, local_parent_path, local_name, folderish, size, local_state, remote_state, pair_state)"
+                  + " VALUES(?,?,?,?,?,?,?,?,?,?)", (info.last_modification_time, digest, info.path,
+                                                parent_path, name, info.folderish, info.size, STATE_CODES['created'],
+                                                STATE_CODES['unknown'], state_code(pair_state)))
+        row_id = cursor.lastrowid
+        parent = cursor.execute("SELECT * FROM States WHERE local_path=?", (parent_path,)).fetchone()
+        # Dont queue if parent is not yet created
+        if (parent is None and parent_path == '') or (parent is not None and parent.pair_state != "locally_created"):
+            self._queue_pair_state(row_id, info.folderish, pair_state, size=info.size, local_path=info.path,
+                                   local_parent_path=parent_path)
+        return row_id
+
+    def insert_local_state(self, info, parent_path):
+        # Compute the digest outside of the write
         digest = info.get_digest()
-        self._lock.acquire()
-        try:
-            con = self._get_write_connection()
-            c = con.cursor()
-            name = os.path.basename(info.path)
-            c.execute("INSERT INTO States(last_local_updated, local_digest, "
-                      + "local_path, local_parent_path, local_name, folderish, size, local_state, remote_state, pair_state)"
-                      + " VALUES(?,?,?,?,?,?,?,'created','unknown',?)", (info.last_modification_time, digest, info.path,
-                                                    parent_path, name, info.folderish, info.size, pair_state))
-            row_id = c.lastrowid
-            parent = c.execute("SELECT * FROM States WHERE local_path=?", (parent_path,)).fetchone()
-            # Dont queue if parent is not yet created
-            if (parent is None and parent_path == '') or (parent is not None and parent.pair_state != "locally_created"):
-                self._queue_pair_state(row_id, info.folderish, pair_state)
-            if self.auto_commit:
-                con.commit()
-            self._items_count = self._items_count + 1
-        finally:
-            self._lock.release()
-        return row_id
+        return self._write(self._insert_local_state, info, parent_path, digest)
 
     def get_last_files(self, number, direction=""):
-        c = self._get_read_connection(factory=StateRow).cursor()
         condition = ""
         if direction == "remote":
-            condition = " AND last_transfer = 'upload'"
+            condition = " AND last_transfer = " + _state_codes_sql('upload')
         elif direction == "local":
-            condition = " AND last_transfer = 'download'"
-        return c.execute("SELECT * FROM States WHERE pair_state='synchronized' AND folderish=0" + condition + " ORDER BY last_sync_date DESC LIMIT " + str(number)).fetchall()
+            condition = " AND last_transfer = " + _state_codes_sql('download')
+        # Walk the last synchronized ones backwards instead of sorting all the synchronized pairs
+        return self._select("SELECT * FROM States WHERE +pair_state=" + _state_codes_sql('synchronized') + " AND folderish=0" + condition + " ORDER BY last_sync_date DESC LIMIT " + str(number))
 
     def _get_to_sync_condition(self):
-        return "pair_state != 'synchronized' AND pair_state != 'unsynchronized'"
+        return "pair_state NOT IN (" + _state_codes_sql('synchronized', 'unsynchronized') + ")"
 
     def register_queue_manager(self, manager):
-        # Prevent any update while init queue
-        self._lock.acquire()
-        con = None
-        try:
-            self._queue_manager = manager
-            con = self._get_write_connection(factory=StateRow)
-            c = con.cursor()
-            # Order by path to be sure to process parents before childs
-            pairs = c.execute("SELECT * FROM States WHERE " + self._get_to_sync_condition() + " ORDER BY local_path ASC").fetchall()
-            folders = dict()
-            for pair in pairs:
-                # Add all the folders
-                if pair.folderish:
-                    folders[pair.local_path] = True
-                if not pair.local_parent_path in folders:
-                    self._queue_manager.push_ref(pair.id, pair.folderish, pair.pair_state)
-        # Dont block everything if queue manager fail
-        # TODO As the error should be fatal not sure we need this
-        finally:
-            self._lock.release()
+        # The pending pairs are paged from the WorkQueue by the manager
+        self._queue_manager = manager
 
-    def _queue_pair_state(self, row_id, folderish, pair_state, pair=None):
+    def get_work_queue(self, kind, after=(-1, 0), before=None, limit=1000):
+        '''
+        Return the next pairs of the queue kind after the (priority, row_id) key, enqueued before the timestamp
+        The children of a folder waiting to be synchronized are queued with it
+        '''
+        query = ("SELECT States.id, States.folderish, States.pair_state, States.size, States.local_path," +
+                 " States.local_parent_path, WorkQueue.priority, WorkQueue.enqueue_time FROM WorkQueue, States" +
+                 " WHERE States.id=WorkQueue.row_id AND WorkQueue.kind=? AND (WorkQueue.priority>?" +
+                 " OR (WorkQueue.priority=? AND WorkQueue.row_id>?))")
+        params = [kind, after[0], after[0], after[1]]
+        if before is not None:
+            query = query + " AND WorkQueue.enqueue_time<=?"
+            params.append(before)
+        query = (query + " AND NOT EXISTS (SELECT 1 FROM States p WHERE p.local_path=States.local_parent_path" +
+                 " AND p.folderish=1 AND p.pair_state NOT IN (" + _state_codes_sql('synchronized', 'unsynchronized') + "))" +
+                 " ORDER BY WorkQueue.priority, WorkQueue.row_id LIMIT ?")
+        params.append(limit)
+        return self._select(query, params)
+
+    def get_work_queue_size(self, kind=None):
+        if kind is None:
+            return self._select_one("SELECT COUNT(*) as count FROM WorkQueue").count
+        return self._select_one("SELECT COUNT(*) as count FROM WorkQueue WHERE kind=?", (kind,)).count
+
+    def _queue_pair_state(self, row_id, folderish, pair_state, pair=None, size=None, local_path=None,
+                          local_parent_path=None):
+        # The local paths give the depth of the pair to the scheduler, and the parent to wait for to a folder
+        if local_path is None and pair is not None:
+            local_path = pair.local_path
+            local_parent_path = pair.local_parent_path
         if (self._queue_manager is not None
              and pair_state != 'synchronized' and pair_state != 'unsynchronized'):
             if pair_state == 'conflicted':
                 log.trace("Emit newConflict with: %r, pair=%r", row_id, pair)
-                self.newConflict.emit(row_id)
+                self._on_commit(self.newConflict.emit, row_id)
             else:
                 log.trace("Push to queue: %s, pair=%r", pair_state, pair)
-                self._queue_manager.push_ref(row_id, folderish, pair_state)
+                self._on_commit(self._queue_manager.push_ref, row_id, folderish, pair_state, size, local_path,
+                                local_parent_path)
         else:
             log.trace("Will not push pair: %s, pair=%r", pair_state, pair)
         return
@@ -766,16 +1928,11 @@ class EngineDAO(ConfigurationDAO):
     def _get_pair_state(self, row):
         return PAIR_STATES.get((row.local_state, row.remote_state))
 
+    def _update_last_transfer(self, cursor, row_id, transfer):
+        cursor.execute("UPDATE States SET last_transfer=? WHERE id=?", (state_code(transfer), row_id))
+
     def update_last_transfer(self, row_id, transfer):
-        self._lock.acquire()
-        try:
-            con = self._get_write_connection()
-            c = con.cursor()
-            c.execute("UPDATE States SET last_transfer=? WHERE id=?", (transfer, row_id))
-            if self.auto_commit:
-                con.commit()
-        finally:
-            self._lock.release()
+        self._write(self._update_last_transfer, row_id, transfer)
 
     def update_local_state(self, row, info, versionned=True, queue=True):
         log.trace('Updating local state for row = %r with info = %r', row, info)
@@ -784,110 +1941,202 @@ class EngineDAO(ConfigurationDAO):
         if versionned:
             version = ', version=version+1'
             log.trace('Increasing version to %d for pair %r', row.version + 1, row)
+        self._write(self._update_local_state, row, info, pair_state, version, queue)
+
+    def _update_local_state(self, cursor, row, info, pair_state, version, queue):
         parent_path = os.path.dirname(info.path)
-        self._lock.acquire()
-        try:
-            con = self._get_write_connection()
-            c = con.cursor()
-            # Should not update this
-            c.execute("UPDATE States SET last_local_updated=?, local_digest=?, local_path=?, local_parent_path=?, local_name=?,"
-                      + "local_state=?, size=?, remote_state=?, pair_state=?" + version +
-                      " WHERE id=?", (info.last_modification_time, row.local_digest, info.path, parent_path,
-                                        os.path.basename(info.path), row.local_state, info.size, row.remote_state,
-                                        pair_state, row.id))
-            if queue:
-                parent = c.execute("SELECT * FROM States WHERE local_path=?", (parent_path,)).fetchone()
-                # Dont queue if parent is not yet created
-                if (parent is None and parent_path == '') or (parent is not None and parent.pair_state != "locally_created"):
-                    self._queue_pair_state(row.id, info.folderish, pair_state, pair=row)
-            if self.auto_commit:
-                con.commit()
-        finally:
-            self._lock.release()
+        # Should not update this
+        cursor.execute("UPDATE States SET last_local_updated=?, local_digest=?, local_path=?, local_parent_path=?, local_name=?,"
+                  + "local_state=?, size=?, remote_state=?, pair_state=?" + version +
+                  " WHERE id=?", (info.last_modification_time, row.local_digest, info.path, parent_path,
+                                    os.path.basename(info.path), state_code(row.local_state), info.size,
+                                    state_code(row.remote_state), state_code(pair_state), row.id))
+        if queue:
+            parent = cursor.execute("SELECT * FROM States WHERE local_path=?", (parent_path,)).fetchone()
+            # Dont queue if parent is not yet created
+            if (parent is None and parent_path == '') or (parent is not None and parent.pair_state != "locally_created"):
+                self._queue_pair_state(row.id, info.folderish, pair_state, pair=row, size=info.size,
+                                       local_path=info.path, local_parent_path=parent_path)
 
     def update_local_modification_time(self, row, info):
         self.update_local_state(row, info, versionned=False, queue=False)
 
     def get_valid_duplicate_file(self, digest):
-        c = self._get_read_connection(factory=StateRow).cursor()
-        return c.execute("SELECT * FROM States WHERE remote_digest=? AND pair_state='synchronized'", (digest,)).fetchone()
+        # Most of the pairs are synchronized, +pair_state keeps the lookup on the digest index
+        return self._select_one("SELECT * FROM States WHERE remote_digest=? AND +pair_state=?",
+                                (digest, STATE_CODES['synchronized']))
+
+    def _get_remote_path_condition(self, path):
+        # Range of the remote parent paths starting with path, searched in the index unlike a LIKE
+        if not path:
+            return "remote_parent_path IS NOT NULL", ()
+        return "remote_parent_path>=? AND remote_parent_path<?", (path, path[:-1] + unichr(ord(path[-1]) + 1))
+
+    def _get_remote_ref_condition(self, ref):
+        # The descendants of the pairs of the ref are found below their remote paths
+        paths = set((row.remote_parent_path or '') + '/' + ref for row in
+                    self._select("SELECT remote_parent_path FROM States WHERE remote_ref=?", (ref,)))
+        if not paths:
+            # Without a pair of the ref its descendants may still be stored, scan the remote paths
+            return "remote_parent_path LIKE ?", ('%' + ref + '%',)
+        condition = " OR ".join(["remote_parent_path=? OR (remote_parent_path>=? AND remote_parent_path<?)"] * len(paths))
+        params = ()
+        for path in paths:
+            params += (path, path + '/', path + '0')
+        return "(" + condition + ")", params
 
     def get_remote_descendants(self, path):
-        c = self._get_read_connection(factory=StateRow).cursor()
-        return c.execute("SELECT * FROM States WHERE remote_parent_path LIKE ?", (path + '%',)).fetchall()
+        condition, params = self._get_remote_path_condition(path)
+        return self._select("SELECT * FROM States WHERE " + condition, params)
+
+    def _iter_select(self, condition, params=(), batch_size=DEFAULT_ITER_BATCH_SIZE):
+        '''
+        Yield the States matching the condition by batches of rows, paging on the id
+        The rows changed behind the last returned id are not seen again
+        '''
+        last_id = -1
+        while True:
+            rows = self._select("SELECT * FROM States WHERE (" + condition + ") AND id>? ORDER BY id LIMIT ?",
+                                tuple(params) + (last_id, batch_size))
+            for row in rows:
+                yield row
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1].id
+
+    def iter_remote_descendants(self, path, unscrolled=False, batch_size=DEFAULT_ITER_BATCH_SIZE):
+        condition, params = self._get_remote_path_condition(path)
+        if unscrolled:
+            condition += self._unscrolled_condition
+        return self._iter_select(condition, params, batch_size)
+
+    def iter_remote_descendants_from_ref(self, ref, unscrolled=False, batch_size=DEFAULT_ITER_BATCH_SIZE):
+        condition, params = self._get_remote_ref_condition(ref)
+        if unscrolled:
+            condition += self._unscrolled_condition
+        return self._iter_select(condition, params, batch_size)
+
+    _unscrolled_condition = " AND remote_ref NOT IN (SELECT remote_ref FROM RemoteScrolled)"
+
+    def _clean_remote_scrolled(self, cursor):
+        cursor.execute("DELETE FROM RemoteScrolled")
+
+    def clean_remote_scrolled(self):
+        self._write(self._clean_remote_scrolled)
+
+    def _add_remote_scrolled(self, cursor, refs):
+        cursor.executemany("INSERT OR IGNORE INTO RemoteScrolled(remote_ref) VALUES(?)", ((ref,) for ref in refs))
+
+    def add_remote_scrolled(self, refs):
+        '''
+        Record the remote refs returned by the scroll scan, iter_remote_descendants skips them with unscrolled
+        '''
+        self._write(self._add_remote_scrolled, refs)
+
+    def get_last_state_id(self):
+        row = self._select_one("SELECT MAX(id) FROM States")
+        return row[0] or 0
+
+    def get_states_from_remote_refs(self, refs):
+        result = []
+        refs = list(set(refs))
+        for i in range(0, len(refs), 500):
+            chunk = refs[i:i + 500]
+            result.extend(self._select("SELECT * FROM States WHERE remote_ref IN (" + ",".join("?" * len(chunk)) +
+                                       ") ORDER BY id", chunk))
+        return result
+
+    def get_states_from_ids(self, row_ids):
+        result = []
+        row_ids = list(set(row_ids))
+        for i in range(0, len(row_ids), 500):
+            chunk = row_ids[i:i + 500]
+            result.extend(self._select("SELECT * FROM States WHERE id IN (" + ",".join("?" * len(chunk)) +
+                                       ") ORDER BY id", chunk))
+        return result
 
     def get_remote_descendants_from_ref(self, ref):
-        c = self._get_read_connection(factory=StateRow).cursor()
-        return c.execute("SELECT * FROM States WHERE remote_parent_path LIKE ?", ('%' + ref + '%',)).fetchall()
+        condition, params = self._get_remote_ref_condition(ref)
+        return self._select("SELECT * FROM States WHERE " + condition, params)
 
     def get_remote_children(self, ref):
-        c = self._get_read_connection(factory=StateRow).cursor()
-        return c.execute("SELECT * FROM States WHERE remote_parent_ref=?", (ref,)).fetchall()
+        return self._select("SELECT * FROM States WHERE remote_parent_ref=?", (ref,))
 
     def get_new_remote_children(self, ref):
-        c = self._get_read_connection(factory=StateRow).cursor()
-        return c.execute("SELECT * FROM States WHERE remote_parent_ref=? AND remote_state='created' AND local_state='unknown'", (ref,)).fetchall()
+        return self._select("SELECT * FROM States WHERE remote_parent_ref=? AND remote_state=? AND local_state=?",
+                            (ref, STATE_CODES['created'], STATE_CODES['unknown']))
+
+    def get_state_counters(self):
+        row = self._select_one("SELECT * FROM StateCounters", factory=CustomRow)
+        return dict((name, row[name]) for name, _, _ in STATE_COUNTERS)
+
+    def _get_state_counter(self, name):
+        return self._select_one("SELECT " + name + " FROM StateCounters", factory=CustomRow)[0]
 
     def get_unsynchronized_count(self):
-        return self.get_count("pair_state='unsynchronized'")
+        return self._get_state_counter("unsynchronized")
 
     def get_conflict_count(self):
-        return self.get_count("pair_state='conflicted'")
+        return self._get_state_counter("conflicts")
 
-    def get_error_count(self, threshold=3):
+    def get_error_count(self, threshold=STATE_COUNTERS_THRESHOLD):
+        if threshold == STATE_COUNTERS_THRESHOLD:
+            return self._get_state_counter("errors")
         return self.get_count("error_count > " + str(threshold))
 
-    def get_syncing_count(self, threshold=3):
-        query = "pair_state!='synchronized' AND pair_state!='conflicted' AND pair_state!='unsynchronized' AND error_count < " + str(threshold)
-        count = self.get_count(query)
-        if self._items_count is not None and count != self._items_count:
-            log.trace("Cache Syncing count incorrect should be %d was %d", count, self._items_count)
-            self._items_count = count
-        return count
+    def get_syncing_count(self, threshold=STATE_COUNTERS_THRESHOLD):
+        if threshold == STATE_COUNTERS_THRESHOLD:
+            return self._get_state_counter("syncing")
+        query = ("pair_state NOT IN (" + _state_codes_sql('synchronized', 'conflicted', 'unsynchronized') +
+                 ") AND error_count < " + str(threshold))
+        return self.get_count(query)
 
     def get_sync_count(self, filetype=None):
-        query = "pair_state='synchronized'"
         if filetype == "file":
-            query = query + " AND folderish=0"
+            return self._get_state_counter("sync_files")
         elif filetype == "folder":
-            query = query + " AND folderish=1"
-        return self.get_count(query)
+            return self._get_state_counter("sync_folders")
+        return self._get_state_counter("synchronized")
 
     def get_count(self, condition=None):
         query = "SELECT COUNT(*) as count FROM States"
         if condition is not None:
             query = query + " WHERE " + condition
-        c = self._get_read_connection(factory=StateRow).cursor()
-        return c.execute(query).fetchone().count
+        return self._select_one(query).count
 
     def get_global_size(self):
-        c = self._get_read_connection(factory=StateRow).cursor()
-        return c.execute("SELECT SUM(size) as sum FROM States WHERE pair_state='synchronized'").fetchone().sum
+        return self._get_state_counter("sync_size")
 
     def get_unsynchronizeds(self):
-        c = self._get_read_connection(factory=StateRow).cursor()
-        return c.execute("SELECT * FROM States WHERE pair_state='unsynchronized'").fetchall()
+        return self._select("SELECT * FROM States WHERE pair_state=?", (STATE_CODES['unsynchronized'],))
+
+    def iter_unsynchronizeds(self, batch_size=DEFAULT_ITER_BATCH_SIZE):
+        return self._iter_select("pair_state=?", (STATE_CODES['unsynchronized'],), batch_size)
 
     def get_conflicts(self):
-        c = self._get_read_connection(factory=StateRow).cursor()
-        return c.execute("SELECT * FROM States WHERE pair_state='conflicted'").fetchall()
+        return self._select("SELECT * FROM States WHERE pair_state=?", (STATE_CODES['conflicted'],))
+
+    def iter_conflicts(self, batch_size=DEFAULT_ITER_BATCH_SIZE):
+        return self._iter_select("pair_state=?", (STATE_CODES['conflicted'],), batch_size)
 
     def get_errors(self, limit=3):
-        c = self._get_read_connection(factory=StateRow).cursor()
-        return c.execute("SELECT * FROM States WHERE error_count>?", (limit,)).fetchall()
+        return self._select("SELECT * FROM States WHERE error_count>?", (limit,))
+
+    def iter_errors(self, limit=3, batch_size=DEFAULT_ITER_BATCH_SIZE):
+        return self._iter_select("error_count>?", (limit,), batch_size)
 
     def get_local_children(self, path):
-        c = self._get_read_connection(factory=StateRow).cursor()
-        return c.execute("SELECT * FROM States WHERE local_parent_path=?", (path,)).fetchall()
+        return self._select("SELECT * FROM States WHERE local_parent_path=?", (path,))
 
     def get_states_from_partial_local(self, path):
-        c = self._get_read_connection(factory=StateRow).cursor()
-        return c.execute("SELECT * FROM States WHERE local_path LIKE ?", (path + '%',)).fetchall()
+        return self._select("SELECT * FROM States WHERE local_path LIKE ?", (path + '%',))
+
+    def iter_states_from_partial_local(self, path, batch_size=DEFAULT_ITER_BATCH_SIZE):
+        return self._iter_select("local_path LIKE ?", (path + '%',), batch_size)
 
     def get_first_state_from_partial_remote(self, ref):
-        c = self._get_read_connection(factory=StateRow).cursor()
-        return c.execute("SELECT * FROM States WHERE remote_ref LIKE ? ORDER BY last_remote_updated ASC LIMIT 1",
-                         ('%' + ref,)).fetchone()
+        return self._select_one("SELECT * FROM States WHERE remote_ref LIKE ? ORDER BY last_remote_updated ASC LIMIT 1",
+                         ('%' + ref,))
 
     def get_normal_state_from_remote(self, ref):
         # TODO Select the only states that is not a collection
@@ -900,173 +2149,162 @@ class EngineDAO(ConfigurationDAO):
         # remote_path root is empty, should refactor this
         if path == '/':
             path = ""
-        c = self._get_read_connection(factory=StateRow).cursor()
-        return c.execute("SELECT * FROM States WHERE remote_ref=? AND remote_parent_path=?", (ref,path)).fetchone()
+        return self._select_one("SELECT * FROM States WHERE remote_ref=? AND remote_parent_path=?", (ref,path))
 
     def get_states_from_remote(self, ref):
-        c = self._get_read_connection(factory=StateRow).cursor()
-        return c.execute("SELECT * FROM States WHERE remote_ref=?", (ref,)).fetchall()
+        return self._select_state(('remote', ref), "SELECT * FROM States WHERE remote_ref=?", (ref,))
 
     def get_state_from_id(self, row_id, from_write=False):
         # Dont need to read from write as auto_commit is True
         if from_write and self.auto_commit:
             from_write = False
+        if not from_write:
+            return self._select_state(('id', row_id), "SELECT * FROM States WHERE id=?", (row_id,))
+        self._lock.acquire()
         try:
-            if from_write:
-                self._lock.acquire()
-                c = self._get_write_connection(factory=StateRow).cursor()
-            else:
-                c = self._get_read_connection(factory=StateRow).cursor()
+            c = self._get_write_connection(factory=state_row_factory).cursor()
             state = c.execute("SELECT * FROM States WHERE id=?", (row_id,)).fetchone()
         finally:
-            if from_write:
-                self._lock.release()
+            self._lock.release()
         return state
 
     def _get_recursive_condition(self, doc_pair):
         return (" WHERE local_parent_path LIKE '" + self._escape(doc_pair.local_path) + "/%'"
                     + " OR local_parent_path = '" + self._escape(doc_pair.local_path) + "'")
 
+    def _update_remote_parent_path(self, cursor, doc_pair, new_path):
+        if doc_pair.folderish:
+            remote_path = doc_pair.remote_parent_path + "/" + doc_pair.remote_ref
+            query = "UPDATE States SET remote_parent_path='%s/%s' || substr(remote_parent_path,%d)" % (
+                self._escape(new_path), self._escape(doc_pair.remote_ref), len(remote_path) + 1)
+            query = query + self._get_recursive_condition(doc_pair)
+            log.trace("Update remote_parent_path: " + query)
+            cursor.execute(query)
+        cursor.execute("UPDATE States SET remote_parent_path=? WHERE id=?", (new_path, doc_pair.id))
+
     def update_remote_parent_path(self, doc_pair, new_path):
-        self._lock.acquire()
-        try:
-            con = self._get_write_connection()
-            c = con.cursor()
-            if doc_pair.folderish:
-                remote_path = doc_pair.remote_parent_path + "/" + doc_pair.remote_ref
-                query = "UPDATE States SET remote_parent_path='%s/%s' || substr(remote_parent_path,%d)" % (
-                    self._escape(new_path), self._escape(doc_pair.remote_ref), len(remote_path) + 1)
-                query = query + self._get_recursive_condition(doc_pair)
-                log.trace("Update remote_parent_path: " + query)
-                c.execute(query)
-            c.execute("UPDATE States SET remote_parent_path=? WHERE id=?", (new_path, doc_pair.id))
-            if self.auto_commit:
-                con.commit()
-        finally:
-            self._lock.release()
+        self._write(self._update_remote_parent_path, doc_pair, new_path)
+
+    def _update_local_paths(self, cursor, doc_pair):
+        cursor.execute("UPDATE States SET local_parent_path=?, local_path=? WHERE id=?",
+                       (doc_pair.local_parent_path, doc_pair.local_path, doc_pair.id))
 
     def update_local_paths(self, doc_pair):
-        self._lock.acquire()
-        try:
-            con = self._get_write_connection()
-            c = con.cursor()
-            c.execute("UPDATE States SET local_parent_path=?, local_path=? WHERE id=?", (doc_pair.local_parent_path, doc_pair.local_path, doc_pair.id))
-            if self.auto_commit:
-                con.commit()
-        finally:
-            self._lock.release()
+        self._write(self._update_local_paths, doc_pair)
+
+    def _update_local_parent_path(self, cursor, doc_pair, new_name, new_path):
+        if doc_pair.folderish:
+            if new_path == '/':
+                new_path = ''
+            escaped_new_path = self._escape(new_path)
+            escaped_new_name = self._escape(new_name)
+            query = ("UPDATE States SET local_parent_path='%s/%s' || substr(local_parent_path,%d), local_path='%s/%s' || substr(local_path,%d)" %
+                     (escaped_new_path, escaped_new_name, len(doc_pair.local_path) + 1,
+                      escaped_new_path, escaped_new_name, len(doc_pair.local_path)+1))
+            query = query + self._get_recursive_condition(doc_pair)
+            cursor.execute(query)
+        # Dont need to update the path as it is refresh later
+        cursor.execute("UPDATE States SET local_parent_path=? WHERE id=?", (new_path, doc_pair.id))
 
     def update_local_parent_path(self, doc_pair, new_name, new_path):
-        self._lock.acquire()
-        try:
-            con = self._get_write_connection()
-            c = con.cursor()
-            if doc_pair.folderish:
-                if new_path == '/':
-                    new_path = ''
-                escaped_new_path = self._escape(new_path)
-                escaped_new_name = self._escape(new_name)
-                query = ("UPDATE States SET local_parent_path='%s/%s' || substr(local_parent_path,%d), local_path='%s/%s' || substr(local_path,%d)" %
-                         (escaped_new_path, escaped_new_name, len(doc_pair.local_path) + 1,
-                          escaped_new_path, escaped_new_name, len(doc_pair.local_path)+1))
-                query = query + self._get_recursive_condition(doc_pair)
-                c.execute(query)
-            # Dont need to update the path as it is refresh later
-            c.execute("UPDATE States SET local_parent_path=? WHERE id=?", (new_path, doc_pair.id))
-            if self.auto_commit:
-                con.commit()
-        finally:
-            self._lock.release()
+        self._write(self._update_local_parent_path, doc_pair, new_name, new_path)
+
+    def _mark_descendants(self, cursor, doc_pair, update):
+        cursor.execute(update + " WHERE id=?", (doc_pair.id,))
+        if doc_pair.folderish:
+            cursor.execute(update + self._get_recursive_condition(doc_pair))
+        self._queue_pair_state(doc_pair.id, doc_pair.folderish, doc_pair.pair_state, pair=doc_pair)
 
     def mark_descendants_remotely_deleted(self, doc_pair):
-        self._lock.acquire()
-        try:
-            con = self._get_write_connection()
-            c = con.cursor()
-            update = "UPDATE States SET local_digest=NULL, last_local_updated=NULL, local_name=NULL, remote_state='deleted', pair_state='remotely_deleted'"
-            c.execute(update + " WHERE id=?", (doc_pair.id,))
-            if doc_pair.folderish:
-                c.execute(update + self._get_recursive_condition(doc_pair))
-            if self.auto_commit:
-                con.commit()
-            self._queue_pair_state(doc_pair.id, doc_pair.folderish, doc_pair.pair_state)
-        finally:
-            self._lock.release()
+        update = "UPDATE States SET local_digest=NULL, last_local_updated=NULL, local_name=NULL, remote_state=" + _state_codes_sql('deleted') + ", pair_state=" + _state_codes_sql('remotely_deleted')
+        self._write(self._mark_descendants, doc_pair, update)
 
     def mark_descendants_remotely_created(self, doc_pair):
-        self._lock.acquire()
-        try:
-            con = self._get_write_connection()
-            c = con.cursor()
-            update = "UPDATE States SET local_digest=NULL, last_local_updated=NULL, local_name=NULL, remote_state='created', pair_state='remotely_created'"
-            c.execute(update + " WHERE id=" + str(doc_pair.id))
-            if doc_pair.folderish:
-                c.execute(update + self._get_recursive_condition(doc_pair))
-            if self.auto_commit:
-                con.commit()
-            self._queue_pair_state(doc_pair.id, doc_pair.folderish, doc_pair.pair_state)
-        finally:
-            self._lock.release()
+        update = "UPDATE States SET local_digest=NULL, last_local_updated=NULL, local_name=NULL, remote_state=" + _state_codes_sql('created') + ", pair_state=" + _state_codes_sql('remotely_created')
+        self._write(self._mark_descendants, doc_pair, update)
 
     def mark_descendants_locally_created(self, doc_pair):
-        self._lock.acquire()
-        try:
-            con = self._get_write_connection()
-            c = con.cursor()
-            update = "UPDATE States SET remote_digest=NULL, remote_ref=NULL, remote_parent_ref=NULL, remote_parent_path=NULL, last_remote_updated=NULL, remote_name=NULL, remote_state='unknown', local_state='created', pair_state='locally_created'"
-            c.execute(update + " WHERE id=" + str(doc_pair.id))
-            if doc_pair.folderish:
-                c.execute(update + self._get_recursive_condition(doc_pair))
-            if self.auto_commit:
-                con.commit()
-            self._queue_pair_state(doc_pair.id, doc_pair.folderish, doc_pair.pair_state)
-        finally:
-            self._lock.release()
+        update = "UPDATE States SET remote_digest=NULL, remote_ref=NULL, remote_parent_ref=NULL, remote_parent_path=NULL, last_remote_updated=NULL, remote_name=NULL, remote_state=" + _state_codes_sql('unknown') + ", local_state=" + _state_codes_sql('created') + ", pair_state=" + _state_codes_sql('locally_created')
+        self._write(self._mark_descendants, doc_pair, update)
+
+    def _remove_state(self, cursor, doc_pair):
+        if doc_pair.folderish:
+            cursor.execute("DELETE FROM States" + self._get_recursive_condition(doc_pair))
+        cursor.execute("DELETE FROM States WHERE id=?", (doc_pair.id,))
 
     def remove_state(self, doc_pair):
-        self._lock.acquire()
-        try:
-            con = self._get_write_connection()
-            c = con.cursor()
-            c.execute("DELETE FROM States WHERE id=?", (doc_pair.id,))
-            if doc_pair.folderish:
-                c.execute("DELETE FROM States" + self._get_recursive_condition(doc_pair))
-            if self.auto_commit:
-                con.commit()
-        finally:
-            self._lock.release()
+        self._write(self._remove_state, doc_pair)
 
     def get_state_from_local(self, path):
-        c = self._get_read_connection(factory=StateRow).cursor()
-        return c.execute("SELECT * FROM States WHERE local_path=?", (path,)).fetchone()
+        return self._select_state(('local', path), "SELECT * FROM States WHERE local_path=?", (path,))
+
+    _insert_remote_query = ("INSERT INTO States (remote_ref, remote_parent_ref, " +
+                  "remote_parent_path, remote_name, last_remote_updated, remote_can_rename," +
+                  "remote_can_delete, remote_can_update, " +
+                  "remote_can_create_child, last_remote_modifier, remote_digest," +
+                  "folderish, last_remote_modifier, local_path, local_parent_path, remote_state, local_state, pair_state, local_name)" +
+                  " VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?," + _state_codes_sql('created', 'unknown') + ",?, ?)")
+
+    def _get_insert_remote_params(self, info, remote_parent_path, local_path, local_parent_path, pair_state):
+        return (info.uid, info.parent_uid, remote_parent_path, info.name,
+                info.last_modification_time, info.can_rename, info.can_delete, info.can_update,
+                info.can_create_child, info.last_contributor, info.digest, info.folderish, info.last_contributor,
+                local_path, local_parent_path, state_code(pair_state), info.name)
+
+    def _get_parent_states(self, cursor, refs):
+        # Resolve the pair_state of the parents of a batch with one query per 500 refs
+        parents = dict()
+        refs = list(set(refs))
+        for i in range(0, len(refs), 500):
+            chunk = refs[i:i + 500]
+            rows = cursor.execute("SELECT remote_ref, pair_state FROM States WHERE remote_ref IN (" +
+                                  ",".join("?" * len(chunk)) + ")", chunk).fetchall()
+            for row in rows:
+                parents.setdefault(row[0], row[1])
+        return parents
+
+    def _insert_remote_state(self, cursor, info, remote_parent_path, local_path, local_parent_path):
+        pair_state = PAIR_STATES.get(('unknown','created'))
+        cursor.execute(self._insert_remote_query, self._get_insert_remote_params(info, remote_parent_path, local_path,
+                                                                                 local_parent_path, pair_state))
+        row_id = cursor.lastrowid
+        # Check if parent is not in creation
+        parent = cursor.execute("SELECT * FROM States WHERE remote_ref=?", (info.parent_uid,)).fetchone()
+        if (parent is None and local_parent_path == '') or (parent is not None and parent.pair_state != "remotely_created"):
+            self._queue_pair_state(row_id, info.folderish, pair_state, local_path=local_path,
+                                   local_parent_path=local_parent_path)
+        return row_id
 
     def insert_remote_state(self, info, remote_parent_path, local_path, local_parent_path):
+        return self._write(self._insert_remote_state, info, remote_parent_path, local_path, local_parent_path)
+
+    def _insert_remote_states(self, cursor, batch):
         pair_state = PAIR_STATES.get(('unknown','created'))
-        self._lock.acquire()
-        try:
-            con = self._get_write_connection()
-            c = con.cursor()
-            c.execute("INSERT INTO States (remote_ref, remote_parent_ref, " +
-                      "remote_parent_path, remote_name, last_remote_updated, remote_can_rename," +
-                      "remote_can_delete, remote_can_update, " +
-                      "remote_can_create_child, last_remote_modifier, remote_digest," +
-                      "folderish, last_remote_modifier, local_path, local_parent_path, remote_state, local_state, pair_state, local_name)" +
-                      " VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,'created','unknown',?, ?)",
-                      (info.uid, info.parent_uid, remote_parent_path, info.name,
-                       info.last_modification_time, info.can_rename, info.can_delete, info.can_update,
-                       info.can_create_child, info.last_contributor, info.digest, info.folderish, info.last_contributor,
-                       local_path, local_parent_path, pair_state, info.name))
-            row_id = c.lastrowid
-            if self.auto_commit:
-                con.commit()
+        last_id = cursor.execute("SELECT MAX(id) FROM States").fetchone()[0] or 0
+        cursor.executemany(self._insert_remote_query,
+                           [self._get_insert_remote_params(info, remote_parent_path, local_path, local_parent_path,
+                                                           pair_state)
+                            for info, remote_parent_path, local_path, local_parent_path in batch])
+        # The ids are allocated after the current maximum as the write lock is held
+        cursor.row_factory = state_row_factory
+        rows = cursor.execute("SELECT * FROM States WHERE id > ? ORDER BY id", (last_id,)).fetchall()
+        parents = self._get_parent_states(cursor, [row.remote_parent_ref for row in rows])
+        for row in rows:
             # Check if parent is not in creation
-            parent = c.execute("SELECT * FROM States WHERE remote_ref=?", (info.parent_uid,)).fetchone()
-            if (parent is None and local_parent_path == '') or (parent is not None and parent.pair_state != "remotely_created"):
-                self._queue_pair_state(row_id, info.folderish, pair_state)
-            self._items_count = self._items_count + 1
-        finally:
-            self._lock.release()
-        return row_id
+            parent_state = parents.get(row.remote_parent_ref)
+            if ((parent_state is None and row.local_parent_path == '')
+                    or (parent_state is not None and parent_state != "remotely_created")):
+                self._queue_pair_state(row.id, row.folderish, pair_state, pair=row)
+        return rows
+
+    def insert_remote_states(self, batch):
+        '''
+        Insert a batch of (info, remote_parent_path, local_path, local_parent_path) in one transaction
+        and return the created StateRow in the batch order
+        '''
+        if not batch:
+            return []
+        return self._write(self._insert_remote_states, batch)
 
     def queue_children(self, row):
         self._lock.acquire()
@@ -1077,145 +2315,78 @@ class EngineDAO(ConfigurationDAO):
                                     self._get_to_sync_condition(), (row.remote_ref, row.local_path)).fetchall()
             log.debug("Queuing %d children of '%r'", len(children), row)
             for child in children:
-                self._queue_pair_state(child.id, child.folderish, child.pair_state)
+                self._queue_pair_state(child.id, child.folderish, child.pair_state, pair=child, size=child.size)
         finally:
             self._lock.release()
 
+    def _increase_error(self, cursor, row_id, error, error_date, details, incr):
+        cursor.execute("UPDATE States SET last_error=?, last_sync_error_date=?, error_count = error_count + ?, last_error_details=? " +
+                  "WHERE id=?", (error, error_date, incr, details, row_id))
+
     def increase_error(self, row, error, details=None, incr=1):
         error_date = datetime.utcnow()
-        self._lock.acquire()
-        try:
-            con = self._get_write_connection()
-            c = con.cursor()
-            c.execute("UPDATE States SET last_error=?, last_sync_error_date=?, error_count = error_count + ?, last_error_details=? " +
-                      "WHERE id=?", (error, error_date, incr, details, row.id))
-            if self.auto_commit:
-                con.commit()
-        finally:
-            self._lock.release()
+        self._write(self._increase_error, row.id, error, error_date, details, incr)
         row.last_error = error
         row.error_count = row.error_count + incr
         row.last_sync_error_date = error_date
 
+    def _reset_error(self, cursor, row):
+        cursor.execute("UPDATE States SET last_error=NULL, last_error_details=NULL, last_sync_error_date=NULL, error_count = 0" +
+                  " WHERE id=?", (row.id,))
+        self._queue_pair_state(row.id, row.folderish, row.pair_state, pair=row, size=row.size)
+
     def reset_error(self, row):
-        self._lock.acquire()
-        try:
-            con = self._get_write_connection()
-            c = con.cursor()
-            c.execute("UPDATE States SET last_error=NULL, last_error_details=NULL, last_sync_error_date=NULL, error_count = 0" +
-                      " WHERE id=?", (row.id,))
-            if self.auto_commit:
-                con.commit()
-            self._queue_pair_state(row.id, row.folderish, row.pair_state)
-            self._items_count = self._items_count + 1
-        finally:
-            self._lock.release()
+        self._write(self._reset_error, row)
         row.last_error = None
         row.error_count = 0
         row.last_sync_error_date = None
 
+    def _force_remote(self, cursor, row):
+        cursor.execute("UPDATE States SET local_state=?, remote_state=?, pair_state=?, last_error=NULL, last_sync_error_date=NULL, error_count = 0" +
+                  " WHERE id=? AND version=?", (STATE_CODES['synchronized'], STATE_CODES['modified'],
+                                                STATE_CODES['remotely_modified'], row.id, row.version))
+        self._queue_pair_state(row.id, row.folderish, "remotely_modified", pair=row, size=row.size)
+        return cursor.rowcount
+
     def force_remote(self, row):
-        self._lock.acquire()
-        try:
-            con = self._get_write_connection()
-            c = con.cursor()
-            c.execute("UPDATE States SET local_state='synchronized', remote_state='modified', pair_state='remotely_modified', last_error=NULL, last_sync_error_date=NULL, error_count = 0" +
-                      " WHERE id=? AND version=?", (row.id, row.version))
-            self._queue_pair_state(row.id, row.folderish, "remotely_modified")
-            if self.auto_commit:
-                con.commit()
-        finally:
-            self._lock.release()
-        if c.rowcount == 1:
-            self._items_count = self._items_count + 1
-            return True
-        return False
+        return self._write(self._force_remote, row) == 1
+
+    def _force_local(self, cursor, row):
+        cursor.execute("UPDATE States SET local_state=?, remote_state=?, pair_state=?, last_error=NULL, last_sync_error_date=NULL, error_count = 0" +
+                  " WHERE id=? AND version=?", (STATE_CODES['created'], STATE_CODES['unknown'],
+                                                STATE_CODES['locally_created'], row.id, row.version))
+        self._queue_pair_state(row.id, row.folderish, "locally_created", pair=row, size=row.size)
+        return cursor.rowcount
 
     def force_local(self, row):
-        self._lock.acquire()
-        try:
-            con = self._get_write_connection()
-            c = con.cursor()
-            c.execute("UPDATE States SET local_state='created', remote_state='unknown', pair_state='locally_created', last_error=NULL, last_sync_error_date=NULL, error_count = 0" +
-                      " WHERE id=? AND version=?", (row.id, row.version))
-            self._queue_pair_state(row.id, row.folderish, "locally_created")
-            if self.auto_commit:
-                con.commit()
-        finally:
-            self._lock.release()
-        if c.rowcount == 1:
-            self._items_count = self._items_count + 1
-            return True
-        return False
+        return self._write(self._force_local, row) == 1
+
+    def _set_conflict_state(self, cursor, row):
+        cursor.execute("UPDATE States SET pair_state=? WHERE id=?",
+                  (STATE_CODES['conflicted'], row.id))
+        self._on_commit(self.newConflict.emit, row.id)
+        return cursor.rowcount
 
     def set_conflict_state(self, row):
-        self._lock.acquire()
-        try:
-            con = self._get_write_connection()
-            c = con.cursor()
-            c.execute("UPDATE States SET pair_state='conflicted' WHERE id=?",
-                      (row.id, ))
-            self.newConflict.emit(row.id)
-            if self.auto_commit:
-                con.commit()
-        finally:
-            self._lock.release()
-        if c.rowcount == 1:
-            self._items_count = self._items_count - 1
-            return True
-        return False
+        return self._write(self._set_conflict_state, row) == 1
+
+    def _unsynchronize_state(self, cursor, row, last_error):
+        cursor.execute("UPDATE States SET pair_state=?, last_sync_date=?, processor = 0," +
+                  "last_error=?, error_count=0, last_sync_error_date=NULL WHERE id=?",
+                  (STATE_CODES['unsynchronized'], datetime.utcnow(), last_error, row.id))
 
     def unsynchronize_state(self, row, last_error=None):
-        self._lock.acquire()
-        try:
-            con = self._get_write_connection()
-            c = con.cursor()
-            c.execute("UPDATE States SET pair_state='unsynchronized', last_sync_date=?, processor = 0," +
-                      "last_error=?, error_count=0, last_sync_error_date=NULL WHERE id=?",
-                      (datetime.utcnow(), last_error, row.id))
-            if self.auto_commit:
-                con.commit()
-        finally:
-            self._lock.release()
+        self._write(self._unsynchronize_state, row, last_error)
 
     def synchronize_state(self, row, version=None):
         if version is None:
             version = row.version
         log.trace('Try to synchronize state for [local_path=%s, remote_name=%s, version=%s] with version=%s',
                   row.local_path, row.remote_name, row.version, version)
-        self._lock.acquire()
-        try:
-            con = self._get_write_connection()
-            c = con.cursor()
-            c.execute("UPDATE States SET local_state='synchronized', remote_state='synchronized', " +
-                      "pair_state='synchronized', last_sync_date=?, processor = 0, last_error=NULL, error_count=0, last_sync_error_date=NULL " +
-                      "WHERE id=? and version=?",
-                      (datetime.utcnow(), row.id, version))
-            if self.auto_commit:
-                con.commit()
-        finally:
-            self._lock.release()
-        result = c.rowcount == 1
-        # Retry without version for folder
-        if not result and row.folderish:
-            self._lock.acquire()
-            try:
-                con = self._get_write_connection()
-                c = con.cursor()
-                c.execute("UPDATE States SET local_state='synchronized', remote_state='synchronized', " +
-                          "pair_state='synchronized', last_sync_date=?, processor = 0, last_error=NULL, error_count=0, last_sync_error_date=NULL " +
-                          "WHERE id=? and local_path=? and remote_name=? and remote_ref=? and remote_parent_ref=?",
-                          (datetime.utcnow(), row.id, row.local_path, row.remote_name, row.remote_ref, row.remote_parent_ref))
-                if self.auto_commit:
-                    con.commit()
-            finally:
-                self._lock.release()
-            result = c.rowcount == 1
+        result = self._write(self._synchronize_state, row, version) == 1
         if not result:
             log.trace("Was not able to synchronize state: %r", row)
-            con = self._get_read_connection()
-            c = con.cursor()
-            row2 = c.execute("SELECT * FROM States WHERE id=?", (row.id,)).fetchone()
+            row2 = self._select_one("SELECT * FROM States WHERE id=?", (row.id,))
             if row2 is None:
                 log.trace("No more row")
             else:
@@ -1225,11 +2396,36 @@ class EngineDAO(ConfigurationDAO):
             self.queue_children(row)
         return result
 
+    _synchronized = _state_codes_sql('synchronized')
+
+    def _synchronize_state(self, cursor, row, version):
+        cursor.execute("UPDATE States SET local_state=" + self._synchronized + ", remote_state=" + self._synchronized + ", " +
+                  "pair_state=" + self._synchronized + ", last_sync_date=?, processor = 0, last_error=NULL, error_count=0, last_sync_error_date=NULL " +
+                  "WHERE id=? and version=?",
+                  (datetime.utcnow(), row.id, version))
+        # Retry without version for folder
+        if cursor.rowcount != 1 and row.folderish:
+            cursor.execute("UPDATE States SET local_state=" + self._synchronized + ", remote_state=" + self._synchronized + ", " +
+                      "pair_state=" + self._synchronized + ", last_sync_date=?, processor = 0, last_error=NULL, error_count=0, last_sync_error_date=NULL " +
+                      "WHERE id=? and local_path=? and remote_name=? and remote_ref=? and remote_parent_ref=?",
+                      (datetime.utcnow(), row.id, row.local_path, row.remote_name, row.remote_ref, row.remote_parent_ref))
+        return cursor.rowcount
+
     def update_remote_state(self, row, info, remote_parent_path=None, versionned=True, queue=True, force_update=False, no_digest=False):
-        pair_state = self._get_pair_state(row)
         if remote_parent_path is None:
             remote_parent_path = row.remote_parent_path
+        pair_state = self._get_remote_pair_state(row, info, remote_parent_path, force_update)
+        if pair_state is None:
+            return
         version = ''
+        if versionned:
+            version = ', version=version+1'
+            log.trace('Increasing version to %d for pair %r', row.version + 1, row)
+        self._write(self._update_remote_state, row, info, remote_parent_path, pair_state, version, queue, no_digest)
+
+    def _get_remote_pair_state(self, row, info, remote_parent_path, force_update=False):
+        # Return the new pair_state of the row or None if it does not need an update
+        pair_state = self._get_pair_state(row)
         # Check if it really needs an update
         if (row.remote_ref == info.uid and info.parent_uid == row.remote_parent_ref and remote_parent_path == row.remote_parent_path
             and info.name == row.remote_name and info.can_rename == row.remote_can_rename
@@ -1240,144 +2436,150 @@ class EngineDAO(ConfigurationDAO):
                 pair_state = self._get_pair_state(row)
             if info.digest == row.remote_digest and not force_update:
                 log.trace('Not updating remote state (not dirty) for row = %r with info = %r', row, info)
-                return
+                return None
         log.trace('Updating remote state for row = %r with info = %r (force: %r)', row, info, force_update)
-        if versionned:
-            version = ', version=version+1'
-            log.trace('Increasing version to %d for pair %r', row.version + 1, row)
-        self._lock.acquire()
-        try:
-            con = self._get_write_connection()
-            c = con.cursor()
-            query = "UPDATE States SET remote_ref=?, remote_parent_ref=?, " + \
-                      "remote_parent_path=?, remote_name=?, last_remote_updated=?, remote_can_rename=?," + \
-                      "remote_can_delete=?, remote_can_update=?, " + \
-                      "remote_can_create_child=?, last_remote_modifier=?,"
-            if not no_digest and info.digest is not None:
-                query = query + "remote_digest='" + info.digest + "',"
-            query = query + " local_state=?," + \
-                      "remote_state=?, pair_state=?" + version + " WHERE id=?"
-            c.execute(query,
-                      (info.uid, info.parent_uid, remote_parent_path, info.name,
-                       info.last_modification_time, info.can_rename, info.can_delete, info.can_update,
-                       info.can_create_child, info.last_contributor, row.local_state,
-                       row.remote_state, pair_state, row.id))
-            if self.auto_commit:
-                con.commit()
-            if queue:
-                # Check if parent is not in creation
-                parent = c.execute("SELECT * FROM States WHERE remote_ref=?", (info.parent_uid,)).fetchone()
-                # Parent can be None if the parent is filtered
-                if (parent is not None and parent.pair_state != "remotely_created") or parent is None:
-                    self._queue_pair_state(row.id, info.folderish, pair_state)
-        finally:
-            self._lock.release()
+        return pair_state
+
+    def update_remote_states(self, batch):
+        '''
+        Update a batch of (row, info, remote_parent_path) in one transaction, the version of
+        each updated row is increased and the not dirty rows are skipped
+        '''
+        updates = []
+        for row, info, remote_parent_path in batch:
+            if remote_parent_path is None:
+                remote_parent_path = row.remote_parent_path
+            pair_state = self._get_remote_pair_state(row, info, remote_parent_path)
+            if pair_state is not None:
+                updates.append((row, info, remote_parent_path, pair_state))
+        if updates:
+            self._write(self._update_remote_states, updates)
+        return len(updates)
+
+    def _update_remote_states(self, cursor, updates):
+        cursor.executemany("UPDATE States SET remote_ref=?, remote_parent_ref=?, " +
+                           "remote_parent_path=?, remote_name=?, last_remote_updated=?, remote_can_rename=?," +
+                           "remote_can_delete=?, remote_can_update=?, " +
+                           "remote_can_create_child=?, last_remote_modifier=?, remote_digest=IFNULL(?, remote_digest)," +
+                           " local_state=?, remote_state=?, pair_state=?, version=version+1 WHERE id=?",
+                           [(info.uid, info.parent_uid, remote_parent_path, info.name,
+                             info.last_modification_time, info.can_rename, info.can_delete, info.can_update,
+                             info.can_create_child, info.last_contributor, info.digest, state_code(row.local_state),
+                             state_code(row.remote_state), state_code(pair_state), row.id)
+                            for row, info, remote_parent_path, pair_state in updates])
+        # Parent can be None if the parent is filtered
+        parents = self._get_parent_states(cursor, [info.parent_uid for _, info, _, _ in updates])
+        for row, info, _, pair_state in updates:
+            if parents.get(info.parent_uid) != "remotely_created":
+                self._queue_pair_state(row.id, info.folderish, pair_state, pair=row)
+
+    def _update_remote_state(self, cursor, row, info, remote_parent_path, pair_state, version, queue, no_digest):
+        query = "UPDATE States SET remote_ref=?, remote_parent_ref=?, " + \
+                  "remote_parent_path=?, remote_name=?, last_remote_updated=?, remote_can_rename=?," + \
+                  "remote_can_delete=?, remote_can_update=?, " + \
+                  "remote_can_create_child=?, last_remote_modifier=?,"
+        if not no_digest and info.digest is not None:
+            query = query + "remote_digest='" + info.digest + "',"
+        query = query + " local_state=?," + \
+                  "remote_state=?, pair_state=?" + version + " WHERE id=?"
+        cursor.execute(query,
+                  (info.uid, info.parent_uid, remote_parent_path, info.name,
+                   info.last_modification_time, info.can_rename, info.can_delete, info.can_update,
+                   info.can_create_child, info.last_contributor, state_code(row.local_state),
+                   state_code(row.remote_state), state_code(pair_state), row.id))
+        if queue:
+            # Check if parent is not in creation
+            parent = cursor.execute("SELECT * FROM States WHERE remote_ref=?", (info.parent_uid,)).fetchone()
+            # Parent can be None if the parent is filtered
+            if (parent is not None and parent.pair_state != "remotely_created") or parent is None:
+                self._queue_pair_state(row.id, info.folderish, pair_state, pair=row)
 
     def _clean_filter_path(self, path):
         if not path.endswith("/"):
             path += "/"
         return path
 
-    def add_path_to_scan(self, path):
-        path = self._clean_filter_path(path)
-        self._lock.acquire()
+    def _add_path_to_scan(self, cursor, path):
         try:
-            con = self._get_write_connection()
-            c = con.cursor()
             # Remove any subchilds as it is gonna be scanned anyway
-            c.execute("DELETE FROM ToRemoteScan WHERE path LIKE ?", (path+'%',))
+            cursor.execute("DELETE FROM ToRemoteScan WHERE path LIKE ?", (path+'%',))
             # ADD IT
-            c.execute("INSERT INTO ToRemoteScan(path) VALUES(?)", (path,))
-            if self.auto_commit:
-                con.commit()
+            cursor.execute("INSERT INTO ToRemoteScan(path) VALUES(?)", (path,))
         except sqlite3.IntegrityError:
             pass
-        finally:
-            self._lock.release()
 
-    def delete_path_to_scan(self, path):
+    def add_path_to_scan(self, path):
         path = self._clean_filter_path(path)
-        self._lock.acquire()
+        self._write(self._add_path_to_scan, path)
+
+    def _delete_path_to_scan(self, cursor, path):
         try:
-            con = self._get_write_connection()
-            c = con.cursor()
             # ADD IT
-            c.execute("DELETE FROM ToRemoteScan WHERE path=?", (path,))
-            if self.auto_commit:
-                con.commit()
+            cursor.execute("DELETE FROM ToRemoteScan WHERE path=?", (path,))
         except sqlite3.IntegrityError:
             pass
-        finally:
-            self._lock.release()
+
+    def delete_path_to_scan(self, path):
+        path = self._clean_filter_path(path)
+        self._write(self._delete_path_to_scan, path)
 
     def get_paths_to_scan(self):
-        c = self._get_read_connection().cursor()
-        return c.execute(u"SELECT * FROM ToRemoteScan").fetchall()
+        return self._select(u"SELECT * FROM ToRemoteScan")
 
-    def add_path_scanned(self, path):
-        path = self._clean_filter_path(path)
-        self._lock.acquire()
+    def _add_path_scanned(self, cursor, path):
         try:
-            con = self._get_write_connection()
-            c = con.cursor()
             # ADD IT
-            c.execute("INSERT INTO RemoteScan(path) VALUES(?)", (path,))
-            if self.auto_commit:
-                con.commit()
+            cursor.execute("INSERT INTO RemoteScan(path) VALUES(?)", (path,))
         except sqlite3.IntegrityError:
             pass
-        finally:
-            self._lock.release()
+
+    def add_path_scanned(self, path):
+        path = self._clean_filter_path(path)
+        self._write(self._add_path_scanned, path)
+
+    def _clean_scanned(self, cursor):
+        cursor.execute("DELETE FROM RemoteScan")
 
     def clean_scanned(self):
-        self._lock.acquire()
-        try:
-            con = self._get_write_connection()
-            c = con.cursor()
-            c.execute("DELETE FROM RemoteScan")
-            if self.auto_commit:
-                con.commit()
-        finally:
-            self._lock.release()
+        self._write(self._clean_scanned)
 
     def is_path_scanned(self, path):
         path = self._clean_filter_path(path)
-        c = self._get_read_connection().cursor()
-        row = c.execute("SELECT COUNT(path) FROM RemoteScan WHERE path=? LIMIT 1", (path,)).fetchone()
+        row = self._select_one("SELECT COUNT(path) FROM RemoteScan WHERE path=? LIMIT 1", (path,))
         return row[0] > 0
 
     def get_previous_sync_file(self, ref, sync_mode=None):
         mode_condition = ""
+        params = []
         if sync_mode is not None:
-            mode_condition = "AND last_transfer='" + sync_mode + "' "
+            mode_condition = "AND last_transfer=? "
+            params.append(state_code(sync_mode))
         state = self.get_normal_state_from_remote(ref)
         if state is None:
             return None
-        c = self._get_read_connection().cursor()
-        return c.execute(u"SELECT * FROM States WHERE last_sync_date>? " + mode_condition + self.get_batch_sync_ignore() + " ORDER BY last_sync_date ASC LIMIT 1", (state.last_sync_date,)).fetchone()
+        return self._select_one(u"SELECT * FROM States WHERE last_sync_date>? " + mode_condition + self.get_batch_sync_ignore() + " ORDER BY last_sync_date ASC LIMIT 1", [state.last_sync_date] + params)
 
     def get_batch_sync_ignore(self):
-        return "AND ( pair_state != 'unsynchronized' AND pair_state != 'conflicted') AND folderish=0 "
+        return "AND pair_state NOT IN (" + _state_codes_sql('unsynchronized', 'conflicted') + ") AND folderish=0 "
 
     def get_next_sync_file(self, ref, sync_mode=None):
         mode_condition = ""
+        params = []
         if sync_mode is not None:
-            mode_condition = "AND last_transfer='" + sync_mode + "' "
+            mode_condition = "AND last_transfer=? "
+            params.append(state_code(sync_mode))
         state = self.get_normal_state_from_remote(ref)
         if state is None:
             return None
-        c = self._get_read_connection().cursor()
-        return c.execute(u"SELECT * FROM States WHERE last_sync_date<? " + mode_condition + self.get_batch_sync_ignore() + " ORDER BY last_sync_date DESC LIMIT 1", (state.last_sync_date,)).fetchone()
+        return self._select_one(u"SELECT * FROM States WHERE last_sync_date<? " + mode_condition + self.get_batch_sync_ignore() + " ORDER BY last_sync_date DESC LIMIT 1", [state.last_sync_date] + params)
 
     def get_next_folder_file(self, ref):
         state = self.get_normal_state_from_remote(ref)
-        c = self._get_read_connection().cursor()
-        return c.execute("SELECT * FROM States WHERE remote_parent_ref=? AND remote_name > ? AND folderish=0 ORDER BY remote_name ASC LIMIT 1", (state.remote_parent_ref,state.remote_name)).fetchone()
+        return self._select_one("SELECT * FROM States WHERE remote_parent_ref=? AND remote_name > ? AND folderish=0 ORDER BY remote_name ASC LIMIT 1", (state.remote_parent_ref,state.remote_name))
 
     def get_previous_folder_file(self, ref):
         state = self.get_normal_state_from_remote(ref)
-        c = self._get_read_connection().cursor()
-        return c.execute("SELECT * FROM States WHERE remote_parent_ref=? AND remote_name < ? AND folderish=0 ORDER BY remote_name DESC LIMIT 1", (state.remote_parent_ref,state.remote_name)).fetchone()
+        return self._select_one("SELECT * FROM States WHERE remote_parent_ref=? AND remote_name < ? AND folderish=0 ORDER BY remote_name DESC LIMIT 1", (state.remote_parent_ref,state.remote_name))
 
     def is_filter(self, path):
         path = self._clean_filter_path(path)
@@ -1387,44 +2589,31 @@ class EngineDAO(ConfigurationDAO):
             return False
 
     def get_filters(self):
-        c = self._get_read_connection().cursor()
-        return c.execute("SELECT * FROM Filters").fetchall()
+        return self._select("SELECT * FROM Filters")
 
     def add_filter(self, path):
         if self.is_filter(path):
             return
         path = self._clean_filter_path(path)
-        self._lock.acquire()
-        try:
-            con = self._get_write_connection()
-            c = con.cursor()
-            # DELETE ANY SUBFILTERS
-            c.execute("DELETE FROM Filters WHERE path LIKE ?", (path + '%',))
-            # PREVENT ANY RESCAN
-            c.execute("DELETE FROM ToRemoteScan WHERE path LIKE ?", (path+'%',))
-            # ADD IT
-            c.execute("INSERT INTO Filters(path) VALUES(?)", (path,))
-            # TODO ADD THIS path AS remotely_deleted
-            if self.auto_commit:
-                con.commit()
-            self._filters = self.get_filters()
-            self._items_count = self.get_syncing_count()
-        finally:
-            self._lock.release()
+        self._write(self._add_filter, path)
+        self._filters = self.get_filters()
+
+    def _add_filter(self, cursor, path):
+        # DELETE ANY SUBFILTERS
+        cursor.execute("DELETE FROM Filters WHERE path LIKE ?", (path + '%',))
+        # PREVENT ANY RESCAN
+        cursor.execute("DELETE FROM ToRemoteScan WHERE path LIKE ?", (path+'%',))
+        # ADD IT
+        cursor.execute("INSERT INTO Filters(path) VALUES(?)", (path,))
+        # TODO ADD THIS path AS remotely_deleted
 
     def remove_filter(self, path):
         path = self._clean_filter_path(path)
-        self._lock.acquire()
-        try:
-            con = self._get_write_connection()
-            c = con.cursor()
-            c.execute("DELETE FROM Filters WHERE path LIKE ?", (path + '%',))
-            if self.auto_commit:
-                con.commit()
-            self._filters = self.get_filters()
-            self._items_count = self.get_syncing_count()
-        finally:
-            self._lock.release()
+        self._write(self._remove_filter, path)
+        self._filters = self.get_filters()
+
+    def _remove_filter(self, cursor, path):
+        cursor.execute("DELETE FROM Filters WHERE path LIKE ?", (path + '%',))
 
     def _escape(self, _str):
         return _str.replace("'", "''")
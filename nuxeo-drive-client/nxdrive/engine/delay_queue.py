@@ -0,0 +1,111 @@
+'''
+Items to retry later, ordered by their due time
+
+The QueueManager errors and postponed pairs, and the BlacklistQueue items share this min-heap:
+the earliest due time is known in O(1) so its consumer can wake exactly then, a push or a pop is O(log n).
+'''
+from threading import Lock
+import heapq
+import itertools
+import time
+
+# The replaced entries are left in the heap, it is rebuilt once they outnumber the scheduled ones
+COMPACT_MIN_SIZE = 1024
+
+
+class DelayQueue(object):
+    '''
+    An item is ready once its due time is past, each id is scheduled once:
+    pushing it again replaces its item and its due time
+    '''
+    def __init__(self):
+        # Heap of [due, sequence, id, item], an entry is current while it is the one of its id
+        self._heap = []
+        self._entries = dict()
+        self._counter = itertools.count()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, item_id):
+        return item_id in self._entries
+
+    def push(self, item_id, item, due):
+        entry = [due, next(self._counter), item_id, item]
+        self._lock.acquire()
+        try:
+            self._entries[item_id] = entry
+            heapq.heappush(self._heap, entry)
+            if len(self._heap) > COMPACT_MIN_SIZE and len(self._heap) > 2 * len(self._entries):
+                self._heap = self._entries.values()
+                heapq.heapify(self._heap)
+        finally:
+            self._lock.release()
+
+    def remove(self, item_id):
+        '''
+        Unschedule the item of the id, return True if any
+        '''
+        self._lock.acquire()
+        try:
+            if self._entries.pop(item_id, None) is None:
+                return False
+            if not self._entries:
+                del self._heap[:]
+            return True
+        finally:
+            self._lock.release()
+
+    def _first(self):
+        # Drop the replaced entries from the top of the heap
+        while self._heap and self._entries.get(self._heap[0][2]) is not self._heap[0]:
+            heapq.heappop(self._heap)
+        return self._heap[0] if self._heap else None
+
+    def get_next_due(self):
+        '''
+        Return the earliest due time, None if empty
+        '''
+        self._lock.acquire()
+        try:
+            entry = self._first()
+            return entry[0] if entry is not None else None
+        finally:
+            self._lock.release()
+
+    def get(self, cur_time=None):
+        '''
+        Remove and return the earliest ready item, None if none is ready
+        '''
+        if cur_time is None:
+            cur_time = time.time()
+        self._lock.acquire()
+        try:
+            entry = self._first()
+            if entry is None or entry[0] >= cur_time:
+                return None
+            heapq.heappop(self._heap)
+            del self._entries[entry[2]]
+            return entry[3]
+        finally:
+            self._lock.release()
+
+    def get_ready(self, cur_time=None):
+        '''
+        Remove and return all the ready items by due time
+        '''
+        if cur_time is None:
+            cur_time = time.time()
+        result = []
+        self._lock.acquire()
+        try:
+            while True:
+                entry = self._first()
+                if entry is None or entry[0] >= cur_time:
+                    return result
+                heapq.heappop(self._heap)
+                del self._entries[entry[2]]
+                result.append(entry[3])
+        finally:
+            self._lock.release()
@@ -9,13 +9,15 @@ from nxdrive.client import LocalClient
 from nxdrive.client import RemoteFileSystemClient
 from nxdrive.client import RemoteFilteredFileSystemClient
 from nxdrive.client import RemoteDocumentClient
+from nxdrive.client.local_copy import LocalCopier, detect_copy_method
 from nxdrive.utils import normalized_path
 from nxdrive.engine.processor import Processor
-from threading import current_thread
+from threading import current_thread, Thread
 from nxdrive.osi import AbstractOSIntegration
 from nxdrive.engine.workers import Worker, ThreadInterrupt, PairInterrupt
+from nxdrive.engine.prefetch import RemoteInfoCache, RemoteInfoPrefetcher
 from nxdrive.engine.activity import Action, FileAction
-from time import sleep
+from time import sleep, time
 WindowsError = None
 try:
     from exceptions import WindowsError
@@ -173,6 +175,10 @@ class Engine(QObject):
         self._threads = list()
         self._client_cache_timestamps = dict()
         self._dao = self._create_dao()
+        self._local_copier = LocalCopier(self._dao.get_config("local_copy_method"))
+        self._vacuum_thread = None
+        self._last_vacuum = time()
+        self.syncCompleted.connect(self._vacuum_dao)
         if binder is not None:
             self.bind(binder)
         self._load_configuration()
@@ -185,6 +191,12 @@ class Engine(QObject):
         self._local_watcher.rootMoved.connect(self.rootMoved)
         self._local_watcher.localScanFinished.connect(self._remote_watcher.run)
         self._queue_manager = self._create_queue_manager(processors)
+        self._remote_info_cache = RemoteInfoCache()
+        self._prefetcher = None
+        fetchers = self._manager.get_prefetch_fetchers()
+        if fetchers > 0:
+            self._prefetcher = RemoteInfoPrefetcher(self, self._dao, self._remote_info_cache, fetchers=fetchers)
+            self.create_thread(worker=self._prefetcher, start_connect=False)
         # Launch queue processors after first remote_watcher pass
         self._remote_watcher.initiate.connect(self._queue_manager.init_processors)
         self._remote_watcher.remoteWatcherStopped.connect(self._queue_manager.shutdown_processors)
@@ -199,7 +211,7 @@ class Engine(QObject):
         # Some conflict can be resolved automatically
         self._dao.newConflict.connect(self.conflict_resolver)
         # Try to resolve conflict on startup
-        for conflict in self._dao.get_conflicts():
+        for conflict in self._dao.iter_conflicts():
             self._conflict_resolver(conflict.id, emit=False)
         # Scan in remote_watcher thread
         self._scanPair.connect(self._remote_watcher.scan_pair)
@@ -425,9 +437,34 @@ class Engine(QObject):
 
     def _create_queue_manager(self, processors):
         from nxdrive.engine.queue_manager import QueueManager
+        core_processors = self._manager.get_core_processors()
         if self._manager.is_debug():
-            return QueueManager(self, self._dao, max_file_processors=2)
-        return QueueManager(self, self._dao)
+            return QueueManager(self, self._dao, max_file_processors=2, core_processors=core_processors)
+        concurrency = None
+        if self._manager.get_adaptive_processors():
+            from nxdrive.engine.concurrency import ConcurrencyController
+            # The limits are the generic processors, two more handle the local and remote files
+            concurrency = ConcurrencyController(processors - 2, min_processors=self.get_min_processors(),
+                                                max_processors=self.get_max_processors())
+        return QueueManager(self, self._dao, max_file_processors=processors, core_processors=core_processors,
+                            concurrency=concurrency)
+
+    def get_min_processors(self):
+        from nxdrive.engine.concurrency import DEFAULT_MIN_PROCESSORS
+        return int(self._dao.get_config("min_processors", DEFAULT_MIN_PROCESSORS))
+
+    def set_min_processors(self, value):
+        self._dao.update_config("min_processors", value)
+
+    def get_max_processors(self):
+        from nxdrive.engine.concurrency import DEFAULT_MAX_PROCESSORS
+        return int(self._dao.get_config("max_processors", DEFAULT_MAX_PROCESSORS))
+
+    def set_max_processors(self, value):
+        self._dao.update_config("max_processors", value)
+
+    def get_remote_info_cache(self):
+        return self._remote_info_cache
 
     def _create_remote_watcher(self, delay):
         from nxdrive.engine.watcher.remote_watcher import RemoteWatcher
@@ -443,7 +480,12 @@ class Engine(QObject):
 
     def _create_dao(self):
         from nxdrive.engine.dao.sqlite import EngineDAO
-        return EngineDAO(self._get_db_file())
+        dao = EngineDAO(self._get_db_file(), wal=self._manager.get_dao_wal())
+        if self._manager.get_dao_writer():
+            dao.start_writer()
+        if self._manager.get_dao_profiling():
+            dao.enable_profiling(self._manager.get_dao_slow_query() / 1000.0)
+        return dao
 
     def get_remote_url(self):
         server_link = self._dao.get_config("server_url", "")
@@ -458,6 +500,13 @@ class Engine(QObject):
     def get_abspath(self, path):
         return self.get_local_client().abspath(path)
 
+    def promote(self, path):
+        # The user opened it, synchronize it first if it is waiting
+        pair = self._dao.get_state_from_local(path)
+        if pair is None:
+            return False
+        return self._queue_manager.promote(pair.id)
+
     def get_binder(self):
         from nxdrive.manager import ServerBindingSettings
         return ServerBindingSettings(server_url=self._server_url,
@@ -594,6 +643,19 @@ class Engine(QObject):
             log.debug('Emitting syncCompleted for engine %s', self.get_uid())
             self.syncCompleted.emit()
 
+    @pyqtSlot()
+    def _vacuum_dao(self):
+        # Release the free pages of the database while the synchronization is idle
+        from nxdrive.engine.dao.sqlite import DEFAULT_VACUUM_INTERVAL
+        if self._vacuum_thread is not None and self._vacuum_thread.is_alive():
+            return
+        if time() - self._last_vacuum < DEFAULT_VACUUM_INTERVAL:
+            return
+        self._last_vacuum = time()
+        self._vacuum_thread = Thread(target=self._dao.incremental_vacuum, name="VacuumThread")
+        self._vacuum_thread.daemon = True
+        self._vacuum_thread.start()
+
     def _thread_finished(self):
         for thread in self._threads:
             if thread == self._local_watcher.get_thread():
@@ -611,6 +673,9 @@ class Engine(QObject):
             raise FsMarkerException()
         # Checking root in case of failed migration
         self._check_root()
+        if self._dao.get_config("local_copy_method") is None:
+            # Bound before the detection
+            self._detect_copy_method()
         self._stopped = False
         Processor.soft_locks = dict()
         log.debug("Engine %s starting", self.get_uid())
@@ -631,16 +696,29 @@ class Engine(QObject):
 
     def get_metrics(self):
         metrics = dict()
-        metrics["sync_folders"] = self._dao.get_sync_count(filetype="folder")
-        metrics["sync_files"] = self._dao.get_sync_count(filetype="file")
-        metrics["syncing"] = self._dao.get_syncing_count()
-        metrics["error_files"] = self._dao.get_error_count()
-        metrics["conflicted_files"] = self._dao.get_conflict_count()
-        metrics["unsynchronized_files"] = self._dao.get_unsynchronized_count()
-        metrics["files_size"] = self._dao.get_global_size()
+        # All the counters are read at once from the StateCounters table
+        counters = self._dao.get_state_counters()
+        metrics["sync_folders"] = counters["sync_folders"]
+        metrics["sync_files"] = counters["sync_files"]
+        metrics["syncing"] = counters["syncing"]
+        metrics["error_files"] = counters["errors"]
+        metrics["conflicted_files"] = counters["conflicts"]
+        metrics["unsynchronized_files"] = counters["unsynchronized"]
+        metrics["files_size"] = counters["sync_size"]
         metrics["invalid_credentials"] = self._invalid_credentials
+        for key, value in self._remote_info_cache.get_metrics().iteritems():
+            metrics["remote_info_cache_" + key] = value
         return metrics
 
+    def get_diagnostics(self):
+        # Kept out of the metrics sent to the tracker, for the logs and the debug report only
+        diagnostics = dict()
+        for key, value in self._dao.get_metrics().iteritems():
+            diagnostics["dao_" + key] = value
+        for key, value in self._local_copier.get_metrics().iteritems():
+            diagnostics["local_copy_" + key] = value
+        return diagnostics
+
     def get_conflicts(self):
         return self._dao.get_conflicts()
 
@@ -795,6 +873,25 @@ class Engine(QObject):
             # If the top level state for the server binding doesn't exist,
             # create the local folder and the top level state.
             self._check_root()
+        if os.path.exists(self._local_folder):
+            self._detect_copy_method()
+
+    def _detect_copy_method(self):
+        # Clone or kernel copy of the local duplicates, depending on the filesystem of the sync root
+        local_client = self.get_local_client()
+        locker = local_client.unlock_path(self._local_folder, False)
+        try:
+            method = detect_copy_method(self._local_folder)
+        finally:
+            local_client.lock_path(self._local_folder, locker)
+        if method is None:
+            return
+        log.debug("Local copies of %s use %s", self._local_folder, method)
+        self._dao.update_config("local_copy_method", method)
+        self._local_copier.method = method
+
+    def get_local_copier(self):
+        return self._local_copier
 
     def _check_fs(self, path):
         if not self._manager.get_osi().is_partition_supported(path):
@@ -950,9 +1047,17 @@ class Engine(QObject):
                         password=self._remote_password,
                         timeout=self.timeout, cookie_jar=self.cookie_jar,
                         token=self._remote_token, check_suspended=self.suspend_client)
+            self._set_bandwidth(remote_client)
             cache[cache_key] = remote_client
         return remote_client
 
+    def _set_bandwidth(self, remote_client):
+        # The transfers of the engine share the bandwidth with the other engines and DirectEdit
+        bandwidth = self._manager.get_bandwidth_scheduler()
+        bandwidth.set_weight(self._uid, self._manager.get_bandwidth_weight(self._uid))
+        remote_client.bandwidth = bandwidth
+        remote_client.bandwidth_flow = self._uid
+
     def get_remote_doc_client(self, repository=DEFAULT_REPOSITORY_NAME, base_folder=None):
         if self._invalid_credentials:
             return None
@@ -968,6 +1073,7 @@ class Engine(QObject):
                 password=self._remote_password, token=self._remote_token,
                 repository=repository, base_folder=base_folder,
                 timeout=self._handshake_timeout, cookie_jar=self.cookie_jar, check_suspended=self.suspend_client)
+            self._set_bandwidth(remote_client)
             cache[cache_key] = remote_client
         return remote_client
 
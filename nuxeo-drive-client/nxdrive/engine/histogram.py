@@ -0,0 +1,119 @@
+'''
+Latency histograms of the processing
+
+The values are counted in buckets of a fixed relative width, like the HDR histograms: the values
+below 2 ** PRECISION_BITS are exact, the others are within 1 / 2 ** (PRECISION_BITS - 1) of their bucket.
+The memory only depends on the range of the values, not on their number.
+'''
+from threading import Lock
+import json
+
+PRECISION_BITS = 6
+# Percentiles of the dumps, the metrics only keep the first and the last
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def get_bucket(value):
+    value = max(int(value), 0)
+    shift = value.bit_length() - PRECISION_BITS
+    if shift <= 0:
+        return value
+    half = 1 << (PRECISION_BITS - 1)
+    return (1 << PRECISION_BITS) + (shift - 1) * half + (value >> shift) - half
+
+
+def get_bucket_value(bucket):
+    '''
+    Return the highest value counted in the bucket
+    '''
+    if bucket < (1 << PRECISION_BITS):
+        return bucket
+    half = 1 << (PRECISION_BITS - 1)
+    shift, top = divmod(bucket - (1 << PRECISION_BITS), half)
+    shift += 1
+    return ((top + half + 1) << shift) - 1
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self._buckets = dict()
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        bucket = get_bucket(value)
+        self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def get_percentile(self, percentile):
+        if not self.count:
+            return None
+        rank = percentile * self.count / 100.0
+        seen = 0
+        for bucket in sorted(self._buckets):
+            seen += self._buckets[bucket]
+            if seen >= rank:
+                return min(get_bucket_value(bucket), self.max)
+        return self.max
+
+    def to_dict(self):
+        result = dict(count=self.count, min=self.min, max=self.max,
+                      mean=float(self.total) / self.count if self.count else None)
+        for percentile in PERCENTILES:
+            result["p%s" % percentile] = self.get_percentile(percentile)
+        return result
+
+
+class HistogramSet(object):
+    '''
+    Histograms by handler and stage, thread safe
+    '''
+    def __init__(self):
+        self._histograms = dict()
+        self._lock = Lock()
+
+    def record(self, handler, stage, value):
+        self._lock.acquire()
+        try:
+            histogram = self._histograms.get((handler, stage))
+            if histogram is None:
+                histogram = self._histograms[(handler, stage)] = Histogram()
+            histogram.record(value)
+        finally:
+            self._lock.release()
+
+    def get(self, handler, stage):
+        return self._histograms.get((handler, stage))
+
+    def to_dict(self):
+        result = dict()
+        self._lock.acquire()
+        try:
+            for (handler, stage), histogram in self._histograms.iteritems():
+                result.setdefault(handler, dict())[stage] = histogram.to_dict()
+        finally:
+            self._lock.release()
+        return result
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2, sort_keys=True)
+
+    def get_metrics(self):
+        metrics = dict()
+        first, last = "p%s" % PERCENTILES[0], "p%s" % PERCENTILES[-1]
+        for handler, stages in self.to_dict().iteritems():
+            for stage, values in stages.iteritems():
+                prefix = "%s_%s_" % (handler, stage)
+                metrics[prefix + "count"] = values["count"]
+                metrics[prefix + first] = values[first]
+                metrics[prefix + last] = values[last]
+                metrics[prefix + "max"] = values["max"]
+        return metrics
@@ -36,8 +36,7 @@ class Processor(OldProcessor):
         # Check if the file is already on the HD
         pair = self._dao.get_valid_duplicate_file(doc_pair.remote_digest)
         if pair:
-            import shutil
-            shutil.copy(local_client.abspath(pair.local_path), file_out)
+            self._engine.get_local_copier().copy(local_client.abspath(pair.local_path), file_out)
             return file_out
         tmp_file = remote_client.stream_content( doc_pair.remote_ref, file_path,
                                 parent_fs_item_id=doc_pair.remote_parent_ref, file_out=file_out)
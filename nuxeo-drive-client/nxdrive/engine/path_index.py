@@ -0,0 +1,76 @@
+'''
+Local paths of the pairs in process, by processor
+
+The watchers ask on each event if a processor works under a path: the paths are kept sorted
+so the ones starting with a prefix are found by bisection instead of asking every processor.
+'''
+from threading import Lock, current_thread
+import bisect
+
+
+class PathIndex(object):
+
+    def __init__(self):
+        # Sorted (path, worker key), the key being the id of the worker
+        self._paths = []
+        # Worker key: (path, worker, folderish, ident of the thread which set it)
+        self._workers = dict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._workers)
+
+    def _remove(self, key):
+        entry = self._workers.pop(key, None)
+        if entry is None:
+            return
+        index = bisect.bisect_left(self._paths, (entry[0], key))
+        del self._paths[index]
+
+    def set(self, worker, path, folderish=False):
+        '''
+        Record the path processed by the worker, None when it is not processing anymore
+        '''
+        key = id(worker)
+        self._lock.acquire()
+        try:
+            self._remove(key)
+            if path is not None:
+                self._workers[key] = (path, worker, folderish, current_thread().ident)
+                bisect.insort(self._paths, (path, key))
+        finally:
+            self._lock.release()
+
+    def remove(self, worker):
+        self.set(worker, None)
+
+    def _find(self, path, exact_match):
+        # Entries of the path, or of all the paths starting with it
+        index = bisect.bisect_left(self._paths, (path,))
+        while index < len(self._paths):
+            current, key = self._paths[index]
+            if current != path and (exact_match or not current.startswith(path)):
+                break
+            yield self._workers[key]
+            index += 1
+
+    def get_workers(self, path, exact_match=True):
+        self._lock.acquire()
+        try:
+            return [entry[1] for entry in self._find(path, exact_match)]
+        finally:
+            self._lock.release()
+
+    def has_files(self, path):
+        '''
+        Return True if another thread processes a file starting with the path
+        '''
+        ident = current_thread().ident
+        self._lock.acquire()
+        try:
+            for _, _, folderish, thread_ident in self._find(path, False):
+                if not folderish and thread_ident != ident:
+                    return True
+            return False
+        finally:
+            self._lock.release()
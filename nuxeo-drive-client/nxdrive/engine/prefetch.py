@@ -0,0 +1,206 @@
+'''
+Prefetch of the remote infos of the queued local changes
+
+Before acting on a locally changed pair known remotely, the processor checks its remote info.
+The RemoteInfoPrefetcher looks ahead in the local queues and gets these infos in parallel, the
+processors take them from the RemoteInfoCache while they are fresh. The remote watcher drops
+the infos of the documents changed on the server.
+
+The remote watcher only sees these changes when it polls, so a prefetched info can miss a change
+made on the server meanwhile. Before uploading over a document whose info was prefetched, the
+processor gets it again: a remote change found then makes the pair a conflict. The prefetch is
+disabled unless the prefetch_fetchers config is set.
+'''
+from nxdrive.engine.workers import PollWorker
+from nxdrive.logging_config import get_logger
+from Queue import Queue
+from threading import Lock, Thread
+import time
+log = get_logger(__name__)
+
+# Time in s a prefetched info can be used
+DEFAULT_REMOTE_INFO_TTL = 10
+# Number of queued local pairs looked at on each poll
+DEFAULT_PREFETCH_LOOKAHEAD = 100
+# Fetcher threads of a prefetcher, the Manager starts none unless configured
+DEFAULT_PREFETCH_FETCHERS = 4
+
+
+class RemoteInfoCache(object):
+
+    def __init__(self, ttl=DEFAULT_REMOTE_INFO_TTL):
+        self._ttl = ttl
+        # Remote ref: (info, fetch time)
+        self._infos = dict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._infos)
+
+    def __contains__(self, ref):
+        entry = self._infos.get(ref)
+        return entry is not None and time.time() - entry[1] <= self._ttl
+
+    def put(self, ref, info, now=None):
+        if now is None:
+            now = time.time()
+        self._lock.acquire()
+        try:
+            self._infos[ref] = (info, now)
+        finally:
+            self._lock.release()
+
+    def pop(self, ref, now=None):
+        '''
+        Remove and return the info of the ref if it is still fresh, None otherwise
+        '''
+        if now is None:
+            now = time.time()
+        self._lock.acquire()
+        try:
+            entry = self._infos.pop(ref, None)
+            if entry is None or now - entry[1] > self._ttl:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[0]
+        finally:
+            self._lock.release()
+
+    def invalidate(self, ref):
+        self._lock.acquire()
+        try:
+            self._infos.pop(ref, None)
+        finally:
+            self._lock.release()
+
+    def clear(self, now=None):
+        '''
+        Remove all the infos, or only the expired ones if now is given
+        '''
+        self._lock.acquire()
+        try:
+            if now is None:
+                self._infos.clear()
+                return
+            for ref, (_, fetched) in self._infos.items():
+                if now - fetched > self._ttl:
+                    del self._infos[ref]
+        finally:
+            self._lock.release()
+
+    def get_metrics(self):
+        return dict(size=len(self._infos), hits=self.hits, misses=self.misses)
+
+
+class RemoteInfoPrefetcher(PollWorker):
+    '''
+    Poll the local queues and feed their remote refs to a fixed pool of fetcher threads
+    '''
+
+    def __init__(self, engine, dao, cache, fetchers=DEFAULT_PREFETCH_FETCHERS,
+                 lookahead=DEFAULT_PREFETCH_LOOKAHEAD, check_interval=1):
+        super(RemoteInfoPrefetcher, self).__init__(check_interval, name="RemoteInfoPrefetcher")
+        self._engine = engine
+        self._dao = dao
+        self._cache = cache
+        self._fetchers = fetchers
+        self._lookahead = lookahead
+        self._refs = Queue()
+        # Refs queued or being fetched
+        self._in_flight = set()
+        self._in_flight_lock = Lock()
+        self._threads = []
+        self._metrics['prefetched'] = 0
+        self._metrics['prefetch_errors'] = 0
+
+    def _get_refs(self):
+        # Remote refs of the next local changes, not already fetched nor being fetched
+        queue_manager = self._engine.get_queue_manager()
+        row_ids = [item.id for item in queue_manager.peek('local_file', self._lookahead)]
+        row_ids.extend(item.id for item in queue_manager.peek('local_folder', self._lookahead))
+        refs = []
+        for doc_pair in self._dao.get_states_from_ids(row_ids):
+            if (doc_pair.remote_ref is not None and doc_pair.pair_state.startswith('locally')
+                    and doc_pair.remote_ref not in self._cache and doc_pair.remote_ref not in self._in_flight):
+                refs.append(doc_pair.remote_ref)
+        return refs
+
+    def _start_fetchers(self):
+        if self._threads:
+            return
+        for _ in range(self._fetchers):
+            thread = Thread(target=self._fetch, name="RemoteInfoFetcher")
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _stop_fetchers(self):
+        for _ in self._threads:
+            self._refs.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _fetch(self):
+        while True:
+            ref = self._refs.get()
+            try:
+                if ref is None:
+                    return
+                self._fetch_ref(ref)
+            finally:
+                if ref is not None:
+                    self._in_flight_lock.acquire()
+                    try:
+                        self._in_flight.discard(ref)
+                    finally:
+                        self._in_flight_lock.release()
+                self._refs.task_done()
+
+    def _fetch_ref(self, ref):
+        # Each fetcher thread has its own client
+        remote_client = self._engine.get_remote_client()
+        if remote_client is None:
+            return
+        try:
+            info = remote_client.get_info(ref, raise_if_missing=False)
+        except Exception as e:
+            # The processor will get it and handle the error
+            log.trace("Cannot prefetch remote info of %s: %r", ref, e)
+            self._metrics['prefetch_errors'] += 1
+            return
+        if info is not None:
+            self._cache.put(ref, info)
+            self._metrics['prefetched'] += 1
+
+    def _poll(self):
+        self._cache.clear(now=time.time())
+        if self._engine.get_remote_client() is None:
+            return False
+        refs = self._get_refs()
+        if not refs:
+            return True
+        log.trace("Prefetching %d remote infos", len(refs))
+        self._start_fetchers()
+        self._in_flight_lock.acquire()
+        try:
+            refs = [ref for ref in refs if ref not in self._in_flight]
+            self._in_flight.update(refs)
+        finally:
+            self._in_flight_lock.release()
+        for ref in refs:
+            self._refs.put(ref)
+        return True
+
+    def _clean(self, reason, e=None):
+        self._stop_fetchers()
+
+    def get_metrics(self):
+        metrics = super(RemoteInfoPrefetcher, self).get_metrics()
+        for key, value in self._cache.get_metrics().iteritems():
+            metrics["cache_" + key] = value
+        metrics["in_flight"] = len(self._in_flight)
+        return metrics
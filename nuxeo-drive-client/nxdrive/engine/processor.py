@@ -10,6 +10,7 @@ from nxdrive.client.common import NotFound
 from nxdrive.client.common import safe_filename
 from nxdrive.osi import AbstractOSIntegration
 from nxdrive.engine.activity import Action
+from nxdrive.engine.concurrency import LocalIOTimer
 from nxdrive.utils import current_milli_time, is_office_temp_file
 from PyQt4.QtCore import pyqtSignal
 from urllib2 import HTTPError
@@ -42,6 +43,9 @@ class Processor(EngineWorker):
         super(Processor, self).__init__(engine, engine.get_dao(), name=name)
         self._current_item = None
         self._current_doc_pair = None
+        self._soft_lock = None
+        # The remote info of the current pair came from the prefetch cache
+        self._prefetched = False
         self._get_item = item_getter
         self._engine = engine
 
@@ -145,116 +149,37 @@ class Processor(EngineWorker):
             # Add it back to the queue ? Add the error delay
             if self._current_doc_pair is not None:
                 self.increase_error(self._current_doc_pair, "EXCEPTION", exception=e)
+        self._set_current_pair(None)
+
+    def _set_current_pair(self, doc_pair):
+        self._current_doc_pair = doc_pair
+        self._engine.get_queue_manager().set_processing(self, doc_pair)
+
+    def _get_next_item(self):
+        # The item getter waits for the next push, the last pair is not in process anymore
+        self._set_current_pair(None)
+        return self._get_item()
 
     def _execute(self):
         self._current_metrics = dict()
-        self._current_item = self._get_item()
-        soft_lock = None
+        self._current_item = self._get_next_item()
         while (self._current_item != None):
             # Take client every time as it is cached in engine
             local_client = self._engine.get_local_client()
             remote_client = self._engine.get_remote_client()
             doc_pair = None
+            stages = self._get_queue_stages(self._current_item)
+            start_time = current_milli_time()
             try:
                 doc_pair = self._dao.acquire_state(self._thread_id, self._current_item.id)
+                stages["acquire_time"] = current_milli_time() - start_time
             except:
                 log.trace("Cannot acquire state for: %r", self._current_item)
                 self._postpone_pair(self._current_item, 'Pair in use', interval=3)
-                self._current_item = self._get_item()
+                self._current_item = self._get_next_item()
                 continue
             try:
-                if doc_pair is None:
-                    log.trace("Didn't acquire state, dropping %r", self._current_item)
-                    self._current_item = self._get_item()
-                    continue
-                log.debug('Executing processor on %r(%d)', doc_pair, doc_pair.version)
-                self._current_doc_pair = doc_pair
-                self._current_temp_file = None
-                if (doc_pair.pair_state == 'synchronized'
-                    or doc_pair.pair_state == 'unsynchronized'
-                    or doc_pair.pair_state is None
-                    or doc_pair.pair_state.startswith('parent_')):
-                    log.trace("Skip as pair is in non-processable state: %r", doc_pair)
-                    self._current_item = self._get_item()
-                    continue
-                if AbstractOSIntegration.is_mac() and local_client.exists(doc_pair.local_path):
-                    try:
-                        finder_info = local_client.get_remote_id(doc_pair.local_path, "com.apple.FinderInfo")
-                        if finder_info is not None and 'brokMACS' in finder_info:
-                            log.trace("Skip as pair is in use by Finder: %r", doc_pair)
-                            self._postpone_pair(doc_pair, 'Finder using file', interval=3)
-                            self._current_item = self._get_item()
-                            continue
-                    except IOError:
-                        pass
-                # TODO Update as the server dont take hash to avoid conflict yet
-                if (doc_pair.pair_state.startswith("locally")
-                        and doc_pair.remote_ref is not None):
-                    try:
-                        remote_info = remote_client.get_info(doc_pair.remote_ref)
-                        if remote_info.digest != doc_pair.remote_digest and doc_pair.remote_digest is not None:
-                            doc_pair.remote_state = 'modified'
-                        self._refresh_remote(doc_pair, remote_client, remote_info)
-                        # Can run into conflict
-                        if doc_pair.pair_state == 'conflicted':
-                            self._current_item = self._get_item()
-                            continue
-                        doc_pair = self._dao.get_state_from_id(doc_pair.id)
-                        if doc_pair is None:
-                            self._current_item = self._get_item()
-                            continue
-                    except NotFound:
-                        doc_pair.remote_ref = None
-                parent_path = doc_pair.local_parent_path
-                if (parent_path == ''):
-                    parent_path = "/"
-                if not local_client.exists(parent_path):
-                    if doc_pair.remote_state == "deleted":
-                        self._dao.remove_state(doc_pair)
-                        continue
-                    self._handle_no_parent(doc_pair, local_client, remote_client)
-                    self._current_item = self._get_item()
-                    continue
-
-                self._current_metrics = dict()
-                handler_name = '_synchronize_' + doc_pair.pair_state
-                self._action = Action(handler_name)
-                sync_handler = getattr(self, handler_name, None)
-                if sync_handler is None:
-                    log.debug("Unhandled pair_state: %r for %r",
-                                       doc_pair.pair_state, doc_pair)
-                    self.increase_error(doc_pair, "ILLEGAL_STATE")
-                    self._current_item = self._get_item()
-                    continue
-                else:
-                    self._current_metrics = dict()
-                    self._current_metrics["handler"] = doc_pair.pair_state
-                    self._current_metrics["start_time"] = current_milli_time()
-                    log.trace("Calling %s on doc pair %r", sync_handler, doc_pair)
-                    try:
-                        soft_lock = self._lock_soft_path(doc_pair.local_path)
-                        sync_handler(doc_pair, local_client, remote_client)
-                        self._current_metrics["end_time"] = current_milli_time()
-                        self.pairSync.emit(doc_pair, self._current_metrics)
-                        # TO_REVIEW May have a call to reset_error
-                        log.trace("Finish %s on doc pair %r", sync_handler, doc_pair)
-                    except ThreadInterrupt:
-                        raise
-                    except PairInterrupt:
-                        from time import sleep
-                        # Wait one second to avoid retrying to quickly
-                        self._current_doc_pair = None
-                        log.debug("PairInterrupt wait 1s and requeue on %r", doc_pair)
-                        sleep(1)
-                        self._engine.get_queue_manager().push(doc_pair)
-                        continue
-                    except Exception as e:
-                        if isinstance(e, IOError) and e.errno == 28:
-                            self._engine.noSpaceLeftOnDevice.emit()
-                        log.exception(e)
-                        self.increase_error(doc_pair, "SYNC HANDLER: %s" % handler_name, exception=e)
-                        self._current_item = self._get_item()
-                        continue
+                self._process_pair(doc_pair, stages, local_client, remote_client)
             except ThreadInterrupt:
                 self._engine.get_queue_manager().push(doc_pair)
                 raise
@@ -263,11 +188,105 @@ class Processor(EngineWorker):
                 self.increase_error(doc_pair, "EXCEPTION", exception=e)
                 raise e
             finally:
-                if soft_lock is not None:
-                    self._unlock_soft_path(soft_lock)
+                # Released before waiting for the next item, the other processors can take the pair
+                if self._soft_lock is not None:
+                    self._unlock_soft_path(self._soft_lock)
+                    self._soft_lock = None
                 self._dao.release_state(self._thread_id)
             self._interact()
-            self._current_item = self._get_item()
+            self._current_item = self._get_next_item()
+
+    def _process_pair(self, doc_pair, stages, local_client, remote_client):
+        if doc_pair is None:
+            log.trace("Didn't acquire state, dropping %r", self._current_item)
+            return
+        log.debug('Executing processor on %r(%d)', doc_pair, doc_pair.version)
+        self._set_current_pair(doc_pair)
+        self._current_temp_file = None
+        if (doc_pair.pair_state == 'synchronized'
+            or doc_pair.pair_state == 'unsynchronized'
+            or doc_pair.pair_state is None
+            or doc_pair.pair_state.startswith('parent_')):
+            log.trace("Skip as pair is in non-processable state: %r", doc_pair)
+            return
+        if AbstractOSIntegration.is_mac() and local_client.exists(doc_pair.local_path):
+            try:
+                finder_info = local_client.get_remote_id(doc_pair.local_path, "com.apple.FinderInfo")
+                if finder_info is not None and 'brokMACS' in finder_info:
+                    log.trace("Skip as pair is in use by Finder: %r", doc_pair)
+                    self._postpone_pair(doc_pair, 'Finder using file', interval=3)
+                    return
+            except IOError:
+                pass
+        self._prefetched = False
+        # TODO Update as the server dont take hash to avoid conflict yet
+        if (doc_pair.pair_state.startswith("locally")
+                and doc_pair.remote_ref is not None):
+            try:
+                start_time = current_milli_time()
+                # Most likely prefetched while the pair was queued
+                remote_info = self._engine.get_remote_info_cache().pop(doc_pair.remote_ref)
+                self._prefetched = remote_info is not None
+                if remote_info is None:
+                    remote_info = remote_client.get_info(doc_pair.remote_ref)
+                stages["remote_info_time"] = current_milli_time() - start_time
+                if remote_info.digest != doc_pair.remote_digest and doc_pair.remote_digest is not None:
+                    doc_pair.remote_state = 'modified'
+                self._refresh_remote(doc_pair, remote_client, remote_info)
+                # Can run into conflict
+                if doc_pair.pair_state == 'conflicted':
+                    return
+                doc_pair = self._dao.get_state_from_id(doc_pair.id)
+                if doc_pair is None:
+                    return
+            except NotFound:
+                doc_pair.remote_ref = None
+        parent_path = doc_pair.local_parent_path
+        if (parent_path == ''):
+            parent_path = "/"
+        if not local_client.exists(parent_path):
+            if doc_pair.remote_state == "deleted":
+                self._dao.remove_state(doc_pair)
+                return
+            self._handle_no_parent(doc_pair, local_client, remote_client)
+            return
+
+        self._current_metrics = dict()
+        handler_name = '_synchronize_' + doc_pair.pair_state
+        self._action = Action(handler_name)
+        sync_handler = getattr(self, handler_name, None)
+        if sync_handler is None:
+            log.debug("Unhandled pair_state: %r for %r",
+                               doc_pair.pair_state, doc_pair)
+            self.increase_error(doc_pair, "ILLEGAL_STATE")
+            return
+        else:
+            self._current_metrics = dict()
+            self._current_metrics["handler"] = doc_pair.pair_state
+            self._current_metrics["start_time"] = current_milli_time()
+            self._current_metrics.update(stages)
+            log.trace("Calling %s on doc pair %r", sync_handler, doc_pair)
+            try:
+                self._soft_lock = self._lock_soft_path(doc_pair.local_path)
+                timed_client = LocalIOTimer(local_client)
+                sync_handler(doc_pair, timed_client, remote_client)
+                self._current_metrics["end_time"] = current_milli_time()
+                self._current_metrics["local_io_time"] = int(timed_client.elapsed * 1000)
+                self.pairSync.emit(doc_pair, self._current_metrics)
+                # TO_REVIEW May have a call to reset_error
+                log.trace("Finish %s on doc pair %r", sync_handler, doc_pair)
+            except ThreadInterrupt:
+                raise
+            except PairInterrupt:
+                # Retry in one second to avoid retrying to quickly, the processor goes on meanwhile
+                self._set_current_pair(None)
+                log.debug("PairInterrupt requeue in 1s on %r", doc_pair)
+                self._engine.get_queue_manager().push_later(doc_pair, interval=1)
+            except Exception as e:
+                if isinstance(e, IOError) and e.errno == 28:
+                    self._engine.noSpaceLeftOnDevice.emit()
+                log.exception(e)
+                self.increase_error(doc_pair, "SYNC HANDLER: %s" % handler_name, exception=e)
 
     def _synchronize_conflicted(self, doc_pair, local_client, remote_client):
         # Auto-resolve conflict
@@ -289,6 +308,16 @@ class Processor(EngineWorker):
             raise PairInterrupt
         self.increase_error(doc_pair, "NO_PARENT")
 
+    def _get_queue_stages(self, item):
+        # Queue timestamps of the item in ms
+        stages = dict()
+        timestamps = getattr(item, 'timestamps', None)
+        if timestamps and "queued" in timestamps:
+            stages["queued"] = int(timestamps["queued"] * 1000)
+            if "dequeued" in timestamps:
+                stages["queue_time"] = int((timestamps["dequeued"] - timestamps["queued"]) * 1000)
+        return stages
+
     def _update_speed_metrics(self):
         action = Action.get_last_file_action()
         if action:
@@ -299,6 +328,9 @@ class Processor(EngineWorker):
             speed = (action.size / duration) * 1000
             log.trace("Transfer speed %d ko/s", speed / 1024)
             self._current_metrics["speed"] = speed
+            self._current_metrics["size"] = action.size
+            self._current_metrics["transfer_time"] = duration
+            self._current_metrics["transfer_end"] = action.end_time
 
     def _synchronize_if_not_remotely_dirty(self, doc_pair, local_client, remote_client, remote_info=None):
             if remote_info is not None and (remote_info.name != doc_pair.local_name
@@ -325,6 +357,8 @@ class Processor(EngineWorker):
                 if doc_pair.local_digest == UNACCESSIBLE_HASH:
                     self._postpone_pair(doc_pair, 'Unaccessible hash')
                     return
+                if self._prefetched and self._is_remotely_modified(doc_pair, remote_client):
+                    return
                 log.debug("Updating remote document '%s'.",
                           doc_pair.local_name)
                 fs_item_info = remote_client.stream_update(
@@ -358,6 +392,18 @@ class Processor(EngineWorker):
             self._dao.update_remote_state(doc_pair, fs_item_info, versionned=False, no_digest=True)
         self._synchronize_if_not_remotely_dirty(doc_pair, local_client, remote_client, remote_info=fs_item_info)
 
+    def _is_remotely_modified(self, doc_pair, remote_client):
+        # The prefetched info can miss a remote change made since it was fetched, check it before overwriting
+        self._prefetched = False
+        remote_info = remote_client.get_info(doc_pair.remote_ref)
+        if remote_info.digest == doc_pair.remote_digest or doc_pair.remote_digest is None:
+            return False
+        log.debug("Remote document '%s' modified since its info was prefetched", doc_pair.remote_name)
+        doc_pair.remote_state = 'modified'
+        # Queued again, as a conflict
+        self._dao.update_remote_state(doc_pair, remote_info, versionned=False)
+        return True
+
     def _get_normal_state_from_remote_ref(self, ref):
         # TODO Select the only states that is not a collection
         return self._dao.get_normal_state_from_remote(ref)
@@ -611,11 +657,10 @@ class Processor(EngineWorker):
         # Check if the file is already on the HD
         pair = self._dao.get_valid_duplicate_file(doc_pair.remote_digest)
         if pair:
-            import shutil
             file_out = self._get_temporary_file(file_path)
             locker = local_client.unlock_path(file_out)
             try:
-                shutil.copy(local_client.abspath(pair.local_path), file_out)
+                self._engine.get_local_copier().copy(local_client.abspath(pair.local_path), file_out)
             finally:
                 local_client.lock_path(file_out, locker)
             return file_out
@@ -901,12 +946,12 @@ class Processor(EngineWorker):
                 if source_pair != target_pair:
                     if target_pair.folderish:
                         # Remove "new" created tree
-                        pairs = self._dao.get_states_from_partial_local(
-                                target_pair.local_path).all()
+                        pairs = self._dao.iter_states_from_partial_local(
+                                target_pair.local_path)
                         for pair in pairs:
                             self._dao.remove_state(pair)
-                        pairs = self._dao.get_states_from_partial_local(
-                                source_pair.local_path).all()
+                        pairs = self._dao.iter_states_from_partial_local(
+                                source_pair.local_path)
                         for pair in pairs:
                             self._dao.synchronize_state(pair)
                     else:
@@ -1,13 +1,24 @@
 from PyQt4.QtCore import QObject, pyqtSignal, pyqtSlot, QTimer
-from Queue import Queue, Empty
+from Queue import Empty
 from nxdrive.logging_config import get_logger
-from nxdrive.engine.processor import Processor
-from threading import Lock, local
+from nxdrive.engine.dao.sqlite import WORK_QUEUE_KINDS
+from nxdrive.engine.scheduler import Scheduler, ScheduledQueue
+from nxdrive.engine.concurrency import DEFAULT_CONCURRENCY_WINDOW
+from nxdrive.engine.delay_queue import DelayQueue
+from nxdrive.engine.path_index import PathIndex
+from nxdrive.engine.histogram import HistogramSet
+from threading import Condition, Lock, current_thread, enumerate as enumerate_threads, local
 from copy import deepcopy
 import time
 log = get_logger(__name__)
 
 WINERROR_CODE_PROCESS_CANNOT_ACCESS_FILE = 32
+# Number of pairs loaded at once from the persistent WorkQueue
+DEFAULT_QUEUE_PAGE_SIZE = 1000
+# Time in s an idle generic processor above the core pool size waits before ending
+DEFAULT_PROCESSORS_IDLE_TIMEOUT = 60
+# Time in s between two checks of the stop conditions by the waiting processors
+PROCESSOR_WAIT_INTERVAL = 1
 
 WindowsError = None
 try:
@@ -17,10 +28,20 @@ except ImportError:
 
 
 class QueueItem(object):
-    def __init__(self, row_id, folderish, pair_state):
+    def __init__(self, row_id, folderish, pair_state, size=None, touched=None, priority=None, local_path=None,
+                 local_parent_path=None):
         self.id = row_id
         self.folderish = folderish
         self.pair_state = pair_state
+        # Folders wait for the processing of their parent, looked up when not given
+        self.local_path = local_path
+        self.local_parent_path = local_parent_path
+        # Time of the processing stages: queued and dequeued
+        self.timestamps = dict()
+        # Hints for the Scheduler
+        self.size = size
+        self.touched = touched
+        self.priority = priority
 
     def __repr__(self):
         return "%s[%s](Folderish:%s, State: %s)" % (
@@ -32,6 +53,7 @@ class QueueManager(QObject):
     # Always create thread from the main thread
     newItem = pyqtSignal(object)
     newError = pyqtSignal(object)
+    newDelay = pyqtSignal()
     newErrorGiveUp = pyqtSignal(object)
     queueEmpty = pyqtSignal()
     queueProcessing = pyqtSignal()
@@ -41,18 +63,40 @@ class QueueManager(QObject):
     '''
     classdocs
     '''
-    def __init__(self, engine, dao, max_file_processors=5):
+    def __init__(self, engine, dao, max_file_processors=5, page_size=DEFAULT_QUEUE_PAGE_SIZE, scheduler=None,
+                 core_processors=0, idle_timeout=DEFAULT_PROCESSORS_IDLE_TIMEOUT, concurrency=None,
+                 concurrency_window=DEFAULT_CONCURRENCY_WINDOW):
         '''
         Constructor
         '''
         super(QueueManager, self).__init__()
         self._dao = dao
         self._engine = engine
-        self._local_folder_queue = Queue()
-        self._local_file_queue = Queue()
-        self._remote_file_queue = Queue()
-        self._remote_folder_queue = Queue()
+        if scheduler is None:
+            scheduler = Scheduler()
+        self._scheduler = scheduler
+        self._local_folder_queue = ScheduledQueue('local_folder', scheduler)
+        self._local_file_queue = ScheduledQueue('local_file', scheduler)
+        self._remote_file_queue = ScheduledQueue('remote_file', scheduler)
+        self._remote_folder_queue = ScheduledQueue('remote_folder', scheduler)
+        self._queues = dict(local_folder=self._local_folder_queue, local_file=self._local_file_queue,
+                            remote_folder=self._remote_folder_queue, remote_file=self._remote_file_queue)
+        # Last (priority, row_id) loaded of each queue, removed once the WorkQueue is exhausted
+        self._queue_pages = dict((kind, (-1, 0)) for kind in WORK_QUEUE_KINDS)
+        self._page_size = page_size
+        self._page_lock = Lock()
+        # The pairs enqueued after are pushed by the DAO
+        self._queue_start = int(time.time())
         self._connected = local()
+        # Folders in process by local path with the processing thread, the folders popped while one of
+        # their ancestors is queued, in process or blocked wait in the blocked folders by the path of
+        # this ancestor: disjoint subtrees and siblings are processed concurrently
+        self._folders_lock = Lock()
+        self._folders_in_process = dict()
+        self._blocked_folders = dict()
+        # Number of blocked folders by local path
+        self._blocked_paths = dict()
+        self._processing = local()
         self._local_folder_enable = True
         self._local_file_enable = True
         self._remote_folder_enable = True
@@ -66,6 +110,18 @@ class QueueManager(QObject):
         self.set_max_processors(max_file_processors)
         self._threads_pool = list()
         self._processors_pool = list()
+        # The processors wait on the condition for the pushes, the generation counts them
+        self._work_condition = Condition()
+        self._work_generation = 0
+        self._waiting_processors = 0
+        self._waiting_generic = 0
+        self._core_processors = core_processors
+        self._idle_timeout = idle_timeout
+        # Adaptive number of generic processors, the ConcurrencyController replaces the fixed maximum
+        self._concurrency = concurrency
+        self._concurrency_window = concurrency_window
+        if concurrency is not None:
+            self._max_processors = concurrency.get_limit()
         self._get_file_lock = Lock()
         # Should not operate on thread while we are inspecting them
         '''
@@ -82,20 +138,33 @@ class QueueManager(QObject):
          AttributeError: 'NoneType' object has no attribute 'worker'
         '''
         self._thread_inspection = Lock()
+        # Local paths of the pairs in process, set by the processors
+        self._in_flight = PathIndex()
 
         # ERROR HANDLING
         self._error_lock = Lock()
         self._on_error_queue = dict()
+        # Retry times of the errors and the postponed pairs, the timer wakes on the earliest
+        self._delay_queue = DelayQueue()
         self._error_timer = QTimer()
+        self._error_timer.setSingleShot(True)
         self._error_timer.timeout.connect(self._on_error_timer)
-        self.newError.connect(self._on_new_error)
+        # Time in ms of the processing stages by pair state
+        self._latency = HistogramSet()
+        self._concurrency_timer = QTimer()
+        self._concurrency_timer.timeout.connect(self._adjust_concurrency)
+        self.newError.connect(self._on_new_delay)
+        self.newDelay.connect(self._on_new_delay)
         self.queueProcessing.connect(self.launch_processors)
         # LAST ACTION
         self._dao.register_queue_manager(self)
+        self._fill_queues()
 
     def init_processors(self):
         log.trace("Init processors")
         self.newItem.connect(self.launch_processors)
+        if self._concurrency is not None:
+            self._concurrency_timer.start(self._concurrency_window * 1000)
         self.queueProcessing.emit()
 
     def shutdown_processors(self):
@@ -105,6 +174,125 @@ class QueueManager(QObject):
         except TypeError:
             # TypeError: disconnect() failed between 'newItem' and 'launch_processors'
             pass
+        self._concurrency_timer.stop()
+        self._notify_processors()
+
+    @pyqtSlot()
+    def _adjust_concurrency(self):
+        backlog = self._local_file_queue.qsize() + self._remote_file_queue.qsize()
+        limit = self._concurrency.adjust(backlog)
+        if limit != self._max_processors:
+            log.debug("Adjusting generic processors from %d to %d, %d files pending",
+                      self._max_processors, limit, backlog)
+            decreased = limit < self._max_processors
+            self._max_processors = limit
+            if decreased:
+                # Wake the waiting generic processors so the ones above the limit end now
+                self._notify_processors()
+            elif backlog:
+                self.queueProcessing.emit()
+
+    @pyqtSlot(object, object)
+    def _on_pair_sync(self, doc_pair, metrics):
+        if self._concurrency is not None:
+            self._concurrency.record_sync(metrics)
+        self._record_latency(metrics)
+
+    def _record_latency(self, metrics):
+        handler = metrics.get("handler")
+        if handler is None:
+            return
+        for stage in ("queue", "acquire", "remote_info", "transfer"):
+            if stage + "_time" in metrics:
+                self._latency.record(handler, stage, metrics[stage + "_time"])
+        end_time = metrics.get("end_time")
+        if end_time is None:
+            return
+        self._latency.record(handler, "handler", end_time - metrics["start_time"])
+        if "transfer_end" in metrics:
+            # Local finalization and DAO updates once the content is transferred
+            self._latency.record(handler, "finalize", end_time - metrics["transfer_end"])
+        if "queued" in metrics:
+            self._latency.record(handler, "total", end_time - metrics["queued"])
+
+    def get_latency(self):
+        '''
+        Return the latency histograms of the processing stages by pair state, as JSON
+        '''
+        return self._latency.to_json()
+
+    def _retire_generic(self):
+        # End the calling generic processor while the pool is above its maximum
+        self._thread_inspection.acquire()
+        try:
+            if len(self._processors_pool) <= self._max_processors:
+                return False
+            ident = current_thread().ident
+            for thread in self._processors_pool:
+                if thread.worker.get_thread_id() == ident:
+                    log.trace("Retiring generic processor, %d for a maximum of %d",
+                              len(self._processors_pool), self._max_processors)
+                    self._processors_pool.remove(thread)
+                    return True
+            return False
+        finally:
+            self._thread_inspection.release()
+
+    def _notify_processors(self):
+        self._work_condition.acquire()
+        try:
+            self._work_generation += 1
+            self._work_condition.notify_all()
+        finally:
+            self._work_condition.release()
+
+    def _wait_item(self, getter, enabled, generic=False):
+        '''
+        Return the next item of the getter, waiting for a push while there is none
+        Return None once the processor must end: its queue is disabled, the engine is stopped or
+        it is a generic processor idle for too long above the core pool size
+        '''
+        self._end_folder()
+        idle_since = None
+        self._work_condition.acquire()
+        try:
+            while True:
+                generation = self._work_generation
+                self._work_condition.release()
+                try:
+                    # A lowered maximum also ends the generic processors already waiting
+                    if generic and self._retire_generic():
+                        return None
+                    item = getter()
+                finally:
+                    self._work_condition.acquire()
+                if item is not None:
+                    return item
+                if not enabled() or self._disable or self._engine.is_stopped():
+                    return None
+                now = time.time()
+                if idle_since is None:
+                    idle_since = now
+                elif (generic and now - idle_since > self._idle_timeout
+                        and self._waiting_generic >= self._core_processors):
+                    log.trace("Ending idle generic processor, %d waiting", self._waiting_generic)
+                    return None
+                if generation != self._work_generation:
+                    continue
+                self._waiting_processors += 1
+                if generic:
+                    self._waiting_generic += 1
+                try:
+                    if now == idle_since:
+                        # Let the main thread check if the processing is finished
+                        self.newItem.emit(None)
+                    self._work_condition.wait(PROCESSOR_WAIT_INTERVAL)
+                finally:
+                    self._waiting_processors -= 1
+                    if generic:
+                        self._waiting_generic -= 1
+        finally:
+            self._work_condition.release()
 
     def init_queue(self, queue):
         # Dont need to change modify as State is compatible with QueueItem
@@ -112,10 +300,33 @@ class QueueManager(QObject):
             self.push(item)
 
     def _copy_queue(self, queue):
-        result = deepcopy(queue.queue)
+        result = deepcopy(queue.get_items())
         result.reverse()
         return result
 
+    def get_scheduler(self):
+        return self._scheduler
+
+    def peek(self, kind, count):
+        '''
+        Return the next count items of the queue kind, they stay queued
+        '''
+        return self._queues[kind].peek(count)
+
+    def promote(self, row_id):
+        '''
+        Process the pair before the others, as the user is waiting for it
+        '''
+        self._scheduler.promote(row_id)
+        found = False
+        for queue in self._queues.values():
+            found = queue.update_priority(row_id) or found
+        if not found:
+            # Only the queued pairs stay promoted until dequeued
+            self._scheduler.demote(row_id)
+        log.debug("Promoted pair %d, queued: %r", row_id, found)
+        return found
+
     def set_max_processors(self, max_file_processors):
         if max_file_processors < 2:
             max_file_processors = 2
@@ -147,6 +358,7 @@ class QueueManager(QObject):
         self._local_file_enable = value
         if self._local_file_thread is not None and not value:
             self._local_file_thread.quit()
+            self._notify_processors()
         if value and emit:
             self.queueProcessing.emit()
 
@@ -154,6 +366,7 @@ class QueueManager(QObject):
         self._local_folder_enable = value
         if self._local_folder_thread is not None and not value:
             self._local_folder_thread.quit()
+            self._notify_processors()
         if value and emit:
             self.queueProcessing.emit()
 
@@ -161,6 +374,7 @@ class QueueManager(QObject):
         self._remote_file_enable = value
         if self._remote_file_thread is not None and not value:
             self._remote_file_thread.quit()
+            self._notify_processors()
         if value and emit:
             self.queueProcessing.emit()
 
@@ -168,6 +382,7 @@ class QueueManager(QObject):
         self._remote_folder_enable = value
         if self._remote_folder_thread is not None and not value:
             self._remote_folder_thread.quit()
+            self._notify_processors()
         if value and emit:
             self.queueProcessing.emit()
 
@@ -183,15 +398,57 @@ class QueueManager(QObject):
     def get_remote_folder_queue(self):
         return self._copy_queue(self._remote_folder_queue)
 
-    def push_ref(self, row_id, folderish, pair_state):
-        self.push(QueueItem(row_id, folderish, pair_state))
+    def _fill_queue(self, kind):
+        pairs = []
+        self._page_lock.acquire()
+        try:
+            queue = self._queues[kind]
+            after = self._queue_pages.get(kind)
+            if after is None or not queue.empty():
+                return
+            pairs = self._dao.get_work_queue(kind, after, self._queue_start, self._page_size)
+            if len(pairs) < self._page_size:
+                del self._queue_pages[kind]
+            else:
+                self._queue_pages[kind] = (pairs[-1].priority, pairs[-1].id)
+            log.trace("Loaded %d pairs in %s queue", len(pairs), kind)
+            for pair in pairs:
+                item = QueueItem(pair.id, pair.folderish, pair.pair_state, size=pair.size,
+                                 touched=pair.enqueue_time, priority=pair.priority, local_path=pair.local_path,
+                                 local_parent_path=pair.local_parent_path)
+                # The persistent queue keeps the time of the push
+                item.timestamps["queued"] = pair.enqueue_time
+                queue.put(item)
+        finally:
+            self._page_lock.release()
+        if pairs:
+            self._notify_processors()
+
+    def _fill_queues(self):
+        for kind in WORK_QUEUE_KINDS:
+            self._fill_queue(kind)
+
+    def push_ref(self, row_id, folderish, pair_state, size=None, local_path=None, local_parent_path=None):
+        self.push(QueueItem(row_id, folderish, pair_state, size=size, touched=int(time.time()),
+                            local_path=local_path, local_parent_path=local_parent_path))
 
     def push(self, state):
         if state.pair_state is None:
             log.trace("Don't push an empty pair_state: %r", state)
             return
+        if not isinstance(state, QueueItem):
+            # The pairs are queued as QueueItem to carry the stage timestamps
+            state = QueueItem(state.id, state.folderish, state.pair_state, size=getattr(state, 'size', None),
+                              local_path=getattr(state, 'local_path', None),
+                              local_parent_path=getattr(state, 'local_parent_path', None))
+        state.timestamps.setdefault("queued", time.time())
         log.trace("Pushing %r", state)
         row_id = state.id
+        # A pair is queued once, in the queue of its last state
+        kind = self._get_queue_kind(state)
+        for queue_kind, queue in self._queues.items():
+            if queue_kind != kind and queue.discard(row_id):
+                log.trace("Removed %r from %s queue", state, queue_kind)
         if state.pair_state.startswith('locally'):
             if state.folderish:
                 self._local_folder_queue.put(state)
@@ -215,29 +472,64 @@ class QueueManager(QObject):
         else:
             # deleted and conflicted
             log.debug("Not processable state: %r", state)
+            self._scheduler.demote(row_id)
+            return
+        self._notify_processors()
+
+    def _get_queue_kind(self, state):
+        if state.pair_state.startswith('locally'):
+            side = 'local'
+        elif state.pair_state.startswith('remotely'):
+            side = 'remote'
+        else:
+            return None
+        return side + ('_folder' if state.folderish else '_file')
 
     @pyqtSlot()
     def _on_error_timer(self):
-        cur_time = int(time.time())
-        self._error_lock.acquire()
-        try:
-            for doc_pair in self._on_error_queue.values():
-                if doc_pair.error_next_try < cur_time:
-                    queueItem = QueueItem(doc_pair.id, doc_pair.folderish, doc_pair.pair_state)
-                    del self._on_error_queue[doc_pair.id]
+        for doc_pair in self._delay_queue.get_ready():
+            self._error_lock.acquire()
+            try:
+                if self._on_error_queue.pop(doc_pair.id, None) is not None:
                     log.debug('End of blacklist period, pushing doc_pair: %r', doc_pair)
-                    self.push(queueItem)
-            if len(self._on_error_queue) == 0:
-                self._error_timer.stop()
-        finally:
-            self._error_lock.release()
+            finally:
+                self._error_lock.release()
+            self.push(QueueItem(doc_pair.id, doc_pair.folderish, doc_pair.pair_state, size=doc_pair.size,
+                                local_path=getattr(doc_pair, 'local_path', None),
+                                local_parent_path=getattr(doc_pair, 'local_parent_path', None)))
+        self._on_new_delay()
 
     def _is_on_error(self, row_id):
         return row_id in self._on_error_queue
 
     @pyqtSlot()
-    def _on_new_error(self):
-        self._error_timer.start(1000)
+    def _on_new_delay(self):
+        # Wake when the earliest delayed pair is due
+        next_try = self._delay_queue.get_next_due()
+        if next_try is None:
+            self._error_timer.stop()
+            return
+        self._error_timer.start(max(int((next_try - time.time()) * 1000), 0) + 1)
+
+    def _add_error(self, doc_pair):
+        self._error_lock.acquire()
+        try:
+            emit_sig = doc_pair.id not in self._on_error_queue
+            self._on_error_queue[doc_pair.id] = doc_pair
+            self._delay_queue.push(doc_pair.id, doc_pair, doc_pair.error_next_try)
+            if emit_sig:
+                self.newError.emit(doc_pair.id)
+            else:
+                self.newDelay.emit()
+        finally:
+            self._error_lock.release()
+
+    def push_later(self, doc_pair, interval=1):
+        '''
+        Push the pair again after interval seconds, without blacklisting it meanwhile
+        '''
+        self._delay_queue.push(doc_pair.id, doc_pair, time.time() + interval)
+        self.newDelay.emit()
 
     def get_errors_count(self):
         return len(self._on_error_queue)
@@ -246,6 +538,8 @@ class QueueManager(QObject):
         return self._error_threshold
 
     def push_error(self, doc_pair, exception=None, interval=None):
+        if self._concurrency is not None:
+            self._concurrency.record_error(exception)
         error_count = doc_pair.error_count
         if (exception is not None and type(exception) == WindowsError
             and hasattr(exception, 'winerror') and exception.winerror == WINERROR_CODE_PROCESS_CANNOT_ACCESS_FILE):
@@ -261,86 +555,195 @@ class QueueManager(QObject):
             interval = self._error_interval * error_count
         doc_pair.error_next_try = interval + int(time.time())
         log.debug("Blacklisting pair for %ds: %r", interval, doc_pair)
-        self._error_lock.acquire()
-        try:
-            emit_sig = False
-            if doc_pair.id not in self._on_error_queue:
-                emit_sig = True
-            self._on_error_queue[doc_pair.id] = doc_pair
-            if emit_sig:
-                self.newError.emit(doc_pair.id)
-        finally:
-            self._error_lock.release()
+        self._add_error(doc_pair)
 
     def requeue_errors(self):
         self._error_lock.acquire()
         try:
             for doc_pair in self._on_error_queue.values():
                 doc_pair.error_next_try = 0
+                self._delay_queue.push(doc_pair.id, doc_pair, 0)
         finally:
             self._error_lock.release()
+        self.newDelay.emit()
+
+    def _pop(self, kind):
+        self._fill_queue(kind)
+        queue = self._queues[kind]
+        # A folder is popped and marked at once, its children cannot start in between
+        folders = kind.endswith('_folder')
+        while True:
+            if folders:
+                self._folders_lock.acquire()
+            try:
+                try:
+                    state = queue.get_nowait()
+                except Empty:
+                    if folders and self._requeue_orphan_folders():
+                        continue
+                    return None
+                state.timestamps["dequeued"] = time.time()
+                if self._is_on_error(state.id):
+                    if state.folderish and state.local_path is not None:
+                        self._requeue_blocked_folders([state.local_path])
+                    continue
+                if not state.folderish or self._start_folder(state):
+                    return state
+            finally:
+                if folders:
+                    self._folders_lock.release()
+
+    def _get_folder_paths(self, state):
+        if state.local_path is None:
+            doc_pair = self._dao.get_state_from_id(state.id)
+            if doc_pair is None:
+                return None, None
+            state.local_path = doc_pair.local_path
+            state.local_parent_path = doc_pair.local_parent_path
+        return state.local_path, state.local_parent_path
+
+    def _get_pending_ancestor(self, path):
+        # Nearest ancestor in process, blocked or queued
+        while path:
+            if (path in self._folders_in_process or path in self._blocked_paths
+                    or self._local_folder_queue.has_path(path) or self._remote_folder_queue.has_path(path)):
+                return path
+            if path == '/':
+                break
+            path = path.rsplit('/', 1)[0] or '/'
+        return None
+
+    def _start_folder(self, state):
+        '''
+        Mark the folder in process by the calling thread, return False if it waits for an ancestor
+        The caller holds the folders lock
+        '''
+        local_path, parent_path = self._get_folder_paths(state)
+        if local_path is None:
+            return True
+        ancestor = self._get_pending_ancestor(parent_path)
+        if ancestor is not None:
+            log.trace("Waiting for the processing of %r: %r", ancestor, state)
+            self._blocked_folders.setdefault(ancestor, []).append(state)
+            self._blocked_paths[local_path] = self._blocked_paths.get(local_path, 0) + 1
+            return False
+        self._folders_in_process[local_path] = current_thread().ident
+        self._processing.folder = local_path
+        return True
 
-    def _get_local_folder(self):
-        if self._local_folder_queue.empty():
-            return None
+    def _requeue_blocked_folders(self, paths):
+        '''
+        Put back in their queue the folders waiting for these paths, they are checked again once popped
+        The caller holds the folders lock
+        '''
+        children = []
+        for local_path in paths:
+            children.extend(self._blocked_folders.pop(local_path, []))
+        for child in children:
+            count = self._blocked_paths.get(child.local_path, 0) - 1
+            if count > 0:
+                self._blocked_paths[child.local_path] = count
+            else:
+                self._blocked_paths.pop(child.local_path, None)
+            self._queues[self._get_queue_kind(child)].put(child)
+        return len(children)
+
+    def _requeue_orphan_folders(self):
+        # The folders waiting for an ancestor which left the queues without being processed,
+        # dropped on error, renamed or moved meanwhile
+        orphans = [path for path in self._blocked_folders
+                   if self._get_pending_ancestor(path) != path]
+        return self._requeue_blocked_folders(orphans)
+
+    def _end_folder(self):
+        # The last folder of the calling thread is processed, its waiting children can run
+        local_path = getattr(self._processing, 'folder', None)
+        if local_path is None:
+            return
+        self._processing.folder = None
+        self._release_folders([local_path])
+
+    def _release_folders(self, paths):
+        self._folders_lock.acquire()
+        try:
+            for local_path in paths:
+                self._folders_in_process.pop(local_path, None)
+            released = self._requeue_blocked_folders(paths)
+        finally:
+            self._folders_lock.release()
+        if released:
+            self._notify_processors()
+
+    def _release_dead_folders(self):
+        # The folders of a processor ended on an exception
+        alive = set(thread.ident for thread in enumerate_threads())
+        self._folders_lock.acquire()
         try:
-            state = self._local_folder_queue.get(True, 3)
-        except Empty:
+            paths = [path for path, ident in self._folders_in_process.items() if ident not in alive]
+        finally:
+            self._folders_lock.release()
+        if paths:
+            self._release_folders(paths)
+
+    def _pop_folder(self):
+        self._fill_queue('local_folder')
+        self._fill_queue('remote_folder')
+        sides = []
+        if not self._local_folder_queue.empty():
+            sides.append('local')
+        if not self._remote_folder_queue.empty():
+            sides.append('remote')
+        side = self._scheduler.choose(sides)
+        if side is None:
             return None
-        if state is not None and self._is_on_error(state.id):
-            return self._get_local_folder()
+        state = self._pop(side + '_folder')
+        if state is None:
+            state = self._pop(('local' if side == 'remote' else 'remote') + '_folder')
         return state
 
-    def _get_local_file(self):
-        if self._local_file_queue.empty():
-            return None
+    def _pop_file(self):
+        # The generic processors help on the folders first, the files of a new folder need it
+        state = self._pop_folder()
+        if state is not None:
+            return state
+        self._fill_queue('local_file')
+        self._fill_queue('remote_file')
+        self._get_file_lock.acquire()
         try:
-            state = self._local_file_queue.get(True, 3)
-        except Empty:
-            return None
-        if state is not None and self._is_on_error(state.id):
-            return self._get_local_file()
-        return state
+            sides = []
+            if not self._local_file_queue.empty():
+                sides.append('local')
+            if not self._remote_file_queue.empty():
+                sides.append('remote')
+            side = self._scheduler.choose(sides)
+            if side is None:
+                return None
+            state = self._pop(side + '_file')
+            if state is None:
+                # Emptied meanwhile by a dedicated processor
+                state = self._pop(('local' if side == 'remote' else 'remote') + '_file')
+            return state
+        finally:
+            self._get_file_lock.release()
+
+    def _get_local_folder(self):
+        return self._wait_item(lambda: self._pop('local_folder'), lambda: self._local_folder_enable)
+
+    def _get_local_file(self):
+        return self._wait_item(lambda: self._pop('local_file'), lambda: self._local_file_enable)
 
     def _get_remote_folder(self):
-        if self._remote_folder_queue.empty():
-            return None
-        try:
-            state = self._remote_folder_queue.get(True, 3)
-        except Empty:
-            return None
-        if state is not None and self._is_on_error(state.id):
-            return self._get_remote_folder()
-        return state
+        return self._wait_item(lambda: self._pop('remote_folder'), lambda: self._remote_folder_enable)
 
     def _get_remote_file(self):
-        if self._remote_file_queue.empty():
-            return None
-        try:
-            state = self._remote_file_queue.get(True, 3)
-        except Empty:
-            return None
-        if state is not None and self._is_on_error(state.id):
-            return self._get_remote_file()
-        return state
+        return self._wait_item(lambda: self._pop('remote_file'), lambda: self._remote_file_enable)
 
     def _get_file(self):
-        self._get_file_lock.acquire()
-        if self._remote_file_queue.empty() and self._local_file_queue.empty():
-            self._get_file_lock.release()
-            return None
-        state = None
-        if (self._remote_file_queue.qsize() > self._local_file_queue.qsize()):
-            state = self._get_remote_file()
-        else:
-            state = self._get_local_file()
-        self._get_file_lock.release()
-        if state is not None and self._is_on_error(state.id):
-            return self._get_file()
-        return state
+        return self._wait_item(self._pop_file, lambda: not self.is_paused(), generic=True)
 
     @pyqtSlot()
     def _thread_finished(self):
+        self._release_dead_folders()
         self._thread_inspection.acquire()
         try:
             for thread in self._processors_pool:
@@ -369,14 +772,15 @@ class QueueManager(QObject):
         return self.is_active()
 
     def is_active(self):
-        return (self._local_folder_thread is not None
-                or self._local_file_thread is not None
-                or self._remote_file_thread is not None
-                or self._remote_folder_thread is not None
-                or len(self._processors_pool) > 0)
+        # The processors waiting for a push are idle
+        processors = len([thread for thread in (self._local_folder_thread, self._local_file_thread,
+                                                self._remote_folder_thread, self._remote_file_thread)
+                          if thread is not None])
+        return processors + len(self._processors_pool) > self._waiting_processors
 
     def _create_thread(self, item_getter, name=None):
         processor = self._engine.create_processor(item_getter, name=name)
+        processor.pairSync.connect(self._on_pair_sync)
         thread = self._engine.create_thread(worker=processor)
         thread.finished.connect(self._thread_finished)
         thread.terminated.connect(self._thread_finished)
@@ -397,72 +801,61 @@ class QueueManager(QObject):
         metrics["total_queue"] = (metrics["local_folder_queue"] + metrics["local_file_queue"]
                                 + metrics["remote_folder_queue"] + metrics["remote_file_queue"])
         metrics["additional_processors"] = len(self._processors_pool)
+        metrics["core_processors"] = self._core_processors
+        metrics["waiting_processors"] = self._waiting_processors
+        metrics["max_processors"] = self._max_processors
+        metrics["folders_in_process"] = len(self._folders_in_process)
+        metrics["blocked_folders"] = self.get_blocked_folders_count()
+        if self._concurrency is not None:
+            for key, value in self._concurrency.get_metrics().iteritems():
+                metrics["concurrency_" + key] = value
+        metrics["work_queue"] = self._dao.get_work_queue_size()
+        metrics["coalesced_items"] = sum(queue.coalesced for queue in self._queues.values())
+        for key, value in self._scheduler.get_metrics().iteritems():
+            metrics["scheduler_" + key] = value
+        for key, value in self._latency.get_metrics().iteritems():
+            metrics["latency_" + key] = value
         return metrics
 
+    def get_blocked_folders_count(self):
+        self._folders_lock.acquire()
+        try:
+            return sum(len(children) for children in self._blocked_folders.values())
+        finally:
+            self._folders_lock.release()
+
     def get_overall_size(self):
         return (self._local_folder_queue.qsize() + self._local_file_queue.qsize()
-                + self._remote_folder_queue.qsize() + self._remote_file_queue.qsize())
+                + self._remote_folder_queue.qsize() + self._remote_file_queue.qsize()
+                + self.get_blocked_folders_count())
 
-    def is_processing_file(self, worker, path, exact_match=False):
-        if not isinstance(worker, Processor):
-            return False
-        doc_pair = worker.get_current_pair()
-        if (doc_pair is None or doc_pair.local_path is None):
-            return False
-        if exact_match:
-            result = doc_pair.local_path == path
+    def set_processing(self, worker, doc_pair):
+        '''
+        Record the pair in process by the worker, None once it is done
+        '''
+        if doc_pair is None or doc_pair.local_path is None:
+            self._in_flight.remove(worker)
         else:
-            result = doc_pair.local_path.startswith(path)
-        if result:
-            log.trace("Worker(%r) is processing: %r", worker.get_metrics(), path)
-        return result
+            self._in_flight.set(worker, doc_pair.local_path, folderish=doc_pair.folderish)
 
     def interrupt_processors_on(self, path, exact_match=True):
         for proc in self.get_processors_on(path, exact_match):
             proc.stop()
 
     def get_processors_on(self, path, exact_match=True):
-        self._thread_inspection.acquire()
-        try:
-            res = []
-            if self._local_folder_thread is not None:
-                if self.is_processing_file(self._local_folder_thread.worker, path, exact_match):
-                    res.append(self._local_folder_thread.worker)
-            if self._remote_folder_thread is not None:
-                if self.is_processing_file(self._remote_folder_thread.worker, path, exact_match):
-                    res.append(self._remote_folder_thread.worker)
-            if self._local_file_thread is not None:
-                if self.is_processing_file(self._local_file_thread.worker, path, exact_match):
-                    res.append(self._local_file_thread.worker)
-            if self._remote_file_thread is not None:
-                if self.is_processing_file(self._remote_file_thread.worker, path, exact_match):
-                    res.append(self._remote_file_thread.worker)
-            for thread in self._processors_pool:
-                if self.is_processing_file(thread.worker, path, exact_match):
-                    res.append(thread.worker)
-            return res
-        finally:
-            self._thread_inspection.release()
+        res = self._in_flight.get_workers(path, exact_match)
+        if res:
+            log.trace("Workers(%r) are processing: %r", res, path)
+        return res
 
     def has_file_processors_on(self, path):
-        self._thread_inspection.acquire()
-        try:
-            # First check local and remote file
-            if self._local_file_thread is not None:
-                if self.is_processing_file(self._local_file_thread.worker, path):
-                    return True
-            if self._remote_file_thread is not None:
-                if self.is_processing_file(self._remote_file_thread.worker, path):
-                    return True
-            for thread in self._processors_pool:
-                if self.is_processing_file(thread.worker, path):
-                    return True
-            return False
-        finally:
-            self._thread_inspection.release()
+        # The generic processors handle folders too: look at the kind of the pairs instead of the
+        # processors, and skip the caller own pair so a processor locking its folder does not wait for itself
+        return self._in_flight.has_files(path)
 
     @pyqtSlot()
     def launch_processors(self):
+        self._fill_queues()
         if (self._disable or self.is_paused() or (self._local_folder_queue.empty() and self._local_file_queue.empty()
                 and self._remote_folder_queue.empty() and self._remote_file_queue.empty())):
             self.queueEmpty.emit()
@@ -482,7 +875,7 @@ class QueueManager(QObject):
         if self._remote_file_thread is None and not self._remote_file_queue.empty() and self._remote_file_enable:
             log.debug("creating remote file processor")
             self._remote_file_thread = self._create_thread(self._get_remote_file, name="RemoteFileProcessor")
-        if self._remote_file_queue.qsize() + self._local_file_queue.qsize() == 0:
+        if self.get_overall_size() == 0:
             return
         while len(self._processors_pool) < self._max_processors:
             log.debug("creating additional file processor")
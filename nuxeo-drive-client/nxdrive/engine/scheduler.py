@@ -0,0 +1,242 @@
+'''
+Order of the QueueManager processing queues
+
+The Scheduler gives the priority of each queued pair and shares the generic processors
+between the local and the remote work, extend it to change the order of the processing.
+'''
+from Queue import Queue
+from threading import Lock
+import heapq
+import itertools
+import time
+
+# Pairs of a size class are processed before the ones of the next class,
+# the classes are powers of SIZE_CLASS_BASE bytes: 16 B, 256 B, 4 KB, 64 KB, 1 MB...
+SIZE_CLASS_BASE_BITS = 4
+# Class of the pairs which size is unknown, like the remote creations
+UNKNOWN_SIZE_CLASS = 0
+
+
+def get_size_class(size):
+    if not size:
+        return UNKNOWN_SIZE_CLASS
+    return (int(size).bit_length() + SIZE_CLASS_BASE_BITS - 1) // SIZE_CLASS_BASE_BITS
+
+
+def get_depth(item):
+    # As the WorkQueue priority: the number of / in the local path
+    local_path = getattr(item, 'local_path', None)
+    if local_path is not None:
+        return local_path.count('/')
+    return getattr(item, 'priority', None) or 0
+
+
+class Scheduler(object):
+    '''
+    Default priorities: the promoted pairs first, then the shallower folders and the smaller files
+    whatever their depth, then the least recently touched pairs, the FIFO order is kept for the
+    equal priorities
+
+    The least recently touched pairs go first rather than the most recent ones: a pair touched
+    again and again, like a file being written, would otherwise starve the others of its class,
+    a pair the user is waiting for is promoted instead
+    '''
+    def __init__(self, local_weight=1, remote_weight=1):
+        self._weights = dict(local=local_weight, remote=remote_weight)
+        self._served = dict(local=0, remote=0)
+        self._promoted = set()
+        self._lock = Lock()
+        # Wait times of the dequeued items by class: count, total and max in s
+        self._waits = dict()
+
+    def get_priority(self, kind, item):
+        promoted = 0 if item.id in self._promoted else 1
+        touched = getattr(item, 'touched', None) or 0
+        if item.folderish:
+            # A folder is needed by its children, the shallower ones unblock more pairs
+            return (promoted, get_depth(item), touched)
+        # A deep small file must not wait behind a big shallow one
+        return (promoted, get_size_class(getattr(item, 'size', None)), touched)
+
+    def get_class(self, kind, priority):
+        if priority[0] == 0:
+            return 'promoted'
+        return kind
+
+    def is_promoted(self, row_id):
+        return row_id in self._promoted
+
+    def promote(self, row_id):
+        self._promoted.add(row_id)
+
+    def demote(self, row_id):
+        self._promoted.discard(row_id)
+
+    def dequeued(self, kind, item, priority, wait):
+        self._promoted.discard(item.id)
+        self._lock.acquire()
+        try:
+            stats = self._waits.setdefault(self.get_class(kind, priority), [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += wait
+            stats[2] = max(stats[2], wait)
+        finally:
+            self._lock.release()
+
+    def choose(self, sides):
+        '''
+        Return the side, local or remote, a generic processor should serve among the ones having work
+        Each side is served proportionally to its weight
+        '''
+        if not sides:
+            return None
+        self._lock.acquire()
+        try:
+            side = min(sides, key=lambda side: float(self._served[side]) / self._weights[side])
+            self._served[side] += 1
+            return side
+        finally:
+            self._lock.release()
+
+    def get_metrics(self):
+        metrics = dict()
+        self._lock.acquire()
+        try:
+            for name, (count, total, longest) in self._waits.iteritems():
+                metrics[name + "_wait_count"] = count
+                metrics[name + "_wait_avg"] = total / count
+                metrics[name + "_wait_max"] = longest
+        finally:
+            self._lock.release()
+        metrics["promoted"] = len(self._promoted)
+        return metrics
+
+
+class ScheduledQueue(Queue):
+    '''
+    Queue returning the items by the priority given by the scheduler
+
+    A pair is queued once: pushing it again replaces the queued item and its priority,
+    it keeps its place among the equal priorities and its enqueue time
+    '''
+    def __init__(self, kind, scheduler):
+        self.kind = kind
+        self._scheduler = scheduler
+        # Number of pushes merged in an already queued item
+        self.coalesced = 0
+        Queue.__init__(self)
+
+    def _init(self, maxsize):
+        # Heap of [priority, sequence, enqueue time, item], the replaced entries have a None item
+        self.queue = []
+        self._entries = dict()
+        self._counter = itertools.count()
+        # Number of queued folders by local path
+        self._paths = dict()
+
+    def _add_path(self, item):
+        local_path = getattr(item, 'local_path', None)
+        if local_path is not None and item.folderish:
+            self._paths[local_path] = self._paths.get(local_path, 0) + 1
+
+    def _remove_path(self, item):
+        local_path = getattr(item, 'local_path', None)
+        if local_path is None or not item.folderish:
+            return
+        count = self._paths.get(local_path, 0) - 1
+        if count > 0:
+            self._paths[local_path] = count
+        else:
+            self._paths.pop(local_path, None)
+
+    def _qsize(self, len=len):
+        return len(self._entries)
+
+    def _push_entry(self, item, sequence, enqueued):
+        entry = [self._scheduler.get_priority(self.kind, item), sequence, enqueued, item]
+        self._entries[item.id] = entry
+        self._add_path(item)
+        heapq.heappush(self.queue, entry)
+
+    def _put(self, item):
+        previous = self._entries.get(item.id)
+        if previous is None:
+            self._push_entry(item, next(self._counter), time.time())
+            return
+        self.coalesced += 1
+        self._remove_path(previous[3])
+        previous[3] = None
+        self._push_entry(item, previous[1], previous[2])
+
+    def _get(self):
+        while True:
+            priority, _, enqueued, item = heapq.heappop(self.queue)
+            if item is not None:
+                break
+        del self._entries[item.id]
+        self._remove_path(item)
+        if not self._entries:
+            del self.queue[:]
+        self._scheduler.dequeued(self.kind, item, priority, time.time() - enqueued)
+        return item
+
+    def get_items(self):
+        self.mutex.acquire()
+        try:
+            return [entry[3] for entry in sorted(self._entries.values())]
+        finally:
+            self.mutex.release()
+
+    def peek(self, count):
+        '''
+        Return the count first items without removing them
+        '''
+        self.mutex.acquire()
+        try:
+            return [entry[3] for entry in heapq.nsmallest(count, self._entries.itervalues())]
+        finally:
+            self.mutex.release()
+
+    def has_path(self, local_path):
+        '''
+        Return True if a folder of this local path is queued
+        '''
+        self.mutex.acquire()
+        try:
+            return local_path in self._paths
+        finally:
+            self.mutex.release()
+
+    def update_priority(self, row_id):
+        '''
+        Recompute the priority of the queued item of the pair, return True if any
+        '''
+        self.mutex.acquire()
+        try:
+            entry = self._entries.get(row_id)
+            if entry is None:
+                return False
+            entry[3], item = None, entry[3]
+            self._remove_path(item)
+            self._push_entry(item, entry[1], entry[2])
+            return True
+        finally:
+            self.mutex.release()
+
+    def discard(self, row_id):
+        '''
+        Remove the queued item of the pair, return True if any
+        '''
+        self.mutex.acquire()
+        try:
+            entry = self._entries.pop(row_id, None)
+            if entry is None:
+                return False
+            self._remove_path(entry[3])
+            entry[3] = None
+            # Do not let the replaced entries pile up once the queue is drained
+            if not self._entries:
+                del self.queue[:]
+            return True
+        finally:
+            self.mutex.release()
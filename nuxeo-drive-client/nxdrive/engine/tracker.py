@@ -106,6 +106,9 @@ class Tracker(Worker):
         for _, engine in engines.iteritems():
             stats = engine.get_metrics()
             for key, value in stats.iteritems():
+                # The events only take an integer value
+                if not isinstance(value, (int, long)):
+                    continue
                 log.trace("Send Statistics(Engine) %s:%d", key, value)
                 self._tracker.send('event', category='Statistics', action='Engine', label=key, value=value)
         self._stat_timer.start(60 * 60 * 1000)
@@ -188,18 +188,22 @@ class RemoteWatcher(EngineWorker):
 
     def _scan_remote_scroll(self, doc_pair, remote_info, moved=False):
         """Perform a scroll scan of the bound remote folder looking for updates"""
-        remote_parent_path = self._init_scan_remote(doc_pair, remote_info)
-        if remote_parent_path is None:
+        # Root of the scan, kept for the scope of the known pairs and the deletions check
+        scan_root_path = self._init_scan_remote(doc_pair, remote_info)
+        if scan_root_path is None:
             return
 
-        # Detect recently deleted children
+        # The known descendants are looked up by scrolled batch and the scrolled refs are stored in the
+        # database, the memory used does not depend on the size of the tree
         if moved:
-            db_descendants = self._dao.get_remote_descendants_from_ref(doc_pair.remote_ref)
+            def in_scope(pair):
+                return doc_pair.remote_ref in (pair.remote_parent_path or '')
         else:
-            db_descendants = self._dao.get_remote_descendants(remote_parent_path)
-        descendants = dict()
-        for descendant in db_descendants:
-            descendants[descendant.remote_ref] = descendant
+            def in_scope(pair):
+                return (pair.remote_parent_path or '').startswith(scan_root_path)
+        # Pairs created by the other threads during the scroll are not checked for deletion
+        last_id = self._dao.get_last_state_id()
+        self._dao.clean_remote_scrolled()
 
         to_process = []
         scroll_id = None
@@ -227,7 +231,16 @@ class RemoteWatcher(EngineWorker):
             scroll_id = scroll_res['scroll_id']
             # Results are not necessarily sorted
             descendants_info = sorted(descendants_info, key=lambda x: x.path, reverse=False)
-            # Handle descendants
+            descendants = dict()
+            for pair in self._dao.get_states_from_remote_refs([info.uid for info in descendants_info]):
+                if in_scope(pair):
+                    descendants[pair.remote_ref] = pair
+            self._dao.add_remote_scrolled([info.uid for info in descendants_info])
+            # Handle descendants, the updates and the creations are stored by batch
+            updates = []
+            creations = []
+            # Local and remote parent paths of the descendants pending creation
+            created = dict()
             for descendant_info in descendants_info:
                 log.trace('Handling remote descendant: %r', descendant_info)
                 descendant_pair = None
@@ -235,15 +248,31 @@ class RemoteWatcher(EngineWorker):
                     descendant_pair = descendants.pop(descendant_info.uid)
                     if self._check_modified(descendant_pair, descendant_info):
                         descendant_pair.remote_state = 'modified'
-                    self._dao.update_remote_state(descendant_pair, descendant_info)
-                else:
+                    updates.append((descendant_pair, descendant_info, None))
+                    continue
+                parent_paths = created.get(descendant_info.parent_uid)
+                if parent_paths is None:
                     parent_pair = self._dao.get_normal_state_from_remote(descendant_info.parent_uid)
                     if parent_pair is None:
                         log.trace('Cannot find parent pair of remote descendant, postponing processing of %s',
                                   descendant_info)
                         to_process.append(descendant_info)
                         continue
-                    descendant_pair, _ = self._find_remote_child_match_or_create(parent_pair, descendant_info)
+                    parent_paths = (parent_pair.local_path, parent_pair.remote_parent_path + '/' + parent_pair.remote_ref)
+                local_parent_path, child_remote_parent_path = parent_paths
+                local_path = path_join(local_parent_path, safe_filename(descendant_info.name))
+                if (self._dao.get_state_from_local(local_path) is None
+                        and not self._local_client.exists(local_parent_path)):
+                    # Nothing to match locally, it is a pure creation
+                    creations.append((descendant_info, child_remote_parent_path, local_path, local_parent_path))
+                    created[descendant_info.uid] = (local_path, child_remote_parent_path + '/' + descendant_info.uid)
+                    continue
+                # Might match an existing local document, its parent needs to be stored first
+                self._store_remote_descendants(updates, creations)
+                created.clear()
+                parent_pair = self._dao.get_normal_state_from_remote(descendant_info.parent_uid)
+                descendant_pair, _ = self._find_remote_child_match_or_create(parent_pair, descendant_info)
+            self._store_remote_descendants(updates, creations)
             # Check if synchronization thread was suspended
             self._interact()
 
@@ -262,8 +291,22 @@ class RemoteWatcher(EngineWorker):
             log.trace('Postponed descendants processing took %s ms', self._get_elapsed_time_milliseconds(t0, t1))
 
         # Delete remaining
-        for deleted in descendants.values():
-            self._dao.delete_remote_state(deleted)
+        if moved:
+            remaining = self._dao.iter_remote_descendants_from_ref(doc_pair.remote_ref, unscrolled=True)
+        else:
+            remaining = self._dao.iter_remote_descendants(scan_root_path, unscrolled=True)
+        for deleted in remaining:
+            if deleted.id <= last_id:
+                self._dao.delete_remote_state(deleted)
+        self._dao.clean_remote_scrolled()
+
+    def _store_remote_descendants(self, updates, creations):
+        if updates:
+            self._dao.update_remote_states(updates)
+            del updates[:]
+        if creations:
+            self._dao.insert_remote_states(creations)
+            del creations[:]
 
     def _get_elapsed_time_milliseconds(self, t0, t1):
         delta = t1 - t0
@@ -534,6 +577,7 @@ class RemoteWatcher(EngineWorker):
         summary = self._get_changes()
         if summary['hasTooManyChanges']:
             log.debug("Forced full scan by server")
+            self._engine.get_remote_info_cache().clear()
             remote_path = '/'
             self._dao.add_path_to_scan(remote_path)
             self._dao.update_config('remote_need_full_scan', remote_path)
@@ -588,6 +632,8 @@ class RemoteWatcher(EngineWorker):
             updated = False
             if doc_pairs:
                 for doc_pair in doc_pairs:
+                    # The prefetched info is outdated
+                    self._engine.get_remote_info_cache().invalidate(doc_pair.remote_ref)
                     doc_pair_repr = doc_pair.local_path if doc_pair.local_path is not None else doc_pair.remote_name
                     if eventId == 'deleted':
                         if fs_item is None:
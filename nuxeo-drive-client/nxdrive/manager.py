@@ -242,6 +242,8 @@ class Manager(QtCore.QObject):
         self._app_updater = None
         self._dao = None
         self._create_dao()
+        if self.get_dao_profiling():
+            self._dao.enable_profiling(self.get_dao_slow_query() / 1000.0)
         if options.proxy_server is not None:
             proxy = ProxySettings()
             proxy.from_url(options.proxy_server)
@@ -265,6 +267,7 @@ class Manager(QtCore.QObject):
         self._dao.update_config("update_url", options.update_site_url)
         self._dao.update_config("beta_update_url", options.beta_update_site_url)
         self.refresh_proxies()
+        self._create_bandwidth_scheduler()
         self._os = AbstractOSIntegration.get(self)
         # Create DirectEdit
         self._create_autolock_service()
@@ -312,6 +315,8 @@ class Manager(QtCore.QObject):
         result["python_version"] = platform.python_version()
         result["platform"] = platform.system()
         result["appname"] = self.get_appname()
+        for key, value in self._bandwidth.get_metrics().iteritems():
+            result["bandwidth_" + key] = value
         return result
 
     def open_help(self):
@@ -734,6 +739,86 @@ class Manager(QtCore.QObject):
     def set_direct_edit_auto_lock(self, value):
         self._dao.update_config("direct_edit_auto_lock", value)
 
+    def get_dao_wal(self):
+        # Engines databases use the default journal unless WAL is enabled
+        return self._dao.get_config("dao_wal", "0") == "1"
+
+    def set_dao_wal(self, value):
+        self._dao.update_config("dao_wal", value)
+
+    def get_dao_writer(self):
+        # Engines databases mutations are done by the caller thread unless enabled
+        return self._dao.get_config("dao_writer", "0") == "1"
+
+    def set_dao_writer(self, value):
+        self._dao.update_config("dao_writer", value)
+
+    def get_dao_profiling(self):
+        # Databases methods and statements are timed only if enabled
+        return self._dao.get_config("dao_profiling", "0") == "1"
+
+    def set_dao_profiling(self, value):
+        self._dao.update_config("dao_profiling", value)
+
+    def get_dao_slow_query(self):
+        # Time in ms from which a statement is logged with its query plan
+        from nxdrive.engine.dao.sqlite import DEFAULT_SLOW_QUERY_THRESHOLD
+        return int(self._dao.get_config("dao_slow_query", int(DEFAULT_SLOW_QUERY_THRESHOLD * 1000)))
+
+    def set_dao_slow_query(self, value):
+        self._dao.update_config("dao_slow_query", value)
+
+    def get_core_processors(self):
+        # Generic file processors of each engine kept waiting for work, the others end when idle
+        return int(self._dao.get_config("core_processors", "0"))
+
+    def set_core_processors(self, value):
+        self._dao.update_config("core_processors", value)
+
+    def get_adaptive_processors(self):
+        # The generic file processors follow the throughput and the errors only if enabled
+        return self._dao.get_config("adaptive_processors", "0") == "1"
+
+    def set_adaptive_processors(self, value):
+        self._dao.update_config("adaptive_processors", value)
+
+    def get_prefetch_fetchers(self):
+        # Parallel requests prefetching the remote infos of the queued local changes, disabled unless set
+        return int(self._dao.get_config("prefetch_fetchers", "0"))
+
+    def set_prefetch_fetchers(self, value):
+        self._dao.update_config("prefetch_fetchers", value)
+
+    def _create_bandwidth_scheduler(self):
+        from nxdrive.client.bandwidth import BandwidthScheduler, DIRECT_EDIT_FLOW, UPLOAD, DOWNLOAD
+        self._bandwidth = BandwidthScheduler(self.get_bandwidth_limit(), self.get_bandwidth_limit(UPLOAD),
+                                             self.get_bandwidth_limit(DOWNLOAD))
+        self._bandwidth.set_weight(DIRECT_EDIT_FLOW, self.get_bandwidth_weight(DIRECT_EDIT_FLOW))
+
+    def get_bandwidth_scheduler(self):
+        return self._bandwidth
+
+    def _get_bandwidth_key(self, direction):
+        return "bandwidth_limit" if direction is None else direction + "_bandwidth_limit"
+
+    def get_bandwidth_limit(self, direction=None):
+        # Limit in bytes/s of all the transfers, or of the upload or download direction, 0 for no limit
+        return int(self._dao.get_config(self._get_bandwidth_key(direction), "0"))
+
+    def set_bandwidth_limit(self, value, direction=None):
+        self._dao.update_config(self._get_bandwidth_key(direction), value)
+        self._bandwidth.set_limit(int(value), direction)
+
+    def get_bandwidth_weight(self, flow):
+        # Share of the bandwidth of an engine uid or of DirectEdit, relative to the other active flows
+        from nxdrive.client.bandwidth import DEFAULT_WEIGHT, DIRECT_EDIT_FLOW, DEFAULT_DIRECT_EDIT_WEIGHT
+        default = DEFAULT_DIRECT_EDIT_WEIGHT if flow == DIRECT_EDIT_FLOW else DEFAULT_WEIGHT
+        return int(self._dao.get_config("bandwidth_weight_" + flow, default))
+
+    def set_bandwidth_weight(self, flow, value):
+        self._dao.update_config("bandwidth_weight_" + flow, value)
+        self._bandwidth.set_weight(flow, int(value))
+
     def get_auto_update(self):
         # By default auto update
         return self._dao.get_config("auto_update", "1") == "1"
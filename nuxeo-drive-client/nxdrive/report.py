@@ -44,12 +44,14 @@ class Report(object):
             pass
 
     def copy_db(self, myzip, dao):
-        # Lock to avoid inconsistence
-        dao._lock.acquire()
+        # Snapshot to avoid inconsistence, the synchronization only goes on during the copy in WAL mode
+        snapshot = os.path.join(os.path.dirname(self._zipfile), self._report_name + '.db')
         try:
-            myzip.write(dao._db, os.path.basename(dao._db))
+            dao.snapshot(snapshot)
+            myzip.write(snapshot, os.path.basename(dao._db))
         finally:
-            dao._lock.release()
+            if os.path.exists(snapshot):
+                os.remove(snapshot)
 
     def get_path(self):
         return self._zipfile
@@ -75,6 +77,7 @@ class Report(object):
             self.copy_db(myzip, dao)
             for engine in self._manager.get_engines().values():
                 log.debug("Engine metrics: '%s'", engine.get_metrics())
+                log.debug("Engine diagnostics: '%s'", engine.get_diagnostics())
                 self.copy_db(myzip, engine.get_dao())
                 # Might want threads too here
             self.copy_logs(myzip)
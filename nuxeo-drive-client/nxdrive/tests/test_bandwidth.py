@@ -0,0 +1,49 @@
+import unittest
+from nxdrive.client.bandwidth import BandwidthScheduler, TokenBucket, DIRECT_EDIT_FLOW, UPLOAD, DOWNLOAD
+
+
+class BandwidthSchedulerTest(unittest.TestCase):
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(1000, now=0)
+        # Half a second of burst, then the debt is repaid at the rate
+        self.assertEquals(bucket.consume(500, 0), 0)
+        self.assertEquals(bucket.consume(1000, 0), 1)
+        self.assertEquals(bucket.consume(500, 2), 0)
+        bucket.set_rate(100, 2)
+        self.assertEquals(bucket.consume(100, 2), 1)
+
+    def test_no_limit(self):
+        scheduler = BandwidthScheduler()
+        self.assertEquals(scheduler.acquire(UPLOAD, 'engine', 10 ** 9, now=0), 0)
+        scheduler.set_limit(1000, UPLOAD)
+        self.assertTrue(scheduler.acquire(UPLOAD, 'engine', 10 ** 4, now=0) > 0)
+        self.assertEquals(scheduler.acquire(DOWNLOAD, 'engine', 10 ** 9, now=0), 0)
+
+    def test_fair_share(self):
+        scheduler = BandwidthScheduler(limit=1000)
+        scheduler.set_weight('engine2', 3)
+        # Alone, a flow gets the whole limit
+        self.assertAlmostEquals(scheduler.acquire(DOWNLOAD, 'engine1', 1500, now=0), 1)
+        # Then the active flows share it by weight
+        scheduler.acquire(UPLOAD, 'engine2', 375, now=0)
+        self.assertAlmostEquals(scheduler.acquire(DOWNLOAD, 'engine1', 500, now=1), 2)
+        self.assertAlmostEquals(scheduler.acquire(UPLOAD, 'engine2', 750, now=1), 0.5)
+        # DirectEdit weights 4 by default
+        scheduler.set_limit(900, DOWNLOAD)
+        scheduler.acquire(DOWNLOAD, DIRECT_EDIT_FLOW, 1, now=1)
+        self.assertAlmostEquals(scheduler._get_rate(DIRECT_EDIT_FLOW, DOWNLOAD, 1), 500)
+        self.assertAlmostEquals(scheduler._get_rate('engine1', DOWNLOAD, 1), 125)
+        # Idle flows leave their share
+        scheduler.acquire(DOWNLOAD, DIRECT_EDIT_FLOW, 1, now=10)
+        self.assertAlmostEquals(scheduler._get_rate(DIRECT_EDIT_FLOW, DOWNLOAD, 10), 900)
+
+    def test_metrics(self):
+        scheduler = BandwidthScheduler(upload_limit=10 ** 6)
+        scheduler.acquire(UPLOAD, 'engine', 1000, now=0)
+        scheduler.acquire(UPLOAD, 'engine', 1000, now=6)
+        metrics = scheduler.get_metrics()
+        self.assertEquals(metrics["upload_limit"], 10 ** 6)
+        self.assertEquals(metrics["upload_total"], 2000)
+        self.assertEquals(metrics["download_total"], 0)
+        self.assertIn("engine_upload_rate", metrics)
@@ -0,0 +1,87 @@
+import unittest
+from urllib2 import HTTPError
+import socket
+from nxdrive.engine.concurrency import ConcurrencyController, LocalIOTimer, is_overload_error
+import time
+
+
+class ConcurrencyControllerTest(unittest.TestCase):
+
+    def _window(self, controller, now, pairs, size=1000, duration=100, transfer=100, local_io=0):
+        for _ in range(pairs):
+            controller.record_sync(dict(start_time=0, end_time=duration, transfer_time=transfer, size=size,
+                                        local_io_time=local_io))
+        return controller.adjust(10, now=now)
+
+    def test_overload_errors(self):
+        self.assertTrue(is_overload_error(HTTPError('http://localhost', 503, 'Unavailable', None, None)))
+        self.assertTrue(is_overload_error(HTTPError('http://localhost', 429, 'Too many', None, None)))
+        self.assertFalse(is_overload_error(HTTPError('http://localhost', 404, 'Not found', None, None)))
+        self.assertTrue(is_overload_error(socket.timeout()))
+        self.assertFalse(is_overload_error(ValueError()))
+        self.assertFalse(is_overload_error(None))
+
+    def test_grow_while_throughput_increases(self):
+        controller = ConcurrencyController(4, min_processors=1, max_processors=6)
+        start = controller._window_start
+        self.assertEquals(self._window(controller, start + 10, 10), 5)
+        self.assertEquals(self._window(controller, start + 20, 20), 6)
+        # Capped by the maximum
+        self.assertEquals(self._window(controller, start + 30, 40), 6)
+        # No growth without pending files
+        controller = ConcurrencyController(4)
+        controller.record_sync(dict(start_time=0, end_time=100, size=10))
+        self.assertEquals(controller.adjust(0, now=controller._window_start + 10), 4)
+
+    def test_shrink_when_throughput_decreases(self):
+        controller = ConcurrencyController(4)
+        start = controller._window_start
+        self.assertEquals(self._window(controller, start + 10, 20), 5)
+        self.assertEquals(self._window(controller, start + 20, 10, size=500), 4)
+        # Stable throughput keeps the limit
+        self.assertEquals(self._window(controller, start + 30, 10, size=500), 4)
+        self.assertEquals(controller.get_metrics()["adjustments"], 2)
+
+    def test_backoff_on_overload(self):
+        controller = ConcurrencyController(8, min_processors=3)
+        start = controller._window_start
+        controller.record_error(HTTPError('http://localhost', 503, 'Unavailable', None, None))
+        self.assertEquals(self._window(controller, start + 10, 5), 4)
+        controller.record_error(socket.timeout())
+        self.assertEquals(self._window(controller, start + 20, 5), 3)
+        # Other errors do not back off
+        controller.record_error(HTTPError('http://localhost', 404, 'Not found', None, None))
+        self.assertEquals(self._window(controller, start + 30, 50), 4)
+
+    def test_hold_on_slow_disk(self):
+        controller = ConcurrencyController(4)
+        start = controller._window_start
+        # 3s per pair in the local calls
+        self.assertEquals(self._window(controller, start + 10, 10, duration=3100, local_io=3000), 4)
+        self.assertEquals(self._window(controller, start + 20, 50, duration=3100, local_io=3000), 4)
+        self.assertEquals(self._window(controller, start + 30, 80), 5)
+        # Slow pairs out of the local calls, a slow server for instance, do not hold the growth
+        self.assertEquals(self._window(controller, start + 40, 160, duration=3100), 6)
+
+    def test_local_io_timer(self):
+        class Client(object):
+            base_folder = '/tmp'
+
+            def get_info(self, path):
+                time.sleep(0.05)
+                return path
+
+            def fail(self):
+                time.sleep(0.05)
+                raise IOError()
+        timer = LocalIOTimer(Client())
+        self.assertEquals(timer.base_folder, '/tmp')
+        self.assertEquals(timer.get_info('/file'), '/file')
+        self.assertRaises(IOError, timer.fail)
+        self.assertTrue(0.09 <= timer.elapsed < 1)
+
+    def test_limits(self):
+        self.assertEquals(ConcurrencyController(0, min_processors=2).get_limit(), 2)
+        self.assertEquals(ConcurrencyController(30, max_processors=10).get_limit(), 10)
+        controller = ConcurrencyController(4, min_processors=4, max_processors=2)
+        self.assertEquals(controller.get_limit(), 4)
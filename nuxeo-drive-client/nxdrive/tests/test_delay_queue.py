@@ -0,0 +1,43 @@
+import unittest
+from nxdrive.engine.delay_queue import DelayQueue
+
+
+class DelayQueueTest(unittest.TestCase):
+
+    def test_order(self):
+        queue = DelayQueue()
+        queue.push(1, "Item1", 30)
+        queue.push(2, "Item2", 10)
+        queue.push(3, "Item3", 20)
+        queue.push(4, "Item4", 10)
+        self.assertEquals(queue.get_next_due(), 10)
+        # Ready once the due time is past, FIFO for the same due time
+        self.assertIsNone(queue.get(cur_time=10))
+        self.assertEquals(queue.get(cur_time=11), "Item2")
+        self.assertEquals(queue.get_ready(cur_time=25), ["Item4", "Item3"])
+        self.assertEquals(len(queue), 1)
+        self.assertEquals(queue.get_ready(cur_time=25), [])
+        self.assertEquals(queue.get_ready(cur_time=31), ["Item1"])
+        self.assertIsNone(queue.get_next_due())
+        self.assertIsNone(queue.get())
+
+    def test_replace(self):
+        queue = DelayQueue()
+        queue.push(1, "Item1", 10)
+        queue.push(2, "Item2", 20)
+        # Pushing an id again replaces its item and due time
+        queue.push(1, "Item1bis", 30)
+        self.assertEquals(len(queue), 2)
+        self.assertTrue(1 in queue)
+        self.assertEquals(queue.get_next_due(), 20)
+        self.assertTrue(queue.remove(2))
+        self.assertFalse(queue.remove(2))
+        self.assertEquals(queue.get_ready(cur_time=100), ["Item1bis"])
+        self.assertEquals(queue._heap, [])
+
+    def test_compact(self):
+        queue = DelayQueue()
+        for due in range(5000):
+            queue.push(1, due, due)
+        self.assertTrue(len(queue._heap) <= 2048)
+        self.assertEquals(queue.get_ready(cur_time=10000), [4999])
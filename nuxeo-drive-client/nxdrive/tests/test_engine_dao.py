@@ -7,9 +7,26 @@ import unittest
 import os
 import sys
 import nxdrive
-from nxdrive.engine.dao.sqlite import EngineDAO
+from nxdrive.engine.dao import sqlite as dao_sqlite
+from nxdrive.engine.dao.sqlite import WriteFuture, WriteTimeout
+from nxdrive.engine.dao.sqlite import EngineDAO, StateRow, STATE_INDEXES, STATE_COUNTERS, STATE_CODES
 from nxdrive.engine.engine import Engine
+from nxdrive.client.remote_file_system_client import RemoteFileInfo
 import tempfile
+import sqlite3
+from threading import Thread
+import time
+
+
+class StatementRecorder(object):
+    # Stands for the QueryProfiler of the connections to capture the executed statements
+    def __init__(self):
+        self.statements = []
+        self.durations = []
+
+    def record_query(self, duration, query, params=()):
+        self.statements.append((query, params))
+        self.durations.append(duration)
 
 
 class EngineDAOTest(unittest.TestCase):
@@ -73,7 +90,7 @@ class EngineDAOTest(unittest.TestCase):
         rows = c.execute("SELECT * FROM States").fetchall()
         self.assertEquals(len(rows), 0)
         cols = c.execute("PRAGMA table_info('States')").fetchall()
-        self.assertEquals(len(cols), 30)
+        self.assertEquals(len(cols), 31)
         self.assertIsNone(self._dao.get_config("remote_last_event_log_id"))
         self.assertIsNone(self._dao.get_config("remote_last_full_scan"))
 
@@ -90,7 +107,7 @@ class EngineDAOTest(unittest.TestCase):
         self._dao = EngineDAO(migrate_db.name)
         c = self._dao._get_read_connection().cursor()
         cols = c.execute("PRAGMA table_info('States')").fetchall()
-        self.assertEquals(len(cols), 30)
+        self.assertEquals(len(cols), 31)
         cols = c.execute("SELECT * FROM States").fetchall()
         self.assertEquals(len(cols), 63)
         self.test_batch_folder_files()
@@ -100,10 +117,670 @@ class EngineDAOTest(unittest.TestCase):
         self.test_acquire_processors()
         self.test_configuration()
 
+    def test_migration_db_v4_indexes(self):
+        migrate_db = self.get_db_temp_file()
+        db = open(self._get_default_db('test_engine_migration.db'), 'rb')
+        with open(migrate_db.name, 'wb') as f:
+            f.write(db.read())
+        self._clean_dao(self._dao)
+        self._dao = EngineDAO(migrate_db.name)
+        self.assertEquals(self._dao.get_config("schema_version"), "10")
+        c = self._dao._get_read_connection().cursor()
+        indexes = [row.name for row in c.execute("PRAGMA index_list('States')").fetchall()]
+        for name, _ in STATE_INDEXES:
+            self.assertIn(name, indexes)
+
+    def test_state_codes(self):
+        # The states are stored as codes and given back by name
+        c = sqlite3.connect(self._dao.get_db()).cursor()
+        raw = c.execute("SELECT pair_state, local_state, remote_state FROM States").fetchall()
+        self.assertTrue(raw)
+        for row in raw:
+            self.assertTrue(all(isinstance(value, (int, long)) for value in row))
+        codes = dict(c.execute("SELECT name, code FROM StateCodes").fetchall())
+        self.assertEquals(codes, STATE_CODES)
+        row = self._dao.get_states_from_partial_local('/')[1]
+        self.assertIn(row.pair_state, STATE_CODES)
+        self.assertEquals(len(self._dao.get_conflicts()), 3)
+        # A state without code is kept as is
+        self._dao.update_last_transfer(row.id, 'custom')
+        self.assertEquals(self._dao.get_state_from_id(row.id).last_transfer, 'custom')
+        self._dao.update_last_transfer(row.id, 'upload')
+        self.assertEquals(self._dao.get_state_from_id(row.id).last_transfer, 'upload')
+        self.assertEquals(c.execute("SELECT last_transfer FROM States WHERE id=?", (row.id,)).fetchone()[0],
+                          STATE_CODES['upload'])
+
+    def _get_query_plan(self, query, params=()):
+        c = self._dao._get_read_connection().cursor()
+        return [row[-1] for row in c.execute("EXPLAIN QUERY PLAN " + query, params).fetchall()]
+
+    def test_query_plans(self):
+        # Each hot query of the DAO must be resolved through an index, not a full scan of States
+        self._clean_dao(self._dao)
+        # Without the StateRow cache the lookups run their statement
+        self._dao = EngineDAO(self.tmp_db.name, cache_size=0)
+        ref = [row for row in self._dao.get_states_from_partial_local('/') if row.remote_ref][-1].remote_ref
+        root = self._dao.get_state_from_local('/')
+        remote_path = root.remote_parent_path + '/' + root.remote_ref
+        recorder = StatementRecorder()
+        # The reads of this thread reuse the same pooled connection
+        self._dao._readers.checkin(self._dao._readers.checkout())
+        for con in self._dao._connections + self._dao._readers.get_connections():
+            con.profiler = recorder
+        # Name, arguments and the indexes its accesses to States may use
+        calls = [
+            ("get_state_from_id", (1,), ("INTEGER PRIMARY KEY",)),
+            ("get_local_children", ('/',), ("States_local_parent_path",)),
+            ("get_state_from_local", ('/',), ("States_local_path",)),
+            ("get_remote_children", (ref,), ("States_remote_parent_ref",)),
+            ("get_new_remote_children", (ref,), ("States_remote_parent_ref",)),
+            ("get_states_from_remote", (ref,), ("sqlite_autoindex_States_2",)),
+            ("get_state_from_remote_with_path", (ref, ''), ("sqlite_autoindex_States_2", "States_remote_parent_path")),
+            ("get_valid_duplicate_file", ('digest',), ("States_remote_digest",)),
+            ("get_unsynchronizeds", (), ("States_pair_state",)),
+            ("get_conflicts", (), ("States_pair_state",)),
+            ("get_errors", (), ("States_error_count",)),
+            ("get_error_count", (), ("States_error_count",)),
+            ("get_error_count", (5,), ("States_error_count",)),
+            ("get_sync_count", (), ()),
+            ("get_sync_count", ('file',), ()),
+            ("get_syncing_count", (), ("States_error_count",)),
+            ("get_syncing_count", (5,), ("States_error_count",)),
+            ("get_conflict_count", (), ()),
+            ("get_global_size", (), ()),
+            ("get_last_files", (5,), ("States_last_sync_date",)),
+            ("get_next_folder_file", (ref,), ("sqlite_autoindex_States_2", "States_remote_parent_ref")),
+            ("release_processor", (666,), ("States_processor",)),
+            ("acquire_processor", (666, 1), ("INTEGER PRIMARY KEY",)),
+            ("get_remote_descendants", (remote_path,), ("States_remote_parent_path",)),
+            ("get_remote_descendants_from_ref", (ref,), ("sqlite_autoindex_States_2", "States_remote_parent_path")),
+        ]
+        # Full scans by design
+        exemptions = [
+            # Every pair under a local path, the whole table for the root
+            ("get_states_from_partial_local", ('/',)),
+            # Suffix match on the remote ref, no index can help
+            ("get_first_state_from_partial_remote", (ref,)),
+        ]
+        for name, args, indexes in calls:
+            del recorder.statements[:]
+            getattr(self._dao, name)(*args)
+            self.assertTrue(recorder.statements, "%s ran no statement" % name)
+            statements = [(query, params) for query, params in recorder.statements if "States" in query]
+            for query, params in statements:
+                for detail in self._get_query_plan(query, params):
+                    if "States" not in detail:
+                        continue
+                    # Walking an index in order is bounded by the LIMIT
+                    searched = detail.startswith("SEARCH") or (" LIMIT " in query and "USING INDEX" in detail)
+                    self.assertTrue(searched, "%s does a full scan: %s\n%s" % (name, detail, query))
+                    self.assertTrue([index for index in indexes if index in detail],
+                                    "%s does not use %s: %s\n%s" % (name, " or ".join(indexes), detail, query))
+        for name, args in exemptions:
+            getattr(self._dao, name)(*args)
+
+    def test_wal_readers_pool(self):
+        self._clean_dao(self._dao)
+        # Without the StateRow cache every read goes through the pool
+        self._dao = EngineDAO(self.tmp_db.name, wal=True, readers=2, cache_size=0)
+        c = self._dao._get_write_connection().cursor()
+        self.assertEquals(c.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        errors = []
+
+        def read():
+            try:
+                for _ in range(50):
+                    self.assertEquals(self._dao.get_conflict_count(), 3)
+                    self.assertIsNotNone(self._dao.get_state_from_id(1))
+            except Exception as e:
+                errors.append(e)
+        threads = [Thread(target=read) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(errors, [])
+        metrics = self._dao.get_metrics()
+        self.assertTrue(metrics["wal"])
+        self.assertEquals(metrics["pool_size"], 2)
+        self.assertEquals(metrics["pool_in_use"], 0)
+        self.assertTrue(metrics["pool_checkouts"] >= 500)
+        # The readers of the dead threads are shared, only the pool ones exist
+        self.assertTrue(metrics["connections"] <= 3)
+        # Writes are still visible to the pooled readers
+        row = self._dao.get_state_from_id(1)
+        self._dao.increase_error(row, "Test")
+        self.assertEquals(self._dao.get_state_from_id(1).last_error, "Test")
+
+    def test_readers_pool(self):
+        # Without WAL the reads of the threads share the pool too
+        self._clean_dao(self._dao)
+        self._dao = EngineDAO(self.tmp_db.name, readers=2, cache_size=0)
+        errors = []
+
+        def read():
+            try:
+                for _ in range(10):
+                    self.assertIsNotNone(self._dao.get_state_from_id(1))
+            except Exception as e:
+                errors.append(e)
+        for _ in range(10):
+            thread = Thread(target=read)
+            thread.start()
+            thread.join()
+        self.assertEquals(errors, [])
+        metrics = self._dao.get_metrics()
+        self.assertFalse(metrics["wal"])
+        self.assertTrue(metrics["pool_checkouts"] >= 100)
+        self.assertTrue(metrics["connections"] <= 3)
+
+    def test_group_commit_writer(self):
+        self._dao.start_writer(interval=0.05)
+        rows = self._dao.get_states_from_partial_local('/')
+        errors = []
+        acquired = []
+
+        def write(row):
+            try:
+                self._dao.increase_error(row, "Group")
+                self.assertEquals(self._dao.get_state_from_id(row.id).last_error, "Group")
+                if self._dao.acquire_processor(42, row.id):
+                    acquired.append(row.id)
+            except Exception as e:
+                errors.append(e)
+        threads = [Thread(target=write, args=(row,)) for row in rows]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(errors, [])
+        self.assertEquals(len(acquired), len(rows))
+        self.assertTrue(self._dao.release_processor(42))
+        metrics = self._dao.get_metrics()
+        self.assertEquals(metrics["writer_operations"], 2 * len(rows) + 1)
+        # Concurrent mutations share their commits
+        self.assertTrue(metrics["writer_commits"] < metrics["writer_operations"])
+        # Results are returned to the callers
+        row = [row for row in rows if not row.folderish][0]
+        self.assertFalse(self._dao.synchronize_state(row, version=row.version + 1))
+        self.assertTrue(self._dao.synchronize_state(row))
+
+    def test_writer_failed_mutation(self):
+        # The writes of a failing mutation and its notifications are dropped, not the rest of the batch
+        self._dao.start_writer(interval=0.5)
+        notified = []
+
+        def fail(cursor):
+            cursor.execute("UPDATE States SET last_error='Partial' WHERE id=1")
+            self._dao._on_commit(notified.append, 1)
+            raise ValueError("Failing mutation")
+
+        def succeed(cursor):
+            cursor.execute("UPDATE States SET last_error='Done' WHERE id=2")
+            self._dao._on_commit(notified.append, 2)
+        failed = self._dao._write_async(fail)
+        succeeded = self._dao._write_async(succeed)
+        self.assertRaises(ValueError, failed.result, 5)
+        self.assertIsNone(succeeded.result(5))
+        self.assertEquals(self._dao.get_metrics()["writer_commits"], 1)
+        self.assertEquals(notified, [2])
+        self.assertIsNone(self._dao.get_state_from_id(1).last_error)
+        self.assertEquals(self._dao.get_state_from_id(2).last_error, "Done")
+        # A failed commit is rolled back instead of being committed by the next batch
+        con = self._dao._get_write_connection()
+        con.execute("PRAGMA foreign_keys = ON")
+        con.execute("CREATE TABLE Parent(id INTEGER PRIMARY KEY)")
+        con.execute("CREATE TABLE Child(parent_id INTEGER REFERENCES Parent(id) DEFERRABLE INITIALLY DEFERRED)")
+        con.commit()
+
+        def orphan(cursor):
+            cursor.execute("INSERT INTO Child(parent_id) VALUES(1)")
+        self.assertRaises(sqlite3.IntegrityError, self._dao._write_async(orphan).result, 5)
+        self._dao.increase_error(self._dao.get_state_from_id(1), "Next")
+        self.assertEquals(con.execute("SELECT COUNT(*) FROM Child").fetchone()[0], 0)
+        self.assertEquals(self._dao.get_state_from_id(1).last_error, "Next")
+        # A timeout is not a None result
+        self.assertRaises(WriteTimeout, WriteFuture().result, 0.01)
+
+    def test_writer_failed_batch(self):
+        # A batch failing outside of its mutations fails its callers, the writer thread keeps running
+        self._dao.start_writer()
+        get_write_connection = self._dao._get_write_connection
+
+        def broken_connection(*args, **kwargs):
+            raise sqlite3.OperationalError("Broken connection")
+        self._dao._get_write_connection = broken_connection
+        try:
+            failed = self._dao._write_async(lambda cursor: None)
+            self.assertRaises(sqlite3.OperationalError, failed.result, 5)
+        finally:
+            self._dao._get_write_connection = get_write_connection
+        self.assertTrue(self._dao._writer.is_alive())
+        self._dao.increase_error(self._dao.get_state_from_id(1), "After")
+        self.assertEquals(self._dao.get_state_from_id(1).last_error, "After")
+        # The batches wait for the end of a transaction instead of committing it
+        self._dao.begin_transaction()
+        try:
+            pending = self._dao._writer.submit(lambda cursor: cursor.execute(
+                "UPDATE States SET last_error='Batch' WHERE id=2"))
+            self.assertRaises(WriteTimeout, pending.result, 0.2)
+        finally:
+            self._dao.end_transaction()
+        self.assertIsNone(pending.result(5))
+        self.assertEquals(self._dao.get_state_from_id(2).last_error, "Batch")
+        # Without its thread the writes are inline
+        self._dao._writer.stop()
+        self._dao.increase_error(self._dao.get_state_from_id(1), "Inline")
+        self.assertEquals(self._dao.get_state_from_id(1).last_error, "Inline")
+
+    def test_writer_under_lock(self):
+        # A processor holding the DAO lock must not wait for the writer thread
+        self._dao.start_writer(interval=0.05)
+        row = self._dao.get_states_from_partial_local('/')[1]
+        errors = []
+
+        def write():
+            try:
+                self._dao.acquire_lock()
+                try:
+                    self._dao.increase_error(row, "Locked")
+                finally:
+                    self._dao.release_lock()
+            except Exception as e:
+                errors.append(e)
+        thread = Thread(target=write)
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEquals(errors, [])
+        self.assertEquals(self._dao.get_state_from_id(row.id).last_error, "Locked")
+        # The lock is released, the writes go back to the writer thread
+        self._dao.increase_error(row, "Unlocked")
+        self.assertEquals(self._dao.get_metrics()["writer_operations"], 1)
+
     def test_conflicts(self):
         self.assertEquals(self._dao.get_conflict_count(), 3)
         self.assertEquals(len(self._dao.get_conflicts()), 3)
 
+    def _get_remote_info(self, uid, parent_uid, name, folderish=False, digest=None):
+        return RemoteFileInfo(name, uid, parent_uid, '/' + name, folderish, None, 'Administrator', digest, 'md5',
+                              None, True, True, True, folderish, None, None, True)
+
+    def test_bulk_remote_states(self):
+        count = len(self._dao.get_states_from_partial_local('/'))
+        root = self._dao.get_state_from_local('/')
+        remote_path = root.remote_parent_path + '/' + root.remote_ref
+        batch = [(self._get_remote_info('bulk-folder', root.remote_ref, 'Bulk', folderish=True), remote_path,
+                  '/Bulk', '/')]
+        for i in range(10):
+            batch.append((self._get_remote_info('bulk-%d' % i, 'bulk-folder', 'File %d' % i, digest='digest'),
+                          remote_path + '/bulk-folder', '/Bulk/File %d' % i, '/Bulk'))
+        rows = self._dao.insert_remote_states(batch)
+        self.assertEquals([row.remote_ref for row in rows], [info.uid for info, _, _, _ in batch])
+        self.assertEquals(rows[1].local_parent_path, '/Bulk')
+        self.assertEquals(rows[1].pair_state, 'remotely_created')
+        self.assertEquals(len(self._dao.get_states_from_partial_local('/')), count + 11)
+        # Only the rows whose info changed are updated
+        updates = [(row, self._get_remote_info(row.remote_ref, row.remote_parent_ref, row.remote_name,
+                                               digest=('new' if i % 2 else 'digest')), None)
+                   for i, row in enumerate(rows[1:])]
+        self.assertEquals(self._dao.update_remote_states(updates), 5)
+        row = self._dao.get_state_from_id(rows[2].id)
+        self.assertEquals(row.remote_digest, 'new')
+        self.assertEquals(row.version, rows[2].version + 1)
+        row = self._dao.get_state_from_id(rows[1].id)
+        self.assertEquals(row.remote_digest, 'digest')
+        self.assertEquals(row.version, rows[1].version)
+
+    def _assert_state_counters(self):
+        self.assertTrue(self._dao.check_state_counters(rebuild=False))
+        self.assertEquals(self._dao.get_sync_count(),
+                          self._dao.get_count("pair_state=%d" % STATE_CODES['synchronized']))
+        self.assertEquals(self._dao.get_syncing_count(),
+                          self._dao.get_count("pair_state NOT IN (%d, %d, %d) AND error_count < 3" % (
+                              STATE_CODES['synchronized'], STATE_CODES['conflicted'],
+                              STATE_CODES['unsynchronized'])))
+        self.assertEquals(self._dao.get_error_count(), self._dao.get_count("error_count > 3"))
+
+    def test_state_counters(self):
+        counters = self._dao.get_state_counters()
+        self.assertEquals(sorted(counters.keys()), sorted(name for name, _, _ in STATE_COUNTERS))
+        self.assertEquals(counters["conflicts"], 3)
+        self._assert_state_counters()
+        # Updates, inserts and deletes are followed by the triggers
+        row = self._dao.get_states_from_partial_local('/')[1]
+        self._dao.increase_error(row, "Test", incr=4)
+        self.assertEquals(self._dao.get_error_count(), 2)
+        self._assert_state_counters()
+        self._dao.synchronize_state(row)
+        self._dao.set_conflict_state(self._dao.get_state_from_id(row.id))
+        self.assertEquals(self._dao.get_conflict_count(), 4)
+        self._assert_state_counters()
+        root = self._dao.get_state_from_local('/')
+        self._dao.insert_remote_states([(self._get_remote_info('counter', root.remote_ref, 'Counter'),
+                                         root.remote_parent_path + '/' + root.remote_ref, '/Counter', '/')])
+        self._assert_state_counters()
+        self._dao.remove_state(self._dao.get_state_from_local('/Counter'))
+        self._dao.remove_state(root)
+        self._assert_state_counters()
+        # Drifting counters are detected and rebuilt
+        con = self._dao._get_write_connection()
+        con.execute("UPDATE StateCounters SET synchronized=synchronized+10, errors=-1")
+        con.commit()
+        # Only on demand, opening the database does not scan States
+        self._clean_dao(self._dao)
+        self._dao = EngineDAO(self.tmp_db.name)
+        self.assertEquals(self._dao.get_error_count(), -1)
+        self.assertFalse(self._dao.check_state_counters())
+        self._assert_state_counters()
+
+    def test_iter_states(self):
+        # The iterators page on the id and return the same rows as the lists
+        for batch_size in (1, 2, 1000):
+            self.assertEquals([row.id for row in self._dao.iter_conflicts(batch_size=batch_size)],
+                              sorted(row.id for row in self._dao.get_conflicts()))
+            self.assertEquals([row.id for row in self._dao.iter_errors(batch_size=batch_size)],
+                              sorted(row.id for row in self._dao.get_errors()))
+            self.assertEquals([row.id for row in self._dao.iter_unsynchronizeds(batch_size=batch_size)],
+                              sorted(row.id for row in self._dao.get_unsynchronizeds()))
+            self.assertEquals([row.id for row in self._dao.iter_states_from_partial_local('/', batch_size=batch_size)],
+                              sorted(row.id for row in self._dao.get_states_from_partial_local('/')))
+        root = self._dao.get_state_from_local('/')
+        path = root.remote_parent_path + '/' + root.remote_ref
+        descendants = self._dao.get_remote_descendants(path)
+        self.assertTrue(descendants)
+        self.assertEquals([row.id for row in self._dao.iter_remote_descendants(path, batch_size=3)],
+                          sorted(row.id for row in descendants))
+        # The scrolled refs are skipped on request
+        scrolled = [row.remote_ref for row in descendants[:2]]
+        self._dao.add_remote_scrolled(scrolled)
+        self.assertEquals(sorted(row.id for row in self._dao.iter_remote_descendants(path, unscrolled=True)),
+                          sorted(row.id for row in descendants if row.remote_ref not in scrolled))
+        self._dao.clean_remote_scrolled()
+        self.assertEquals(len(list(self._dao.iter_remote_descendants(path, unscrolled=True))), len(descendants))
+        self.assertEquals(sorted(row.remote_ref for row in self._dao.get_states_from_remote_refs(scrolled)),
+                          sorted(scrolled))
+        self.assertEquals(self._dao.get_last_state_id(), max(row.id for row in self._dao.get_states_from_partial_local('/')))
+
+    def test_remote_descendants_from_ref(self):
+        root = self._dao.get_state_from_local('/')
+        remote_path = root.remote_parent_path + '/' + root.remote_ref
+        batch = [(self._get_remote_info('tree-a', root.remote_ref, 'A', folderish=True), remote_path, '/A', '/'),
+                 (self._get_remote_info('tree-ab', root.remote_ref, 'AB', folderish=True), remote_path, '/AB', '/'),
+                 (self._get_remote_info('tree-b', 'tree-a', 'B'), remote_path + '/tree-a', '/A/B', '/A'),
+                 (self._get_remote_info('tree-c', 'tree-ab', 'C'), remote_path + '/tree-ab', '/AB/C', '/AB')]
+        folder_a, _, file_b, file_c = self._dao.insert_remote_states(batch)
+        # The remote descendants are the ones below the remote path of the ref only
+        self.assertEquals([row.id for row in self._dao.get_remote_descendants_from_ref('tree-a')], [file_b.id])
+        self.assertEquals([row.id for row in self._dao.iter_remote_descendants_from_ref('tree-a')], [file_b.id])
+        self.assertEquals([row.id for row in self._dao.get_remote_descendants(remote_path + '/tree-a')],
+                          [file_b.id, file_c.id])
+        self.assertEquals(self._dao.get_remote_descendants_from_ref('unknown'), [])
+        # Without a pair of the ref the descendants are still found from the remote paths
+        c = self._dao._get_write_connection().cursor()
+        c.execute("UPDATE States SET remote_ref=NULL WHERE id=?", (folder_a.id,))
+        self._dao._get_write_connection().commit()
+        self.assertIn(file_b.id, [row.id for row in self._dao.get_remote_descendants_from_ref('tree-a')])
+        self.assertIn(file_b.id, [row.id for row in self._dao.iter_remote_descendants_from_ref('tree-a')])
+
+    def test_tree_dropped(self):
+        # The parent_id tree of the schema version 6 is not maintained anymore
+        c = self._dao._get_write_connection().cursor()
+        c.execute("CREATE TRIGGER States_tree_insert AFTER INSERT ON States BEGIN SELECT 1; END")
+        c.execute("CREATE TRIGGER States_tree_delete AFTER DELETE ON States BEGIN SELECT 1; END")
+        c.execute("UPDATE Configuration SET value='9' WHERE name='schema_version'")
+        self._dao._get_write_connection().commit()
+        self._clean_dao(self._dao)
+        self._dao = EngineDAO(self.tmp_db.name)
+        c = self._dao._get_read_connection().cursor()
+        self.assertEquals(c.execute("SELECT name FROM sqlite_master WHERE name LIKE 'States_tree_%'"
+                                    " OR name='States_parent_id'").fetchall(), [])
+        self.assertEquals(self._dao.get_config("schema_version"), "10")
+
+    def test_work_queue(self):
+        # The migration queued the processable pairs
+        self.assertEquals(self._dao.get_work_queue_size(), 2)
+        folder = self._dao.get_work_queue('remote_folder')[0]
+        self.assertEquals(folder.pair_state, 'remotely_created')
+        # The children of a folder waiting to be synchronized are left out of the pages
+        self.assertEquals(self._dao.get_work_queue_size('local_file'), 1)
+        self.assertEquals(self._dao.get_work_queue('local_file'), [])
+        root = self._dao.get_state_from_local('/')
+        remote_path = root.remote_parent_path + '/' + root.remote_ref
+        batch = [(self._get_remote_info('queue-%d' % i, root.remote_ref, 'Queue %d' % i), remote_path,
+                  '/Queue %d' % i, '/') for i in range(5)]
+        rows = self._dao.insert_remote_states(batch)
+        self.assertEquals(self._dao.get_work_queue_size('remote_file'), 5)
+        # Pages follow the (priority, row_id) key
+        first = self._dao.get_work_queue('remote_file', limit=3)
+        self.assertEquals([pair.id for pair in first], [row.id for row in rows[:3]])
+        last = self._dao.get_work_queue('remote_file', (first[-1].priority, first[-1].id), limit=3)
+        self.assertEquals([pair.id for pair in last], [row.id for row in rows[3:]])
+        self.assertEquals(self._dao.get_work_queue('remote_file', before=0), [])
+        # Synchronized and removed pairs leave the queue
+        self._dao.synchronize_state(rows[0])
+        self._dao.remove_state(rows[1])
+        self.assertEquals(self._dao.get_work_queue_size('remote_file'), 3)
+        self.assertTrue(self._dao.force_local(self._dao.get_state_from_id(rows[2].id)))
+        self.assertEquals(self._dao.get_work_queue_size('remote_file'), 2)
+        self.assertEquals(self._dao.get_work_queue_size('local_file'), 2)
+
+    def test_snapshot(self):
+        snapshot = self.get_db_temp_file()
+        self._dao.snapshot(snapshot.name)
+        con = sqlite3.connect(snapshot.name)
+        try:
+            self.assertEquals(con.execute("SELECT COUNT(*) FROM States").fetchone()[0], self._dao.get_count())
+            self.assertEquals(con.execute("PRAGMA integrity_check").fetchone()[0], "ok")
+        finally:
+            con.close()
+
+    def test_snapshot_unlocked(self):
+        # The copy is a read transaction of a pooled reader, it does not wait for the DAO lock
+        self.assertFalse(self._dao.is_wal())
+        snapshot = self.get_db_temp_file()
+        self._dao.acquire_lock()
+        try:
+            thread = Thread(target=self._dao.snapshot, args=(snapshot.name,))
+            thread.start()
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+        finally:
+            self._dao.release_lock()
+        con = sqlite3.connect(snapshot.name)
+        try:
+            self.assertEquals(con.execute("SELECT COUNT(*) FROM States").fetchone()[0], self._dao.get_count())
+        finally:
+            con.close()
+
+    def test_snapshot_file_copy(self):
+        # Without VACUUM INTO, the file is copied under the shared lock of the read transaction
+        row = self._dao.get_state_from_id(1)
+        self._dao.increase_error(row, "Snapshot")
+        snapshot = self.get_db_temp_file()
+        min_version = dao_sqlite.SNAPSHOT_MIN_SQLITE_VERSION
+        dao_sqlite.SNAPSHOT_MIN_SQLITE_VERSION = (99, 0, 0)
+        try:
+            self._dao.snapshot(snapshot.name)
+        finally:
+            dao_sqlite.SNAPSHOT_MIN_SQLITE_VERSION = min_version
+        con = sqlite3.connect(snapshot.name)
+        try:
+            self.assertEquals(con.execute("SELECT last_error FROM States WHERE id=1").fetchone()[0], "Snapshot")
+            self.assertEquals(con.execute("PRAGMA integrity_check").fetchone()[0], "ok")
+        finally:
+            con.close()
+        # The reader is given back out of its transaction
+        self._dao.increase_error(row, "Snapshot")
+
+    def test_snapshot_wal_file_copy(self):
+        # Without VACUUM INTO, the copy needs the transactions of the -wal file
+        self._clean_dao(self._dao)
+        self._dao = EngineDAO(self.tmp_db.name, wal=True)
+        row = self._dao.get_state_from_id(1)
+        self._dao.increase_error(row, "Snapshot")
+        snapshot = self.get_db_temp_file()
+        self.assertTrue(os.path.getsize(self.tmp_db.name + '-wal') > 0)
+        min_version = dao_sqlite.SNAPSHOT_MIN_SQLITE_VERSION
+        dao_sqlite.SNAPSHOT_MIN_SQLITE_VERSION = (99, 0, 0)
+        try:
+            self._dao.snapshot(snapshot.name)
+        finally:
+            dao_sqlite.SNAPSHOT_MIN_SQLITE_VERSION = min_version
+        con = sqlite3.connect(snapshot.name)
+        try:
+            self.assertEquals(con.execute("SELECT last_error FROM States WHERE id=1").fetchone()[0], "Snapshot")
+        finally:
+            con.close()
+
+    def test_incremental_vacuum(self):
+        con = sqlite3.connect(self._get_default_db())
+        try:
+            self.assertEquals(con.execute("PRAGMA auto_vacuum").fetchone()[0], 0)
+        finally:
+            con.close()
+        # The older databases are converted when opened, not by the idle vacuum
+        c = self._dao._get_write_connection().cursor()
+        self.assertEquals(c.execute("PRAGMA auto_vacuum").fetchone()[0], 2)
+        self.assertEquals(self._dao.incremental_vacuum(), 0)
+        c.execute("CREATE TABLE Vacuum(data BLOB)")
+        c.executemany("INSERT INTO Vacuum(data) VALUES(?)", [(buffer(' ' * 4096),) for _ in range(50)])
+        c.connection.commit()
+        c.execute("DROP TABLE Vacuum")
+        c.connection.commit()
+        free = c.execute("PRAGMA freelist_count").fetchone()[0]
+        self.assertTrue(free > 10)
+        self.assertEquals(self._dao.incremental_vacuum(pages=10), 10)
+        self.assertEquals(self._dao.incremental_vacuum(), free - 10)
+        self.assertEquals(c.execute("PRAGMA freelist_count").fetchone()[0], 0)
+
+    def test_retry_only_locked(self):
+        # An error that is not about a lock is raised at once
+        con = self._dao._get_write_connection()
+        retries = con.retries
+        start = time.time()
+        self.assertRaises(sqlite3.OperationalError, con.cursor().execute, "SELECT * FROM NoSuchTable")
+        self.assertEquals(con.retries, retries)
+        self.assertTrue(time.time() - start < 1)
+
+    def test_profiling(self):
+        self.assertIsNone(self._dao.get_profile())
+        # Every statement is slow with a null threshold
+        self._dao.enable_profiling(threshold=0)
+        row = self._dao.get_state_from_id(1)
+        children = self._dao.get_local_children('/')
+        self._dao.increase_error(row, "Profiling")
+        profile = self._dao.get_profile()
+        self.assertEquals(profile["get_state_from_id"]["calls"], 1)
+        self.assertEquals(profile["get_state_from_id"]["rows"], 1)
+        self.assertEquals(profile["get_local_children"]["rows"], len(children))
+        self.assertEquals(sum(profile["increase_error"]["histogram"].values()), 1)
+        self.assertIn("lock_wait", profile["increase_error"])
+        metrics = self._dao.get_metrics()
+        self.assertTrue(metrics["profile_queries"] >= 3)
+        self.assertEquals(metrics["profile_slow_queries"], metrics["profile_queries"])
+        self.assertEquals(metrics["profile_get_state_from_id_calls"], 1)
+        self.assertEquals(self._dao.get_state_from_id(1).last_error, "Profiling")
+
+    def test_profiling_fetch(self):
+        # The rows fetched after the first one are part of the statement time
+        recorder = StatementRecorder()
+        # The next read gets the connection given back to the pool
+        con = self._dao._readers.checkout()
+        self._dao._readers.checkin(con)
+        con.profiler = recorder
+        con.create_function("slow", 1, lambda value: time.sleep(0.01) or value)
+        rows = self._dao._select("SELECT slow(id) FROM States LIMIT 20")
+        self.assertEquals(len(rows), 20)
+        self.assertEquals(len(recorder.statements), 1)
+        self.assertTrue(recorder.durations[0] >= 0.15)
+
+    def test_state_cache(self):
+        row = self._dao.get_state_from_id(1)
+        metrics = self._dao.get_metrics()
+        self.assertEquals(metrics["cache_misses"], 1)
+        cached = self._dao.get_state_from_id(1)
+        self.assertEquals(self._dao.get_metrics()["cache_hits"], metrics["cache_hits"] + 1)
+        self.assertEquals(tuple(cached), tuple(row))
+        # Each hit is a new row, updates of the caller are not shared
+        cached.pair_state = 'unknown'
+        self.assertEquals(self._dao.get_state_from_id(1).pair_state, row.pair_state)
+        self.assertEquals(self._dao.get_state_from_local(row.local_path).id, 1)
+        self.assertEquals(self._dao.get_state_from_local(row.local_path).id, 1)
+        self.assertEquals([state.id for state in self._dao.get_states_from_remote(row.remote_ref)], [1])
+        self.assertIsNone(self._dao.get_state_from_local('/Unknown'))
+        self.assertIsNone(self._dao.get_state_from_local('/Unknown'))
+        # Every write invalidates the rows it touches, the version check still works on cached rows
+        self._dao.increase_error(row, "Cache")
+        self.assertEquals(self._dao.get_state_from_id(1).last_error, "Cache")
+        row = self._dao.get_state_from_id(1)
+        self._dao.update_remote_state(row, self._get_remote_info(row.remote_ref, row.remote_parent_ref, 'Renamed'),
+                                      remote_parent_path=row.remote_parent_path)
+        self.assertEquals(self._dao.get_state_from_id(1).version, row.version + 1)
+        self.assertFalse(self._dao.synchronize_state(self._dao.get_state_from_id(1), version=row.version))
+        # Bulk subtree updates invalidate every descendant
+        children = [self._dao.get_state_from_id(child.id) for child in self._dao.get_local_children('/')]
+        self._dao.mark_descendants_remotely_deleted(row)
+        for child in children:
+            self.assertEquals(self._dao.get_state_from_id(child.id).pair_state, 'remotely_deleted')
+        # Inserts invalidate the negative lookups
+        self._dao.insert_remote_states([(self._get_remote_info('cache', row.remote_ref, 'Unknown'),
+                                         row.remote_parent_path + '/' + row.remote_ref, '/Unknown', '/')])
+        self.assertIsNotNone(self._dao.get_state_from_local('/Unknown'))
+        metrics = self._dao.get_metrics()
+        self.assertTrue(metrics["cache_invalidations"] > len(children))
+        self.assertTrue(metrics["cache_size"] > 0)
+
+    def test_state_cache_reconnect(self):
+        # A new write connection gets the invalidation triggers again
+        row = self._dao.get_state_from_id(1)
+        self._dao._connections.remove(self._dao._conn)
+        self._dao._conn.close()
+        self._dao._conn = None
+        self.assertEquals(self._dao.get_state_from_id(1).last_error, row.last_error)
+        self._dao.increase_error(row, "Reconnected")
+        self.assertEquals(self._dao.get_state_from_id(1).last_error, "Reconnected")
+        # As the connections writing outside of the shared one
+        con = self._dao._create_read_conn()
+        try:
+            con.execute("UPDATE States SET last_error='Other' WHERE id=1")
+            con.commit()
+        finally:
+            con.close()
+        self.assertEquals(self._dao.get_state_from_id(1).last_error, "Other")
+
+    def test_state_cache_eviction(self):
+        self._clean_dao(self._dao)
+        self._dao = EngineDAO(self.tmp_db.name, cache_size=10)
+        for row in self._dao.get_states_from_partial_local('/'):
+            self._dao.get_state_from_id(row.id)
+        metrics = self._dao.get_metrics()
+        self.assertEquals(metrics["cache_size"], 10)
+        self.assertTrue(metrics["cache_evictions"] > 0)
+
+    def test_state_row(self):
+        row = self._dao.get_state_from_id(1)
+        self.assertIsInstance(row, StateRow)
+        self.assertFalse(hasattr(row, '__dict__'))
+        self.assertEquals(row['local_path'], row.local_path)
+        self.assertEquals(row['LOCAL_PATH'], row.local_path)
+        self.assertEquals(row[0], row.id)
+        self.assertEquals(len(row), len(row.keys()))
+        self.assertEquals(row, self._dao.get_state_from_id(1))
+        # Columns and the declared extra fields are mutable, nothing else
+        row.local_state = 'moved'
+        self.assertEquals(row.local_state, 'moved')
+        self.assertIsNone(row.error_next_try)
+        row.error_next_try = 10
+        with self.assertRaises(AttributeError):
+            row.unknown = True
+        # Expressions are reachable by index
+        c = self._dao._get_read_connection().cursor()
+        row = c.execute("SELECT COUNT(id), MAX(id) as max FROM States").fetchone()
+        self.assertEquals(row[0], self._dao.get_count())
+        self.assertEquals(row.max, row[1])
+
     def test_errors(self):
         self.assertEquals(self._dao.get_error_count(), 1)
         self.assertEquals(self._dao.get_error_count(5), 0)
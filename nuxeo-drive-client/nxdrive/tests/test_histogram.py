@@ -0,0 +1,41 @@
+import json
+import unittest
+from nxdrive.engine.histogram import Histogram, HistogramSet, get_bucket, get_bucket_value
+
+
+class HistogramTest(unittest.TestCase):
+
+    def test_buckets(self):
+        # Exact below 64, then within 1/32
+        self.assertEquals(get_bucket_value(get_bucket(63)), 63)
+        for value in (64, 100, 1000, 123456, 10 ** 9):
+            bucket_value = get_bucket_value(get_bucket(value))
+            self.assertTrue(value <= bucket_value <= value * 33 / 32.0)
+        self.assertTrue(get_bucket(10 ** 9) < 1000)
+
+    def test_percentiles(self):
+        histogram = Histogram()
+        self.assertIsNone(histogram.get_percentile(50))
+        for value in range(1, 1001):
+            histogram.record(value)
+        self.assertEquals(histogram.count, 1000)
+        self.assertEquals(histogram.min, 1)
+        self.assertEquals(histogram.max, 1000)
+        self.assertAlmostEquals(histogram.to_dict()["mean"], 500.5)
+        self.assertTrue(500 <= histogram.get_percentile(50) <= 516)
+        self.assertTrue(990 <= histogram.get_percentile(99) <= 1000)
+        self.assertEquals(histogram.get_percentile(100), 1000)
+
+    def test_set(self):
+        histograms = HistogramSet()
+        histograms.record('locally_created', 'queue', 10)
+        histograms.record('locally_created', 'queue', 30)
+        histograms.record('remotely_created', 'transfer', 2000)
+        self.assertEquals(histograms.get('locally_created', 'queue').count, 2)
+        dump = json.loads(histograms.to_json())
+        self.assertEquals(dump['locally_created']['queue']['max'], 30)
+        self.assertEquals(dump['remotely_created']['transfer']['count'], 1)
+        metrics = histograms.get_metrics()
+        self.assertEquals(metrics['locally_created_queue_count'], 2)
+        self.assertEquals(metrics['locally_created_queue_p50'], 10)
+        self.assertEquals(metrics['remotely_created_transfer_max'], 2000)
@@ -0,0 +1,82 @@
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+from nxdrive.client import local_copy
+from nxdrive.client.local_copy import LocalCopier, copy_file, detect_copy_method, CLONE, KERNEL_COPY, COPY, METHODS
+
+
+def _fail(src, dst):
+    raise OSError(95, "Operation not supported")
+
+
+class LocalCopyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(u'-nxdrive-tests')
+        self.src = os.path.join(self.folder, u'template.odt')
+        self.dst = os.path.join(self.folder, u'copy.odt')
+        self.data = os.urandom(300 * 1024)
+        with open(self.src, 'wb') as f:
+            f.write(self.data)
+        os.chmod(self.src, stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)
+        self._copiers = dict(local_copy._COPIERS)
+        self._libc_functions = dict(local_copy._libc_functions)
+
+    def tearDown(self):
+        local_copy._COPIERS.update(self._copiers)
+        local_copy._libc_functions.clear()
+        local_copy._libc_functions.update(self._libc_functions)
+        shutil.rmtree(self.folder)
+
+    def _check_copy(self):
+        with open(self.dst, 'rb') as f:
+            self.assertEquals(f.read(), self.data)
+        self.assertEquals(stat.S_IMODE(os.stat(self.dst).st_mode), stat.S_IMODE(os.stat(self.src).st_mode))
+
+    def test_copy_methods(self):
+        for method in METHODS:
+            if os.path.exists(self.dst):
+                os.remove(self.dst)
+            self.assertTrue(copy_file(self.src, self.dst, method) in METHODS[METHODS.index(method):])
+            self._check_copy()
+
+    def test_fallback(self):
+        local_copy._COPIERS[CLONE] = _fail
+        local_copy._COPIERS[KERNEL_COPY] = _fail
+        copier = LocalCopier(CLONE)
+        self.assertEquals(copier.copy(self.src, self.dst), COPY)
+        self._check_copy()
+        metrics = copier.get_metrics()
+        self.assertEquals(metrics["fallbacks"], 1)
+        self.assertEquals(metrics["copy_files"], 1)
+        self.assertEquals(metrics["copy_bytes"], len(self.data))
+        self.assertEquals(metrics["not_copied_bytes"], 0)
+        # The last method errors are raised
+        local_copy._COPIERS[COPY] = _fail
+        self.assertRaises(OSError, copy_file, self.src, self.dst)
+
+    def test_kernel_copy_short(self):
+        # A copy_file_range that stops before the end falls back on a plain copy
+        local_copy._libc_functions['copy_file_range'] = lambda *args: 0
+        copier = LocalCopier(KERNEL_COPY)
+        self.assertEquals(copier.copy(self.src, self.dst), COPY)
+        self._check_copy()
+        self.assertEquals(copier.get_metrics()["fallbacks"], 1)
+
+    def test_detect_copy_method(self):
+        method = detect_copy_method(self.folder)
+        self.assertTrue(method in METHODS)
+        # The probes are removed
+        self.assertEquals(sorted(os.listdir(self.folder)), [u'template.odt'])
+        copier = LocalCopier(method)
+        used = copier.copy(self.src, self.dst)
+        self._check_copy()
+        if used == CLONE:
+            self.assertEquals(copier.get_metrics()["not_copied_bytes"], len(self.data))
+        local_copy._COPIERS[CLONE] = _fail
+        local_copy._COPIERS[KERNEL_COPY] = _fail
+        self.assertEquals(detect_copy_method(self.folder), COPY)
+        self.assertEquals(detect_copy_method(os.path.join(self.folder, u'missing')), None)
+        self.assertEquals(LocalCopier(None).method, CLONE)
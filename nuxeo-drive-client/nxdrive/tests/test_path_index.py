@@ -0,0 +1,45 @@
+import unittest
+from threading import Thread
+from nxdrive.engine.path_index import PathIndex
+
+
+class PathIndexTest(unittest.TestCase):
+
+    def test_lookups(self):
+        index = PathIndex()
+        workers = [object() for _ in range(5)]
+        index.set(workers[0], '/A', folderish=True)
+        index.set(workers[1], '/A/file.txt')
+        index.set(workers[2], '/AB/file.txt')
+        index.set(workers[3], '/B/file.txt')
+        index.set(workers[4], '/A/file.txt')
+        self.assertEquals(len(index), 5)
+        self.assertEquals(index.get_workers('/A'), [workers[0]])
+        self.assertEquals(set(index.get_workers('/A/file.txt')), set([workers[1], workers[4]]))
+        # Same prefix semantic as startswith
+        self.assertEquals(len(index.get_workers('/A', exact_match=False)), 4)
+        self.assertEquals(index.get_workers('/C', exact_match=False), [])
+        self.assertEquals(len(index.get_workers('/', exact_match=False)), 5)
+        # A worker processes one pair at a time
+        index.set(workers[1], '/C/file.txt')
+        self.assertEquals(index.get_workers('/C/file.txt'), [workers[1]])
+        self.assertEquals(set(index.get_workers('/A/file.txt')), set([workers[4]]))
+        index.remove(workers[4])
+        index.remove(workers[4])
+        self.assertEquals(index.get_workers('/A/file.txt'), [])
+        self.assertEquals(len(index), 4)
+
+    def test_has_files(self):
+        index = PathIndex()
+        folder_worker, file_worker = object(), object()
+        index.set(folder_worker, '/A', folderish=True)
+        # The files of the calling thread are ignored
+        index.set(file_worker, '/A/file.txt')
+        self.assertFalse(index.has_files('/A'))
+        thread = Thread(target=lambda: index.set(file_worker, '/A/other.txt'))
+        thread.start()
+        thread.join()
+        self.assertTrue(index.has_files('/A'))
+        self.assertFalse(index.has_files('/B'))
+        index.remove(file_worker)
+        self.assertFalse(index.has_files('/A'))
@@ -0,0 +1,132 @@
+from threading import Event
+import time
+import unittest
+from nxdrive.engine.prefetch import RemoteInfoCache, RemoteInfoPrefetcher
+from nxdrive.engine.queue_manager import QueueItem
+from nxdrive.engine.scheduler import Scheduler, ScheduledQueue
+
+
+class FakePair(object):
+    def __init__(self, row_id, pair_state, remote_ref):
+        self.id = row_id
+        self.pair_state = pair_state
+        self.remote_ref = remote_ref
+
+
+class FakeDAO(object):
+    def __init__(self, pairs):
+        self.pairs = dict((pair.id, pair) for pair in pairs)
+
+    def get_states_from_ids(self, row_ids):
+        return [self.pairs[row_id] for row_id in row_ids if row_id in self.pairs]
+
+
+class FakeQueueManager(object):
+    def __init__(self):
+        self.queues = dict(local_file=ScheduledQueue('local_file', Scheduler()),
+                           local_folder=ScheduledQueue('local_folder', Scheduler()))
+
+    def peek(self, kind, count):
+        return self.queues[kind].peek(count)
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.calls = []
+        self.blocked = dict()
+
+    def get_info(self, ref, raise_if_missing=True):
+        self.calls.append(ref)
+        if ref in self.blocked:
+            self.blocked[ref].wait()
+        if ref == 'error':
+            raise IOError()
+        return None if ref == 'missing' else 'info of ' + ref
+
+
+class FakeEngine(object):
+    def __init__(self):
+        self.queue_manager = FakeQueueManager()
+        self.client = FakeClient()
+
+    def get_queue_manager(self):
+        return self.queue_manager
+
+    def get_remote_client(self):
+        return self.client
+
+
+class RemoteInfoCacheTest(unittest.TestCase):
+
+    def test_ttl(self):
+        cache = RemoteInfoCache(ttl=10)
+        cache.put('ref1', 'info1', now=0)
+        cache.put('ref2', 'info2', now=0)
+        self.assertEquals(cache.pop('ref1', now=5), 'info1')
+        # Consumed once
+        self.assertIsNone(cache.pop('ref1', now=5))
+        self.assertIsNone(cache.pop('ref2', now=11))
+        cache.put('ref3', 'info3', now=0)
+        cache.put('ref4', 'info4', now=20)
+        cache.invalidate('ref4')
+        self.assertEquals(len(cache), 1)
+        cache.clear(now=20)
+        self.assertEquals(len(cache), 0)
+        self.assertEquals(cache.get_metrics(), dict(size=0, hits=1, misses=2))
+
+
+class RemoteInfoPrefetcherTest(unittest.TestCase):
+
+    def test_prefetch(self):
+        engine = FakeEngine()
+        pairs = [FakePair(1, 'locally_modified', 'ref1'), FakePair(2, 'locally_created', None),
+                 FakePair(3, 'locally_moved', 'missing'), FakePair(4, 'locally_modified', 'error'),
+                 FakePair(5, 'locally_moved', 'ref5'), FakePair(6, 'locally_modified', 'ref6')]
+        for pair in pairs:
+            kind = 'local_folder' if pair.id == 5 else 'local_file'
+            engine.queue_manager.queues[kind].put(QueueItem(pair.id, kind == 'local_folder', pair.pair_state))
+        cache = RemoteInfoCache()
+        prefetcher = RemoteInfoPrefetcher(engine, FakeDAO(pairs), cache, fetchers=2, lookahead=4)
+        self.addCleanup(prefetcher._stop_fetchers)
+        self.assertTrue(prefetcher._poll())
+        prefetcher._refs.join()
+        # The first 4 files and the folder, without remote ref for the creation
+        self.assertEquals(sorted(engine.client.calls), ['error', 'missing', 'ref1', 'ref5'])
+        self.assertEquals(len(cache), 2)
+        self.assertEquals(prefetcher.get_metrics()['prefetch_errors'], 1)
+        self.assertEquals(cache.pop('ref1'), 'info of ref1')
+        # The queued items are untouched and the cached infos are not fetched again
+        self.assertEquals(engine.queue_manager.queues['local_file'].qsize(), 5)
+        engine.client.calls = []
+        prefetcher._poll()
+        prefetcher._refs.join()
+        self.assertEquals(sorted(engine.client.calls), ['error', 'missing', 'ref1'])
+        # The same fetchers are used on each poll
+        self.assertEquals(len(prefetcher._threads), 2)
+        threads = list(prefetcher._threads)
+        prefetcher._stop_fetchers()
+        self.assertFalse(any(thread.is_alive() for thread in threads))
+
+    def test_in_flight(self):
+        engine = FakeEngine()
+        pairs = [FakePair(1, 'locally_modified', 'ref1'), FakePair(2, 'locally_modified', 'ref2')]
+        for pair in pairs:
+            engine.queue_manager.queues['local_file'].put(QueueItem(pair.id, False, pair.pair_state))
+        released = Event()
+        engine.client.blocked['ref1'] = released
+        prefetcher = RemoteInfoPrefetcher(engine, FakeDAO(pairs), RemoteInfoCache(), fetchers=2)
+        self.addCleanup(prefetcher._stop_fetchers)
+        self.addCleanup(released.set)
+        prefetcher._poll()
+        for _ in range(500):
+            if 'ref2' in prefetcher._cache:
+                break
+            time.sleep(0.01)
+        # ref1 is still being fetched, it is not queued again
+        for _ in range(3):
+            prefetcher._poll()
+        self.assertEquals(prefetcher.get_metrics()['in_flight'], 1)
+        released.set()
+        prefetcher._refs.join()
+        self.assertEquals(sorted(engine.client.calls), ['ref1', 'ref2'])
+        self.assertEquals(prefetcher.get_metrics()['in_flight'], 0)
@@ -0,0 +1,101 @@
+import unittest
+from PyQt4.QtCore import QObject, pyqtSignal
+from nxdrive.engine.processor import Processor
+from nxdrive.engine.queue_manager import QueueItem
+
+
+class FakePair(object):
+    def __init__(self, row_id, pair_state):
+        self.id = row_id
+        self.pair_state = pair_state
+        self.version = 0
+        self.local_path = u'/file.txt'
+        self.local_parent_path = u'/'
+        self.remote_ref = None
+
+
+class FakeLocalClient(object):
+    def exists(self, path):
+        return True
+
+
+class FakeQueueManager(object):
+    def __init__(self):
+        self.errors = []
+
+    def set_processing(self, worker, doc_pair):
+        pass
+
+    def push_error(self, doc_pair, exception=None, interval=None):
+        self.errors.append(doc_pair)
+
+
+class FakeDAO(object):
+    def __init__(self, pair_state):
+        self.pair_state = pair_state
+        self.claimed = None
+
+    def acquire_state(self, thread_id, row_id):
+        self.claimed = row_id
+        return FakePair(row_id, self.pair_state)
+
+    def release_state(self, thread_id):
+        self.claimed = None
+
+    def increase_error(self, doc_pair, error, details=None, incr=1):
+        pass
+
+
+class FakeEngine(QObject):
+    invalidClientsCache = pyqtSignal()
+
+    def __init__(self, dao):
+        super(FakeEngine, self).__init__()
+        self._dao = dao
+        self._queue_manager = FakeQueueManager()
+
+    def get_dao(self):
+        return self._dao
+
+    def get_uid(self):
+        return 'engine'
+
+    def get_queue_manager(self):
+        return self._queue_manager
+
+    def get_local_client(self):
+        return FakeLocalClient()
+
+    def get_remote_client(self):
+        return None
+
+
+class ProcessorTest(unittest.TestCase):
+
+    def _run(self, pair_state):
+        # Record the claim and the soft locks while the processor waits for its next item
+        dao = FakeDAO(pair_state)
+        items = [QueueItem(1, False, pair_state)]
+        waits = []
+
+        def get_item():
+            waits.append((dao.claimed, dict(Processor.soft_locks.get('engine', dict()))))
+            return items.pop() if items else None
+        processor = Processor(FakeEngine(dao), get_item)
+        processor._continue = True
+        processor._execute()
+        return waits, processor
+
+    def test_release_before_waiting(self):
+        # Skipped pair
+        waits, _ = self._run('synchronized')
+        self.assertEquals(waits, [(None, dict()), (None, dict())])
+        # Pair without handler
+        waits, processor = self._run('unknown_state')
+        self.assertEquals(waits, [(None, dict()), (None, dict())])
+        self.assertEquals(len(processor._engine.get_queue_manager().errors), 1)
+        # Failing handler, run with the soft lock on its path
+        waits, processor = self._run('locally_modified')
+        self.assertEquals(waits, [(None, dict()), (None, dict())])
+        self.assertEquals(len(processor._engine.get_queue_manager().errors), 1)
+        self.assertIsNone(processor._soft_lock)
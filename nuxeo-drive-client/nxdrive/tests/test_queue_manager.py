@@ -0,0 +1,249 @@
+import unittest
+import sqlite3
+from threading import Lock, Thread
+import time
+from nxdrive.engine.queue_manager import QueueManager, QueueItem
+
+
+class FakeEngine(object):
+    def __init__(self):
+        self.stopped = False
+
+    def is_stopped(self):
+        return self.stopped
+
+    def cancel_action_on(self, row_id):
+        pass
+
+
+class FakeDAO(object):
+    def register_queue_manager(self, manager):
+        pass
+
+    def get_work_queue(self, kind, after=(-1, 0), before=None, limit=1000):
+        return []
+
+    def get_work_queue_size(self, kind=None):
+        return 0
+
+
+class FailingDAO(FakeDAO):
+    def get_work_queue(self, kind, after=(-1, 0), before=None, limit=1000):
+        raise sqlite3.OperationalError("disk I/O error")
+
+
+class FakeThread(object):
+    # Stands for a processor QThread of the pool
+    def __init__(self, ident):
+        self.worker = self
+        self._ident = ident
+
+    def get_thread_id(self):
+        return self._ident
+
+
+class FakeConcurrency(object):
+    def __init__(self, limit):
+        self.limit = limit
+
+    def adjust(self, backlog):
+        return self.limit
+
+
+class QueueManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = FakeEngine()
+        self.manager = QueueManager(self.engine, FakeDAO(), idle_timeout=0.5)
+
+    def _start(self, getter):
+        result = []
+        thread = Thread(target=lambda: result.append(getter()))
+        thread.start()
+        return thread, result
+
+    def test_processors_wait_for_push(self):
+        thread, result = self._start(self.manager._get_remote_file)
+        time.sleep(0.2)
+        # A waiting processor is idle
+        self.assertTrue(thread.is_alive())
+        self.assertEquals(self.manager._waiting_processors, 1)
+        start = time.time()
+        self.manager.push(QueueItem(1, False, 'remotely_created'))
+        thread.join(2)
+        self.assertFalse(thread.is_alive())
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEquals(result[0].id, 1)
+        self.assertEquals(self.manager._waiting_processors, 0)
+
+    def test_processors_end(self):
+        # Disabling the queue ends its processor
+        thread, result = self._start(self.manager._get_local_folder)
+        time.sleep(0.2)
+        self.manager._local_folder_enable = False
+        self.manager._notify_processors()
+        thread.join(2)
+        self.assertEquals(result, [None])
+        # So does stopping the engine
+        thread, result = self._start(self.manager._get_local_file)
+        time.sleep(0.2)
+        self.engine.stopped = True
+        thread.join(3)
+        self.assertEquals(result, [None])
+
+    def test_generic_processors_pool(self):
+        # Idle generic processors above the core size end after the idle timeout
+        self.manager._core_processors = 1
+        first, first_result = self._start(self.manager._get_file)
+        second, second_result = self._start(self.manager._get_file)
+        time.sleep(2.5)
+        self.assertEquals([first.is_alive(), second.is_alive()].count(True), 1)
+        self.manager.push(QueueItem(2, False, 'locally_modified'))
+        first.join(2)
+        second.join(2)
+        items = [result[0] for result in (first_result, second_result) if result[0] is not None]
+        self.assertEquals([item.id for item in items], [2])
+
+    def test_generic_processors_retired(self):
+        # Lowering the maximum ends the generic processors already waiting, without the idle timeout
+        self.manager._core_processors = 1
+        self.manager._max_processors = 1
+        thread, result = self._start(self.manager._get_file)
+        time.sleep(0.2)
+        self.assertTrue(thread.is_alive())
+        self.manager._processors_pool.append(FakeThread(thread.ident))
+        self.manager._concurrency = FakeConcurrency(0)
+        self.manager._adjust_concurrency()
+        thread.join(0.2)
+        self.assertFalse(thread.is_alive())
+        self.assertEquals(result, [None])
+        self.assertEquals(self.manager._processors_pool, [])
+
+    def test_file_processors_on(self):
+        # The pairs in process are looked at, not the processors: a folder does not block, a file does
+        folder_worker, file_worker = object(), object()
+        thread = Thread(target=self.manager.set_processing,
+                        args=(folder_worker, QueueItem(1, True, 'remotely_moved', local_path='/A/B')))
+        thread.start()
+        thread.join()
+        self.assertFalse(self.manager.has_file_processors_on('/A'))
+        self.assertEquals(self.manager.get_processors_on('/A', exact_match=False), [folder_worker])
+        thread = Thread(target=self.manager.set_processing,
+                        args=(file_worker, QueueItem(2, False, 'remotely_modified', local_path='/A/B/file.txt')))
+        thread.start()
+        thread.join()
+        self.assertTrue(self.manager.has_file_processors_on('/A'))
+        self.assertFalse(self.manager.has_file_processors_on('/C'))
+        # The caller own pair does not block it
+        self.manager.set_processing(file_worker, QueueItem(2, False, 'remotely_modified', local_path='/A/B/file.txt'))
+        self.assertFalse(self.manager.has_file_processors_on('/A'))
+        self.manager.set_processing(file_worker, None)
+        self.assertEquals(self.manager.get_processors_on('/A/B/file.txt'), [])
+
+    def test_delayed_pairs(self):
+        pair = QueueItem(3, False, 'locally_modified')
+        pair.error_count = 1
+        self.manager.push_error(pair, interval=60)
+        self.assertEquals(self.manager.get_errors_count(), 1)
+        # The timer wakes when the error is due
+        self.assertTrue(59000 <= self.manager._error_timer.interval() <= 60001)
+        later = QueueItem(4, False, 'remotely_modified')
+        self.manager.push_later(later, interval=0)
+        self.assertTrue(self.manager._error_timer.interval() <= 1)
+        self.manager._on_error_timer()
+        self.assertEquals([item.id for item in self.manager._remote_file_queue.get_items()], [4])
+        self.assertEquals(self.manager.get_errors_count(), 1)
+        self.manager.requeue_errors()
+        self.manager._on_error_timer()
+        self.assertEquals([item.id for item in self.manager._local_file_queue.get_items()], [3])
+        self.assertEquals(self.manager.get_errors_count(), 0)
+        self.assertFalse(self.manager._error_timer.isActive())
+
+    def test_folders_dependencies(self):
+        for row_id, path, parent in ((1, '/A', '/'), (2, '/A/B', '/A'), (3, '/C/D', '/C'), (4, '/A/B/E', '/A/B')):
+            self.manager.push(QueueItem(row_id, True, 'locally_created', priority=path.count('/'),
+                                        local_path=path, local_parent_path=parent))
+        # Two workers: /A and /C/D run concurrently, /A/B waits for /A
+        self.assertEquals(self.manager._get_file().id, 1)
+        thread, result = self._start(self.manager._get_file)
+        thread.join(2)
+        self.assertEquals(result[0].id, 3)
+        self.assertEquals(self.manager.get_blocked_folders_count(), 1)
+        self.assertEquals(self.manager.get_overall_size(), 2)
+        # Asking the next item ends /A and releases its child
+        self.assertEquals(self.manager._get_file().id, 2)
+        self.assertEquals(self.manager.get_blocked_folders_count(), 0)
+        self.assertEquals(self.manager._get_file().id, 4)
+        # The folders of an ended processor are released
+        self.assertEquals(sorted(self.manager._folders_in_process), ['/A/B/E', '/C/D'])
+        self.manager._release_dead_folders()
+        self.assertEquals(self.manager._folders_in_process.keys(), ['/A/B/E'])
+
+    def test_folders_ancestors(self):
+        # The promoted folders are popped first, they still wait for all their queued ancestors
+        for row_id, path, parent in ((1, '/P/C/G', '/P/C'), (2, '/P/C', '/P'), (3, '/P', '/'), (4, '/Q', '/')):
+            self.manager.push(QueueItem(row_id, True, 'locally_created', local_path=path, local_parent_path=parent))
+        self.assertTrue(self.manager.promote(1))
+        self.assertTrue(self.manager.promote(2))
+        events = []
+        lock = Lock()
+
+        def work():
+            while True:
+                item = self.manager._get_file()
+                if item is None:
+                    return
+                lock.acquire()
+                events.append(('start', item.id))
+                lock.release()
+                time.sleep(0.1)
+                lock.acquire()
+                events.append(('end', item.id))
+                if len([event for event in events if event[0] == 'end']) == 4:
+                    self.engine.stopped = True
+                lock.release()
+        threads = [Thread(target=work) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        self.assertFalse(any(thread.is_alive() for thread in threads))
+        self.assertEquals(len(events), 8)
+        # Each folder starts once its ancestors are done
+        for parent, child in ((3, 2), (2, 1)):
+            self.assertTrue(events.index(('end', parent)) < events.index(('start', child)))
+        self.assertEquals(self.manager.get_blocked_folders_count(), 0)
+        self.assertEquals(self.manager._blocked_paths, dict())
+
+    def test_promote_queued_only(self):
+        self.manager.push(QueueItem(7, False, 'remotely_created'))
+        self.assertFalse(self.manager.promote(8))
+        self.assertFalse(self.manager.get_scheduler().is_promoted(8))
+        self.assertTrue(self.manager.promote(7))
+        self.assertTrue(self.manager.get_scheduler().is_promoted(7))
+        self.assertEquals(self.manager._get_remote_file().id, 7)
+        self.assertFalse(self.manager.get_scheduler().is_promoted(7))
+
+    def test_fill_queue_error(self):
+        # The error of the DAO reaches the caller, the page is read again on the next fill
+        self.manager._dao = FailingDAO()
+        self.assertRaises(sqlite3.OperationalError, self.manager._fill_queue, 'remote_file')
+        self.assertEquals(self.manager._queue_pages['remote_file'], (-1, 0))
+        self.manager._dao = FakeDAO()
+        self.manager._fill_queue('remote_file')
+        self.assertNotIn('remote_file', self.manager._queue_pages)
+
+    def test_latency(self):
+        self.manager.push(QueueItem(6, False, 'remotely_created'))
+        item = self.manager._get_remote_file()
+        self.assertTrue(item.timestamps["dequeued"] >= item.timestamps["queued"])
+        queued = int(item.timestamps["queued"] * 1000)
+        self.manager._on_pair_sync(None, dict(handler='remotely_created', queued=queued, queue_time=5,
+                                              acquire_time=1, start_time=queued + 10, transfer_time=100,
+                                              transfer_end=queued + 120, end_time=queued + 130))
+        metrics = self.manager.get_metrics()
+        self.assertEquals(metrics["latency_remotely_created_queue_count"], 1)
+        self.assertEquals(metrics["latency_remotely_created_handler_max"], 120)
+        self.assertEquals(metrics["latency_remotely_created_finalize_max"], 10)
+        self.assertEquals(metrics["latency_remotely_created_total_max"], 130)
+        self.assertIn('"transfer"', self.manager.get_latency())
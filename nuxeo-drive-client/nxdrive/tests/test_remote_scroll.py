@@ -0,0 +1,104 @@
+import unittest
+import os
+import sys
+import tempfile
+from PyQt4.QtCore import QObject, pyqtSignal
+from nxdrive.engine.dao.sqlite import EngineDAO
+from nxdrive.engine.watcher.remote_watcher import RemoteWatcher
+from nxdrive.client.remote_file_system_client import RemoteFileInfo
+
+
+class FakeLocalClient(object):
+    def exists(self, path):
+        return False
+
+
+class FakeRemoteClient(object):
+    # Returns each batch of descendants on a scroll request, then none
+    def __init__(self, batches):
+        self.batches = list(batches)
+
+    def scroll_descendants(self, uid, scroll_id, batch_size=100):
+        descendants = self.batches.pop(0) if self.batches else []
+        return dict(scroll_id='scroll', descendants=descendants)
+
+
+class FakeEngine(QObject):
+    invalidClientsCache = pyqtSignal()
+
+    def get_local_client(self):
+        return FakeLocalClient()
+
+
+class RemoteScrollTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_db = tempfile.NamedTemporaryFile(suffix="test_db")
+        if sys.platform == 'win32':
+            self.tmp_db.close()
+        os.remove(self.tmp_db.name)
+        self._dao = EngineDAO(self.tmp_db.name)
+        self._infos = dict()
+        root = self._get_info('root', 'org', 'Root', folderish=True)
+        self._dao.insert_remote_states([(root, '/org', '/', '')])
+        self._root_info = root
+        self._watcher = RemoteWatcher(FakeEngine(), self._dao, 30)
+        self._watcher._continue = True
+
+    def tearDown(self):
+        self._dao.dispose()
+        if os.path.exists(self.tmp_db.name):
+            os.remove(self.tmp_db.name)
+
+    def _get_info(self, uid, parent_uid, name, folderish=False):
+        info = RemoteFileInfo(name, uid, parent_uid, '/' + name, folderish, None, 'Administrator',
+                              None if folderish else 'digest-' + uid, 'md5', None, True, True, True, folderish,
+                              None, None, True)
+        self._infos[uid] = info
+        return info
+
+    def _store(self, *children):
+        # Known pairs: (uid, parent uid, folderish), the parents first
+        batch = []
+        for uid, parent_uid, folderish in children:
+            parent = self._dao.get_normal_state_from_remote(parent_uid)
+            if parent is None:
+                self._dao.insert_remote_states(batch)
+                del batch[:]
+                parent = self._dao.get_normal_state_from_remote(parent_uid)
+            info = self._get_info(uid, parent_uid, uid, folderish=folderish)
+            local_parent_path = '' if parent.local_path == '/' else parent.local_path
+            batch.append((info, parent.remote_parent_path + '/' + parent_uid, local_parent_path + '/' + uid,
+                          parent.local_path))
+        self._dao.insert_remote_states(batch)
+
+    def _scroll(self, *batches):
+        self._watcher._client = FakeRemoteClient([[self._infos.get(uid) or self._get_info(uid, parent_uid, uid)
+                                                   for uid, parent_uid in batch] for batch in batches])
+        root = self._dao.get_normal_state_from_remote('root')
+        self._watcher._scan_remote_scroll(root, self._root_info)
+
+    def _get_pairs(self, uid):
+        return [pair for pair in self._dao.get_states_from_partial_local('/') if pair.remote_ref == uid]
+
+    def test_scroll_batches_of_several_parents(self):
+        # The known pairs of a later batch stay known after the creations under another parent
+        self._store(('A', 'root', True), ('a1', 'A', False), ('B', 'root', True), ('b1', 'B', False))
+        self._scroll([('A', 'root'), ('B', 'root'), ('b1', 'B'), ('b2', 'B')], [('a1', 'A'), ('a2', 'A')])
+        for uid in ('A', 'a1', 'B', 'b1', 'a2', 'b2'):
+            self.assertEquals(len(self._get_pairs(uid)), 1, uid)
+        self.assertEquals(self._get_pairs('a1')[0].local_path, '/A/a1')
+        self.assertNotEquals(self._get_pairs('a1')[0].pair_state, 'remotely_deleted')
+        self.assertEquals(self._get_pairs('a2')[0].local_path, '/A/a2')
+        self.assertEquals(self._get_pairs('a2')[0].remote_parent_path, '/org/root/A')
+        self.assertEquals(self._get_pairs('b2')[0].remote_parent_path, '/org/root/B')
+
+    def test_scroll_deletion_outside_last_parent(self):
+        # The pairs not scrolled are deleted anywhere below the scan root
+        self._store(('A', 'root', True), ('a1', 'A', False), ('a3', 'A', False), ('B', 'root', True),
+                    ('b1', 'B', False))
+        self._scroll([('A', 'root'), ('a1', 'A'), ('B', 'root')], [('b1', 'B'), ('b2', 'B')])
+        self.assertEquals(self._get_pairs('a3')[0].pair_state, 'remotely_deleted')
+        for uid in ('A', 'a1', 'B', 'b1'):
+            self.assertNotEquals(self._get_pairs(uid)[0].pair_state, 'remotely_deleted', uid)
+        self.assertEquals(len(self._get_pairs('b2')), 1)
@@ -0,0 +1,99 @@
+import unittest
+from nxdrive.engine.scheduler import Scheduler, ScheduledQueue, get_size_class
+
+
+class Item(object):
+    def __init__(self, row_id, folderish=False, size=None, touched=None, priority=None, local_path=None):
+        self.id = row_id
+        self.folderish = folderish
+        self.size = size
+        self.touched = touched
+        self.priority = priority
+        self.local_path = local_path
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def _drain(self, queue):
+        result = []
+        while not queue.empty():
+            result.append(queue.get().id)
+        return result
+
+    def test_size_class(self):
+        self.assertEquals(get_size_class(None), 0)
+        self.assertEquals(get_size_class(0), 0)
+        self.assertTrue(get_size_class(10) < get_size_class(1000) < get_size_class(5 * 1024 ** 3))
+        self.assertEquals(get_size_class(1000), get_size_class(1010))
+
+    def test_priorities(self):
+        queue = ScheduledQueue('remote_file', Scheduler())
+        queue.put(Item(1, size=5 * 1024 ** 3, touched=10))
+        queue.put(Item(2, size=100, touched=10))
+        queue.put(Item(3, size=100, touched=20))
+        queue.put(Item(4, size=2000, touched=30))
+        queue.put(Item(5, size=100, touched=20))
+        # Smaller first, then the least recently touched, then FIFO
+        self.assertEquals([item.id for item in queue.get_items()], [2, 3, 5, 4, 1])
+        self.assertEquals(self._drain(queue), [2, 3, 5, 4, 1])
+        # The size outranks the depth for the files
+        queue = ScheduledQueue('remote_file', Scheduler())
+        queue.put(Item(1, size=5 * 1024 ** 3, touched=10, local_path='/Import/big.iso'))
+        for row_id in range(2, 6):
+            queue.put(Item(row_id, size=100, touched=10, local_path='/Import/sub/deep/%d.txt' % row_id))
+        queue.put(Item(6, size=2000, touched=10, local_path='/Import/medium.txt'))
+        self.assertEquals(self._drain(queue), [2, 3, 4, 5, 6, 1])
+        # Shallower folders first, the depth of the pushed items is the one of the paged items
+        queue = ScheduledQueue('local_folder', Scheduler())
+        queue.put(Item(1, folderish=True, priority=3))
+        queue.put(Item(2, folderish=True, priority=1))
+        queue.put(Item(3, folderish=True, local_path='/A/B'))
+        queue.put(Item(4, folderish=True, local_path='/A/B/C/D'))
+        self.assertEquals(self._drain(queue), [2, 3, 1, 4])
+
+    def test_promote(self):
+        scheduler = Scheduler()
+        queue = ScheduledQueue('remote_file', scheduler)
+        for row_id in range(1, 5):
+            queue.put(Item(row_id, size=row_id * 1000))
+        scheduler.promote(4)
+        self.assertTrue(queue.update_priority(4))
+        self.assertFalse(queue.update_priority(5))
+        self.assertEquals(self._drain(queue), [4, 1, 2, 3])
+        self.assertFalse(scheduler.is_promoted(4))
+        scheduler.promote(5)
+        scheduler.demote(5)
+        self.assertFalse(scheduler.is_promoted(5))
+        metrics = scheduler.get_metrics()
+        self.assertEquals(metrics["promoted_wait_count"], 1)
+        self.assertEquals(metrics["remote_file_wait_count"], 3)
+        self.assertTrue(metrics["remote_file_wait_max"] >= metrics["remote_file_wait_avg"] >= 0)
+
+    def test_weighted_fairness(self):
+        scheduler = Scheduler(local_weight=1, remote_weight=3)
+        choices = [scheduler.choose(['local', 'remote']) for _ in range(8)]
+        self.assertEquals(choices.count('remote'), 6)
+        self.assertEquals(choices.count('local'), 2)
+        self.assertEquals(scheduler.choose(['local']), 'local')
+        self.assertIsNone(scheduler.choose([]))
+
+    def test_coalescing(self):
+        queue = ScheduledQueue('local_file', Scheduler())
+        queue.put(Item(1, size=100))
+        queue.put(Item(2, size=100))
+        first = Item(3, size=100)
+        queue.put(first)
+        # Pushing again replaces the queued item and its priority
+        second = Item(3, size=5 * 1024 ** 3)
+        queue.put(second)
+        queue.put(Item(1, size=100))
+        self.assertEquals(queue.qsize(), 3)
+        self.assertEquals(queue.coalesced, 2)
+        self.assertEquals([item.id for item in queue.get_items()], [1, 2, 3])
+        self.assertIs(queue.get_items()[2], second)
+        self.assertTrue(queue.discard(2))
+        self.assertFalse(queue.discard(2))
+        self.assertEquals(self._drain(queue), [1, 3])
+        self.assertEquals(queue.queue, [])
+        queue.put(Item(3))
+        self.assertEquals(self._drain(queue), [3])
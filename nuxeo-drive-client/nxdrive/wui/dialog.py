@@ -448,7 +448,7 @@ class WebDriveApi(QtCore.QObject):
             if engine is None:
                 return result
             result = []
-            for conflict in engine.get_errors():
+            for conflict in engine.get_dao().iter_errors():
                 result.append(self._export_state(conflict))
             return self._json(result)
         except Exception as e:
@@ -473,7 +473,7 @@ class WebDriveApi(QtCore.QObject):
             if engine is None:
                 return result
             result = []
-            for conflict in engine.get_dao().get_unsynchronizeds():
+            for conflict in engine.get_dao().iter_unsynchronizeds():
                 result.append(self._export_state(conflict))
             return self._json(result)
         except Exception as e:
@@ -488,7 +488,7 @@ class WebDriveApi(QtCore.QObject):
             if engine is None:
                 return result
             result = []
-            for conflict in engine.get_conflicts():
+            for conflict in engine.get_dao().iter_conflicts():
                 result.append(self._export_state(conflict))
             return self._json(result)
         except Exception as e:
@@ -636,6 +636,7 @@ class WebDriveApi(QtCore.QObject):
             engine = self._get_engine(uid)
             if engine is None:
                 return "ERROR"
+            engine.promote(path)
             filepath = engine.get_abspath(path)
             self._manager.open_local_file(filepath)
         except Exception as e:
@@ -0,0 +1,247 @@
+'''
+Time the EngineDAO queries and mutations on synthetic databases shaped like a real tree
+
+Usage: python dao.py [--rows 10000,100000,1000000] [--output results.json] [--compare base.json]
+
+Run it from the nuxeo-drive-client folder of each branch with the same --rows and seed
+then compare the JSON results, ratios above 1 are slower than the base.
+'''
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+from time import time
+
+from nxdrive.engine.dao.sqlite import EngineDAO
+try:
+    from nxdrive.engine.dao.sqlite import STATE_CODES
+except ImportError:
+    # The states are stored by name before the schema version 8
+    STATE_CODES = None
+
+FOLDERS_PER_FOLDER = 8
+FILES_PER_FOLDER = 25
+MAX_DEPTH = 7
+SAMPLES = 100
+# local_state, remote_state, pair_state and weight of the pairs
+PAIR_STATES = (
+    ('synchronized', 'synchronized', 'synchronized', 900),
+    ('modified', 'synchronized', 'locally_modified', 20),
+    ('created', 'unknown', 'locally_created', 20),
+    ('synchronized', 'modified', 'remotely_modified', 20),
+    ('unknown', 'created', 'remotely_created', 20),
+    ('modified', 'modified', 'conflicted', 10),
+    ('synchronized', 'synchronized', 'unsynchronized', 10),
+)
+QUEUE_KINDS = ('local_folder', 'local_file', 'remote_folder', 'remote_file')
+
+
+class QueueManagerStub(object):
+    def __init__(self):
+        self.pushed = 0
+
+    def push_ref(self, row_id, folderish, pair_state):
+        self.pushed += 1
+
+
+def pick_state(rand):
+    weight = rand.randint(1, sum(state[3] for state in PAIR_STATES))
+    for state in PAIR_STATES:
+        weight -= state[3]
+        if weight <= 0:
+            return state[:3]
+
+
+def generate_tree(count, rand):
+    # Breadth first so every depth is represented whatever the count
+    root = ('/', '', '', 'ref-0', 'root', '/root', 1)
+    rows = [root]
+    folders = [(root, 1)]
+    while folders and len(rows) < count:
+        next_folders = []
+        for (local_path, _, _, remote_ref, _, remote_path, _), depth in folders:
+            prefix = '' if local_path == '/' else local_path
+            for i in xrange(FILES_PER_FOLDER + (FOLDERS_PER_FOLDER if depth < MAX_DEPTH else 0)):
+                if len(rows) >= count:
+                    break
+                folderish = i >= FILES_PER_FOLDER
+                name = ('Folder %d' if folderish else 'File %d.txt') % i
+                row = (prefix + '/' + name, local_path, name, 'ref-%d' % len(rows), remote_ref,
+                       remote_path + '/' + remote_ref, int(folderish))
+                rows.append(row)
+                if folderish:
+                    next_folders.append((row, depth + 1))
+        folders = next_folders
+    for row in rows:
+        local_state, remote_state, pair_state = ('synchronized',) * 3 if row[0] == '/' else pick_state(rand)
+        size = 0 if row[6] else rand.randint(1, 10000000)
+        digest = None if row[6] else '%032x' % rand.getrandbits(128)
+        error_count = 4 if pair_state != 'synchronized' and rand.randint(0, 20) == 0 else 0
+        yield row + (size, encode_state(local_state), encode_state(remote_state), encode_state(pair_state),
+                     digest, digest, error_count)
+
+
+def encode_state(name):
+    return name if STATE_CODES is None else STATE_CODES[name]
+
+
+def create_database(path, count, seed):
+    rand = random.Random(seed)
+    # Let the DAO create the schema, its triggers keep up with the raw inserts
+    EngineDAO(path).dispose()
+    con = sqlite3.connect(path)
+    start = time()
+    con.executemany("INSERT INTO States(local_path, local_parent_path, local_name, remote_ref, remote_parent_ref,"
+                    " remote_parent_path, folderish, size, local_state, remote_state, pair_state, local_digest,"
+                    " remote_digest, error_count, remote_name, last_sync_date)"
+                    " VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (row + (row[2], datetime.utcnow()) for row in generate_tree(count, rand)))
+    folders = [row[0] for row in con.execute("SELECT local_path FROM States WHERE folderish=1")]
+    con.executemany("INSERT INTO Filters(path) VALUES(?)",
+                    ((path + '/',) for path in rand.sample(folders, min(len(folders) // 100 + 1, len(folders)))))
+    con.executemany("INSERT INTO RemoteScan(path) VALUES(?)", ((path,) for path in folders[:len(folders) // 2]))
+    con.executemany("INSERT INTO ToRemoteScan(path) VALUES(?)", ((path,) for path in folders[len(folders) // 2:]))
+    con.commit()
+    con.close()
+    return time() - start
+
+
+def measure(results, name, function, args_list):
+    if function is None:
+        # Not available on this branch
+        return
+    durations = []
+    for args in args_list:
+        start = time()
+        function(*args)
+        durations.append(time() - start)
+    if not durations:
+        return
+    durations.sort()
+    results[name] = {"runs": len(durations), "mean": 1000 * sum(durations) / len(durations),
+                     "median": 1000 * durations[len(durations) // 2], "max": 1000 * durations[-1]}
+    print "  %-32s %6d runs  mean %9.3fms  median %9.3fms  max %9.3fms" % (
+        name, len(durations), results[name]["mean"], results[name]["median"], results[name]["max"])
+
+
+def queue_startup(dao):
+    dao.register_queue_manager(QueueManagerStub())
+    if hasattr(dao, 'get_work_queue'):
+        for kind in QUEUE_KINDS:
+            dao.get_work_queue(kind)
+
+
+def benchmark(path):
+    dao = EngineDAO(path)
+    results = dict()
+    con = sqlite3.connect(path)
+    ids = [row[0] for row in con.execute("SELECT id FROM States ORDER BY random() LIMIT ?", (SAMPLES,))]
+    pendings = [row[0] for row in con.execute("SELECT id FROM States WHERE pair_state NOT IN (?, ?, ?) LIMIT ?",
+                                              [encode_state(state) for state in
+                                               ('synchronized', 'unsynchronized', 'conflicted')] + [SAMPLES])]
+    folders = [row[0] for row in con.execute("SELECT id FROM States WHERE folderish=1 ORDER BY random() LIMIT ?",
+                                             (SAMPLES,))]
+    # The top folders have the largest subtrees
+    top_folders = [row[0] for row in con.execute("SELECT id FROM States WHERE folderish=1 AND local_parent_path='/'"
+                                                 " ORDER BY id")]
+    con.close()
+    rows = [dao.get_state_from_id(row_id) for row_id in ids]
+    folder_rows = [dao.get_state_from_id(row_id) for row_id in folders]
+
+    measure(results, "get_state_from_id", getattr(dao, "get_state_from_id", None),
+            [(row.id,) for row in rows])
+    measure(results, "get_state_from_local", getattr(dao, "get_state_from_local", None),
+            [(row.local_path,) for row in rows])
+    measure(results, "get_states_from_remote", getattr(dao, "get_states_from_remote", None),
+            [(row.remote_ref,) for row in rows])
+    measure(results, "get_local_children", getattr(dao, "get_local_children", None),
+            [(row.local_path,) for row in folder_rows])
+    measure(results, "get_remote_children", getattr(dao, "get_remote_children", None),
+            [(row.remote_ref,) for row in folder_rows])
+    measure(results, "get_states_from_partial_local", getattr(dao, "get_states_from_partial_local", None),
+            [(row.local_path + '/',) for row in folder_rows[:10]])
+    measure(results, "get_remote_descendants_from_ref", getattr(dao, "get_remote_descendants_from_ref", None),
+            [(row.remote_ref,) for row in folder_rows[:10]])
+    measure(results, "is_filter", getattr(dao, "is_filter", None), [(row.local_path,) for row in rows])
+    for method in ("get_sync_count", "get_syncing_count", "get_conflict_count", "get_error_count",
+                   "get_unsynchronized_count", "get_global_size", "get_count", "get_conflicts", "get_errors"):
+        measure(results, method, getattr(dao, method, None), [()] * 10)
+    measure(results, "queue_startup", queue_startup, [(dao,)])
+
+    # Mutations
+    measure(results, "increase_error", getattr(dao, "increase_error", None),
+            [(row, "BENCHMARK") for row in rows])
+    measure(results, "reset_error", getattr(dao, "reset_error", None), [(row,) for row in rows])
+    measure(results, "add_filter", getattr(dao, "add_filter", None),
+            [(row.local_path,) for row in folder_rows[:10]])
+    measure(results, "remove_filter", getattr(dao, "remove_filter", None),
+            [(row.local_path + '/',) for row in folder_rows[:10]])
+    measure(results, "synchronize_state", getattr(dao, "synchronize_state", None),
+            [(dao.get_state_from_id(row_id),) for row_id in pendings])
+    if top_folders:
+        folder = dao.get_state_from_id(top_folders[0])
+        measure(results, "update_local_parent_path", getattr(dao, "update_local_parent_path", None),
+                [(folder, folder.local_name + ' renamed', '/')])
+        subfolders = [row for row in dao.get_local_children('/' + folder.local_name + ' renamed') if row.folderish]
+        measure(results, "mark_descendants_remotely_deleted", getattr(dao, "mark_descendants_remotely_deleted", None),
+                [(row,) for row in subfolders[:3]])
+        measure(results, "remove_state", getattr(dao, "remove_state", None),
+                [(dao.get_state_from_id(row_id),) for row_id in top_folders[1:3]])
+    dao.dispose()
+    return results
+
+
+def get_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"]).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, base):
+    print "Comparison with %s (ratio > 1 is slower)" % base.get("revision")
+    for count, sizes in sorted(results["sizes"].items(), key=lambda item: int(item[0])):
+        base_ops = base["sizes"].get(count, {}).get("operations", {})
+        print "%s states" % count
+        for name, result in sorted(sizes["operations"].items()):
+            if name not in base_ops or base_ops[name]["mean"] == 0:
+                continue
+            print "  %-32s %7.2f" % (name, result["mean"] / base_ops[name]["mean"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the EngineDAO on synthetic databases")
+    parser.add_argument("--rows", default="10000,100000,1000000", help="Comma separated numbers of States")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="JSON file to write the results to")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare with")
+    options = parser.parse_args()
+    results = {"revision": get_revision(), "sqlite": sqlite3.sqlite_version, "seed": options.seed, "sizes": dict()}
+    folder = tempfile.mkdtemp()
+    try:
+        for count in [int(value) for value in options.rows.split(',')]:
+            path = os.path.join(folder, 'benchmark_%d.db' % count)
+            print "Creating %d states" % count
+            build = create_database(path, count, options.seed)
+            print "  %-32s %.2fs, %.1f MB" % ("build", build, os.path.getsize(path) / 1048576.0)
+            results["sizes"][str(count)] = {"build": build, "size": os.path.getsize(path),
+                                            "operations": benchmark(path)}
+    finally:
+        shutil.rmtree(folder)
+    if options.output is not None:
+        with open(options.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    if options.compare is not None:
+        with open(options.compare) as base:
+            compare(results, json.load(base))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
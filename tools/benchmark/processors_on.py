@@ -0,0 +1,132 @@
+'''
+Time the "is a processor working under this path" lookups of the QueueManager
+
+The watchers ask it on each event: compare the former scan of every processor with the
+PathIndex of the pairs in process, while the processors keep switching pairs.
+
+Usage: python processors_on.py [--workers 64] [--events 10000] [--switches 1000]
+'''
+import argparse
+import random
+import sys
+from threading import Lock
+from time import time
+
+from nxdrive.engine.path_index import PathIndex
+
+FOLDERS = 200
+FILES_PER_FOLDER = 50
+
+
+class Pair(object):
+    def __init__(self, local_path, folderish=False):
+        self.local_path = local_path
+        self.folderish = folderish
+
+
+class Worker(object):
+    def __init__(self):
+        self.pair = None
+
+    def get_current_pair(self):
+        return self.pair
+
+
+class ScanLookup(object):
+    # The lookups before the PathIndex: every processor is asked under the inspection lock
+    def __init__(self, workers):
+        self._workers = workers
+        self._lock = Lock()
+
+    def set(self, worker, pair):
+        worker.pair = pair
+
+    def _is_processing(self, worker, path, exact_match):
+        doc_pair = worker.get_current_pair()
+        if doc_pair is None or doc_pair.local_path is None:
+            return False
+        if exact_match:
+            return doc_pair.local_path == path
+        return doc_pair.local_path.startswith(path)
+
+    def get_processors_on(self, path, exact_match=True):
+        self._lock.acquire()
+        try:
+            return [worker for worker in self._workers if self._is_processing(worker, path, exact_match)]
+        finally:
+            self._lock.release()
+
+    def has_file_processors_on(self, path):
+        self._lock.acquire()
+        try:
+            for worker in self._workers:
+                if self._is_processing(worker, path, False):
+                    return True
+            return False
+        finally:
+            self._lock.release()
+
+
+class IndexLookup(object):
+    def __init__(self, workers):
+        self._index = PathIndex()
+
+    def set(self, worker, pair):
+        worker.pair = pair
+        self._index.set(worker, pair.local_path, folderish=pair.folderish)
+
+    def get_processors_on(self, path, exact_match=True):
+        return self._index.get_workers(path, exact_match)
+
+    def has_file_processors_on(self, path):
+        return self._index.has_files(path)
+
+
+def get_paths(seed):
+    random.seed(seed)
+    folders = ['/folder %d' % i for i in xrange(FOLDERS)]
+    files = [folder + '/file %d.txt' % i for folder in folders for i in xrange(FILES_PER_FOLDER)]
+    return folders, files
+
+
+def benchmark(lookup_class, workers_count, events, switches, seed):
+    folders, files = get_paths(seed)
+    workers = [Worker() for _ in xrange(workers_count)]
+    lookup = lookup_class(workers)
+    for worker in workers:
+        lookup.set(worker, Pair(random.choice(files)))
+    # One event out of events / switches makes a processor take another pair
+    switch_every = max(events // max(switches, 1), 1)
+    queries = [(random.choice(files), random.choice(folders)) for _ in xrange(events)]
+    start = time()
+    found = 0
+    for i, (file_path, folder_path) in enumerate(queries):
+        if i % switch_every == 0:
+            lookup.set(random.choice(workers), Pair(random.choice(files)))
+        # A watcher event: the exact pair, then its folder
+        found += len(lookup.get_processors_on(file_path, exact_match=True))
+        found += len(lookup.get_processors_on(folder_path, exact_match=False))
+        lookup.has_file_processors_on(folder_path)
+    return time() - start, found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--workers', type=int, default=64)
+    parser.add_argument('--events', type=int, default=10000)
+    parser.add_argument('--switches', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=42)
+    options = parser.parse_args()
+    print "%d processors, %d events with %d pair switches" % (options.workers, options.events, options.switches)
+    base = None
+    for name, lookup_class in (("scan", ScanLookup), ("index", IndexLookup)):
+        duration, found = benchmark(lookup_class, options.workers, options.events, options.switches, options.seed)
+        ratio = "" if base is None else "  x%.1f" % (base / duration)
+        print "  %-8s %.3fs, %6.1f us/event, %d matches%s" % (
+            name, duration, duration * 1000000 / options.events, found, ratio)
+        base = base or duration
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,73 @@
+'''
+Compare the memory and attribute access cost of the EngineDAO row factories
+
+Usage: python row_factory.py [rows]
+'''
+import gc
+import os
+import sys
+import tempfile
+import shutil
+from time import time
+
+import psutil
+
+from nxdrive.engine.dao.sqlite import EngineDAO, CustomRow, state_row_factory, STATE_CODES
+
+ATTRIBUTES = ('id', 'local_path', 'remote_ref', 'pair_state', 'version')
+
+
+def create_database(path, count):
+    dao = EngineDAO(path, cache_size=0)
+    con = dao._get_write_connection()
+    synchronized = STATE_CODES['synchronized']
+    con.executemany("INSERT INTO States(local_path, local_parent_path, local_name, remote_ref, remote_parent_ref,"
+                    " remote_name, folderish, size, local_state, remote_state, pair_state)"
+                    " VALUES(?, '/folder', ?, ?, 'parent', ?, 0, 1024, ?, ?, ?)",
+                    (('/folder/file %d' % i, 'file %d' % i, 'ref#%d' % i, 'file %d' % i) + (synchronized,) * 3
+                     for i in xrange(count)))
+    con.commit()
+    return dao
+
+
+def get_rss():
+    gc.collect()
+    return psutil.Process(os.getpid()).memory_info().rss
+
+
+def benchmark(dao, name, factory):
+    con = dao._get_read_connection(factory)
+    rss = get_rss()
+    start = time()
+    rows = con.execute("SELECT * FROM States").fetchall()
+    fetch_time = time() - start
+    memory = get_rss() - rss
+    start = time()
+    for row in rows:
+        for attribute in ATTRIBUTES:
+            getattr(row, attribute)
+    access_time = time() - start
+    start = time()
+    for row in rows:
+        row.local_state = 'moved'
+    update_time = time() - start
+    print "%-12s fetch %6.2fs  memory %7.1f MB (%4d bytes/row)  read %6.2fs  update %6.2fs" % (
+        name, fetch_time, memory / 1048576.0, memory / max(len(rows), 1), access_time, update_time)
+    del rows
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    folder = tempfile.mkdtemp()
+    try:
+        print "Creating %d states" % count
+        dao = create_database(os.path.join(folder, 'benchmark.db'), count)
+        benchmark(dao, "CustomRow", CustomRow)
+        benchmark(dao, "StateRow", state_row_factory)
+        dao.dispose()
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    main()